@@ -1,5 +1,5 @@
 from django.urls import path, re_path
-from .views import RegisterApi
+from .views import RegisterApi, VerifyApi
 
 from rest_framework_simplejwt.views import (
     TokenObtainPairView,
@@ -10,5 +10,6 @@ urlpatterns = [
     re_path(r'^register/?$', RegisterApi.as_view(), name='register_api'),
     re_path(r'^login/?$', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     re_path(r'refresh/?$', TokenRefreshView.as_view(), name='token_refresh'),
+    re_path(r'^verify/?$', VerifyApi.as_view(), name='verify_api'),
 
 ]
@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MainAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'main_app'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+        from .components.metrics import install_query_counter
+        from . import signals  # noqa: F401
+
+        connection_created.connect(install_query_counter)
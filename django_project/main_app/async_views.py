@@ -0,0 +1,237 @@
+import asyncio
+import logging
+import traceback
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import exceptions
+from rest_framework.authentication import SessionAuthentication
+from rest_framework.parsers import JSONParser
+from rest_framework.request import Request
+from rest_framework_simplejwt.authentication import JWTAuthentication
+
+from .components.open_ai import Request as OpenAIRequest
+from .components.cache import get_cache, make_key, canonical_ingredients
+from .components.single_flight import get_async_single_flight
+from .components.write_queue import get_write_queue
+from .components.youtube import asearch_video_link
+from .throttling import ExternalRateThrottle
+from .views import ListFoods, DetailFood, UNAVAILABLE, is_string_list, retry_after_headers
+
+logger = logging.getLogger('django')
+
+
+class AsyncAPIView(View):
+    """
+    Async counterpart of APIView for the endpoints waiting on OpenAI and YouTube.
+    DRF views are sync only, so authentication and JSON parsing are borrowed from DRF
+    and the request runs on the event loop while the upstream calls are in flight.
+    """
+
+    authentication_classes = (JWTAuthentication, SessionAuthentication)
+    throttle_classes = (ExternalRateThrottle,)
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # like APIView, JWT clients send no CSRF token and session users are checked by SessionAuthentication
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    def dispatch(self, request, *args, **kwargs):
+        return self._dispatch(request, *args, **kwargs)
+
+    async def _dispatch(self, request, *args, **kwargs):
+        drf_request = Request(
+            request,
+            parsers=[JSONParser()],
+            authenticators=[auth() for auth in self.authentication_classes],
+        )
+        try:
+            # the user lookup and the CSRF check of session users hit the database
+            user = await sync_to_async(lambda: drf_request.user)()
+            if not user or not user.is_authenticated:
+                raise exceptions.NotAuthenticated()
+            await sync_to_async(self.check_throttles)(drf_request)
+            request.data = drf_request.data
+        except exceptions.APIException as e:
+            response = JsonResponse({"detail": str(e.detail)}, status=e.status_code)
+            if getattr(e, "wait", None):
+                response["Retry-After"] = "%d" % e.wait
+            return response
+        return await super().dispatch(request, *args, **kwargs)
+
+
+    def check_throttles(self, request):
+        """
+        :param request: rest_framework Request of an authenticated user
+        :raises: Throttled when a quota of the user is used up
+        """
+        throttled, waits = False, []
+        for throttle_class in self.throttle_classes:
+            throttle = throttle_class()
+            if not throttle.allow_request(request, self):
+                throttled = True
+                waits.append(throttle.wait())
+        if throttled:
+            waits = [wait for wait in waits if wait is not None]
+            raise exceptions.Throttled(max(waits) if waits else None)
+
+
+class AsyncListFoods(AsyncAPIView):
+    """
+    ListFoods served without holding a worker thread while OpenAI answers
+    """
+
+    async def parse_ingredients(self, ingredients):
+        """
+
+        :param ingredients: list, list of ingredients in string
+        :return: list of foods that was cached, found in stored recipes or generated by OpenAI
+        """
+        try:
+            cache = get_cache("list_foods")
+            cache_key = make_key(canonical_ingredients(ingredients))
+            list_of_foods = await sync_to_async(cache.get)(cache_key)
+            if list_of_foods is not None:
+                return list_of_foods
+
+            list_of_foods = await sync_to_async(ListFoods().match_stored_foods)(ingredients)
+            if list_of_foods:
+                return list_of_foods
+
+            openai_req = OpenAIRequest()
+            list_of_foods = ListFoods.parse_food_list(await openai_req.aget_list_food(ingredients))
+            if list_of_foods:
+                await sync_to_async(cache.set)(cache_key, list_of_foods)
+            return list_of_foods
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+
+    async def post(self, request, *args, **kwargs):
+        """
+        the function takes post request and proceeds for OPENAI
+        :param request: request data
+        :return:  JsonResponse of status
+        """
+        try:
+            ingredients = request.data.get("ingredients")
+            if not ingredients:
+                return JsonResponse({
+                    "message": "error, send ingredients with same key (ingredients key must be sent in body)",
+                })
+            if not is_string_list(ingredients):
+                return JsonResponse({"message": "error, send ingredients as a list of strings"}, status=400)
+
+            list_of_foods = await self.parse_ingredients(ingredients)
+            if not list_of_foods:
+                degraded = await sync_to_async(ListFoods().degraded)(ingredients)
+                if degraded:
+                    return JsonResponse(degraded)
+                return JsonResponse(UNAVAILABLE, status=503, headers=retry_after_headers())
+            return JsonResponse({
+                "Ready Response": list_of_foods
+            })
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+            return JsonResponse({"message": "Something went wrong"}, status=500)
+
+
+class AsyncDetailFood(AsyncAPIView):
+    """
+    DetailFood served without holding a worker thread while OpenAI and YouTube answer
+    """
+
+    async def search_video_link(self, food_name):
+        """
+        :param food_name: str, name of food
+        :return: str, YouTube link, None when the search fails or times out
+        """
+        try:
+            return await asyncio.wait_for(asearch_video_link(food_name),
+                                          timeout=settings.EXTERNAL_CALLS['VIDEO_TIMEOUT'])
+        except BaseException as e:
+            # the recipe is the valuable part, answer without the video
+            logger.warning("video search failed for %s: %r", food_name, e)
+
+    async def get_response_openai(self, food_name, ingredients):
+        """
+        :param food_name: str, name of food
+        :param ingredients: list, list of ingredients in string
+        :return: response generated from OpenAI and YouTube api
+        """
+        try:
+            openai_req = OpenAIRequest()
+            recipe, response_youtube = await asyncio.gather(
+                asyncio.wait_for(openai_req.aget_recipe(food_name, ingredients),
+                                 timeout=settings.EXTERNAL_CALLS['RECIPE_TIMEOUT']),
+                self.search_video_link(food_name),
+            )
+            # stored by the write queue workers after the response is sent
+            await sync_to_async(get_write_queue().submit)(
+                DetailFood().create_food, food_name, response_youtube, recipe, ingredients
+            )
+            return [{"Name": food_name, "link": response_youtube, "recipe": recipe}]
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+
+    async def get_or_generate(self, food_name, ingredients):
+        """
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        :return: response from database or generated from OpenAI and YouTube api
+        """
+        food = await sync_to_async(DetailFood().get_food)(food_name, primary=True)
+        if food:
+            return [DetailFood().food_response(food_name, food)]
+        return await self.get_response_openai(food_name, ingredients)
+
+    async def post(self, request, *args, **kwargs):
+        """
+        the function takes post request and proceeds for OPENAI and YouTube API,
+        streaming with ?stream=1 is only served by the sync DetailFood
+        :param request: request data
+        :return:  JsonResponse of status
+        """
+        try:
+            if request.GET.get("stream"):
+                return JsonResponse({"message": "error, streaming is not supported by this server"}, status=400)
+
+            food_name = request.data.get("name")
+            ingredients = request.data.get("ingredients")
+            if not (food_name and ingredients):
+                return JsonResponse({
+                    "message": "error, send ingredients with same key",
+                })
+            if not (isinstance(food_name, str) and is_string_list(ingredients)):
+                return JsonResponse({
+                    "message": "error, send name as a string and ingredients as a list of strings",
+                }, status=400)
+
+            ingredients = [i.strip() for i in ingredients]
+            food_name = food_name.strip()
+            await sync_to_async(DetailFood().count_request)(food_name, ingredients)
+            food_exists = await sync_to_async(DetailFood().get_food)(food_name)
+            if food_exists:
+                ready_response = [DetailFood().food_response(food_name, food_exists)]
+            else:
+                ready_response = await get_async_single_flight().do(
+                    make_key("detail", food_name.lower()),
+                    lambda: self.get_or_generate(food_name, ingredients)
+                )
+            if not ready_response:
+                degraded = await sync_to_async(DetailFood().degraded)(food_name, ingredients)
+                if degraded:
+                    return JsonResponse(degraded)
+                return JsonResponse(UNAVAILABLE, status=503, headers=retry_after_headers())
+            return JsonResponse({
+                "Ready Response": ready_response
+            })
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+            return JsonResponse({"message": "Something went wrong"}, status=500)
@@ -0,0 +1,290 @@
+"""
+Building blocks of the benchmark management command: stub upstream servers, an in-process Django server
+and a load generator. Nothing here is used while serving real traffic.
+"""
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.core.wsgi import get_wsgi_application
+from rest_framework.renderers import JSONRenderer
+
+from manage_foods.fast_serializers import FastJSONRenderer, FoodValuesSerializer
+
+from .components.metrics import Summary
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+
+class LatencyProfile:
+    """
+    Behaviour of a stub upstream: latency + uniform jitter seconds per call and the share of failing calls
+    """
+
+    def __init__(self, latency=0.2, jitter=0.0, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def sample(self):
+        """
+        :return: (seconds to wait, whether the call fails)
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0, self.jitter)
+            return delay, self._random.random() < self.error_rate
+
+    def as_dict(self):
+        return {"latency": self.latency, "jitter": self.jitter, "error_rate": self.error_rate}
+
+
+def _digest(text, length=8):
+    return hashlib.sha256(text.encode()).hexdigest()[:length]
+
+
+class StubUpstreamHandler(BaseHTTPRequestHandler):
+    """
+    POST /completions answers like the OpenAI completions API (plain or streamed),
+    GET /youtube?q=... answers like VideosSearch.result()
+    """
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def completion_text(self, prompt):
+        if prompt.startswith("What kind of foods"):
+            return "\n".join("{}. Dish {}".format(i, _digest(prompt + str(i), 6)) for i in range(1, 6)) + "."
+        return " ".join("{}. Step {} of the recipe.".format(i, _digest(prompt + str(i), 4)) for i in range(1, 9))
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        delay, failed = self.server.openai.sample()
+        time.sleep(delay)
+        if failed:
+            return self.send_json(503, {"error": {"message": "stub failure"}})
+        text = self.completion_text(payload.get("prompt", ""))
+        if not payload.get("stream"):
+            return self.send_json(200, {"choices": [{"text": text}]})
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for word in text.split(" "):
+            time.sleep(self.server.token_delay)
+            self.wfile.write("data: {}\n\n".format(json.dumps({"choices": [{"text": word + " "}]})).encode())
+            self.wfile.flush()
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query).get("q", [""])[0]
+        delay, failed = self.server.youtube.sample()
+        time.sleep(delay)
+        if failed:
+            return self.send_json(500, {"error": "stub failure"})
+        self.send_json(200, {"result": [{"link": "https://www.youtube.com/watch?v={}".format(_digest(query, 11))}]})
+
+
+class StubUpstream:
+    """
+    Stub OpenAI and YouTube server running in a background thread
+    """
+
+    def __init__(self, openai, youtube, token_delay=0.0):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubUpstreamHandler)
+        self.server.daemon_threads = True
+        self.server.openai = openai
+        self.server.youtube = youtube
+        self.server.token_delay = token_delay
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def stub_videos_search(url):
+    """
+    :param url: str, base url of a StubUpstream
+    :return: class with the interface of youtubesearchpython.VideosSearch asking the stub
+    """
+    session = requests.Session()
+
+    class StubVideosSearch:
+        def __init__(self, query, limit=1):
+            self.query = query
+
+        def result(self):
+            response = session.get(url + "/youtube", params={"q": self.query}, timeout=10)
+            response.raise_for_status()
+            return response.json()
+
+    return StubVideosSearch
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+class DjangoServer:
+    """
+    The project's WSGI application served by a threaded server in a background thread
+    """
+
+    def __init__(self):
+        self.server = ThreadedWSGIServer(("127.0.0.1", 0), _QuietHandler, allow_reuse_address=False)
+        self.server.set_app(get_wsgi_application())
+        self.url = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def queries_of(response):
+    """
+    :param response: requests.Response of the project
+    :return: int, database queries reported in its Server-Timing header, None without the header
+    """
+    for timing in response.headers.get("Server-Timing", "").split(","):
+        name, _, params = timing.strip().partition(";")
+        if name == "db" and 'desc="' in params:
+            return int(params.split('desc="')[1].split(" ")[0])
+
+
+def run_scenario(send, total, concurrency):
+    """
+    :param send: callable (requests.Session, request number) returning a requests.Response
+    :param total: int, number of requests
+    :param concurrency: int, requests in flight at the same time
+    :return: dict, throughput, latency percentiles in milliseconds, statuses and database queries per request
+    """
+    local = threading.local()
+    latencies, queries, statuses = Summary(max_samples=total), [], {}
+    lock = threading.Lock()
+
+    def one(i):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        started = time.perf_counter()
+        try:
+            response = send(local.session, i)
+            response.content  # the whole body, streaming responses included
+            status, count = str(response.status_code), queries_of(response)
+        except requests.RequestException:
+            status, count = "error", None
+        latency = time.perf_counter() - started
+        with lock:
+            latencies.observe(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+            if count is not None:
+                queries.append(count)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one, range(total)))
+    duration = time.perf_counter() - started
+
+    percentiles = latencies.quantiles(QUANTILES)
+    failed = sum(count for status, count in statuses.items() if status == "error" or status >= "500")
+    return {
+        "requests": total,
+        "concurrency": concurrency,
+        "duration": round(duration, 3),
+        "throughput": round(total / duration, 2),
+        "latency_ms": {
+            "mean": round(latencies.sum / total * 1000, 2),
+            **{"p{}".format(int(q * 100)): round(value * 1000, 2) for q, value in percentiles.items()},
+        },
+        "error_rate": round(failed / total, 4),
+        "statuses": dict(sorted(statuses.items())),
+        "queries_per_request": round(sum(queries) / len(queries), 2) if queries else None,
+    }
+
+
+def compare(base, current):
+    """
+    :param base: dict, results of an earlier run
+    :param current: dict, results of this run
+    :return: list of (scenario, metric, base value, current value, change in percent)
+    """
+    rows = []
+    for name, result in current["scenarios"].items():
+        previous = base.get("scenarios", {}).get(name)
+        if not previous:
+            continue
+        for metric, old, new in (
+            ("throughput", previous["throughput"], result["throughput"]),
+            ("p50_ms", previous["latency_ms"]["p50"], result["latency_ms"]["p50"]),
+            ("p95_ms", previous["latency_ms"]["p95"], result["latency_ms"]["p95"]),
+            ("p99_ms", previous["latency_ms"]["p99"], result["latency_ms"]["p99"]),
+            ("queries", previous["queries_per_request"], result["queries_per_request"]),
+        ):
+            change = (new - old) / old * 100 if old and new is not None else None
+            rows.append((name, metric, old, new, change))
+    return rows
+
+
+def time_serialization(queryset, serializer_class, repeat=3):
+    """
+    Renders the same foods as JSON with serializer_class and JSONRenderer, the way views did before, and with
+    FoodValuesSerializer and FastJSONRenderer, reading the rows from the database included
+
+    :param queryset: Food queryset, not sliced
+    :param serializer_class: FoodSerializer or NestedFoodSerializer
+    :param repeat: int, runs of each path, the fastest one counts
+    :return: dict, milliseconds of both paths, speedup, size of the JSON and whether both JSONs are equal
+    """
+    fast = FoodValuesSerializer(serializer_class)
+
+    def serializer():
+        foods = serializer_class.setup_eager_loading(queryset)
+        return JSONRenderer().render(serializer_class(foods, many=True).data)
+
+    def values():
+        return FastJSONRenderer().render(fast.to_representation(fast.values(queryset), queryset.db))
+
+    timings, bodies = {}, {}
+    for name, render in (("serializer", serializer), ("fast", values)):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            bodies[name] = render()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        timings[name] = best
+    return {
+        "serializer_ms": round(timings["serializer"] * 1000, 2),
+        "fast_ms": round(timings["fast"] * 1000, 2),
+        "speedup": round(timings["serializer"] / timings["fast"], 2) if timings["fast"] else None,
+        "bytes": len(bodies["serializer"]),
+        "identical": bodies["serializer"] == bodies["fast"],
+    }
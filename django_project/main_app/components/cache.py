@@ -0,0 +1,360 @@
+import hashlib
+import itertools
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.cache.backends.filebased import FileBasedCache
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger('django')
+
+
+def canonical_ingredients(ingredients):
+    """
+    :param ingredients: list, list of ingredients in string
+    :return: sorted list of lowercased, trimmed and deduplicated ingredients
+    """
+    return sorted({str(i).strip().lower() for i in ingredients if str(i).strip()})
+
+
+def make_key(*parts):
+    """
+    :param parts: json serializable parts of the key
+    :return: str, stable hash of the given parts
+    """
+    raw = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class BaseBackend:
+    """
+    Storage of text values for ResultCache, bounded by max_entries with LRU eviction.
+    Shared backends evict once every evict_every writes of a process and record an access at most once every
+    touch_interval seconds per entry, the number of entries may exceed max_entries between evictions.
+    """
+
+    def __init__(self, namespace, max_entries=1000, evict_every=100, touch_interval=60, **options):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.touch_interval = touch_interval
+        self._writes = itertools.count(1)
+
+    def _evict_due(self):
+        """
+        :return: bool, True once every evict_every calls
+        """
+        return next(self._writes) % self.evict_every == 0
+
+    def get(self, key):
+        """
+        :param key: str, cache key
+        :return: stored text or None if missing or expired
+        """
+        raise NotImplementedError
+
+    def set(self, key, value, timeout):
+        """
+        :param key: str, cache key
+        :param value: str, text to store
+        :param timeout: int, seconds until expiry, None for no expiry
+        """
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class MemoryBackend(BaseBackend):
+    """
+    In-process backend, every worker has its own copy
+    """
+
+    def __init__(self, namespace, max_entries=1000, **options):
+        super().__init__(namespace, max_entries, **options)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        expires_at = time.monotonic() + timeout if timeout is not None else None
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class DatabaseBackend(BaseBackend):
+    """
+    Backend stored in main_app.CacheEntry table, shared by all workers
+    """
+
+    def get(self, key):
+        from main_app.models import CacheEntry
+
+        now = timezone.now()
+        entry = CacheEntry.objects.filter(namespace=self.namespace, key=key).only(
+            "value", "expires_at", "accessed_at"
+        ).first()
+        if entry is None:
+            return None
+        if entry.expires_at is not None and entry.expires_at < now:
+            entry.delete()
+            return None
+        if (now - entry.accessed_at).total_seconds() >= self.touch_interval:
+            CacheEntry.objects.filter(pk=entry.pk).update(accessed_at=now)
+        return entry.value
+
+    def set(self, key, value, timeout):
+        from main_app.models import CacheEntry
+
+        now = timezone.now()
+        expires_at = now + timedelta(seconds=timeout) if timeout is not None else None
+        CacheEntry.objects.update_or_create(
+            namespace=self.namespace, key=key,
+            defaults={"value": value, "expires_at": expires_at, "accessed_at": now}
+        )
+        if self._evict_due():
+            self._evict(now)
+
+    def _evict(self, now):
+        from main_app.models import CacheEntry
+
+        entries = CacheEntry.objects.filter(namespace=self.namespace)
+        entries.filter(expires_at__lt=now).delete()
+        stale = list(entries.order_by("-accessed_at").values_list("pk", flat=True)[self.max_entries:])
+        if stale:
+            CacheEntry.objects.filter(pk__in=stale).delete()
+
+    def delete(self, key):
+        from main_app.models import CacheEntry
+
+        CacheEntry.objects.filter(namespace=self.namespace, key=key).delete()
+
+    def clear(self):
+        from main_app.models import CacheEntry
+
+        CacheEntry.objects.filter(namespace=self.namespace).delete()
+
+
+class FileBackend(BaseBackend):
+    """
+    Backend stored as one file per key in a local directory, shared by workers of one host.
+    File modification time is used as the last access time.
+    """
+
+    def __init__(self, namespace, max_entries=1000, location=None, **options):
+        super().__init__(namespace, max_entries, **options)
+        location = location or os.path.join(tempfile.gettempdir(), "riga_idea_cache")
+        self.location = os.path.join(location, namespace)
+        os.makedirs(self.location, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.location, key)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                item = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if item.get("expires_at") is not None and item["expires_at"] < time.time():
+            self.delete(key)
+            return None
+        try:
+            now = time.time_ns()
+            if now - os.stat(path).st_mtime_ns >= self.touch_interval * 1e9:
+                os.utime(path, ns=(now, now))
+        except OSError:
+            pass
+        return item.get("value")
+
+    def set(self, key, value, timeout):
+        expires_at = time.time() + timeout if timeout is not None else None
+        fd, tmp_path = tempfile.mkstemp(dir=self.location, prefix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({"value": value, "expires_at": expires_at}, f)
+        os.replace(tmp_path, self._path(key))
+        if self._evict_due():
+            self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.location):
+            if name.startswith(".tmp"):
+                continue
+            try:
+                entries.append((os.stat(self._path(name)).st_mtime_ns, name))
+            except OSError:
+                continue
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, name in entries[:len(entries) - self.max_entries]:
+            self.delete(name)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.location):
+            self.delete(name)
+
+
+class LazyCullFileBasedCache(FileBasedCache):
+    """
+    FileBasedCache culling once every OPTIONS['CULL_EVERY'] writes (1000 by default) of a process instead of on
+    every write. FileBasedCache lists the whole directory to count the entries before each set and add, which
+    dominates writes once a cache holds thousands of entries; the count may exceed MAX_ENTRIES between culls.
+    """
+
+    def __init__(self, dir, params):
+        super().__init__(dir, params)
+        self._cull_every = params.get("OPTIONS", {}).get("CULL_EVERY", 1000)
+        self._writes = itertools.count(1)
+
+    def _cull(self):
+        if next(self._writes) % self._cull_every == 0:
+            super()._cull()
+
+
+class ResultCache:
+    """
+    JSON value cache on top of a backend, counts hits and misses.
+    Backend errors are logged and treated as misses so a broken cache never fails a request.
+    """
+
+    def __init__(self, backend, timeout=None):
+        self.backend = backend
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def get(self, key, default=None):
+        """
+        :param key: str, cache key
+        :param default: value returned on miss
+        :return: cached value or default
+        """
+        try:
+            raw = self.backend.get(key)
+        except BaseException:
+            logger.exception("cache get failed")
+            raw = None
+        self._count(raw is not None)
+        if raw is None:
+            return default
+        return json.loads(raw)
+
+    def set(self, key, value, timeout=...):
+        """
+        :param key: str, cache key
+        :param value: json serializable value
+        :param timeout: int, seconds until expiry, defaults to cache TIMEOUT
+        """
+        timeout = self.timeout if timeout is ... else timeout
+        try:
+            self.backend.set(key, json.dumps(value), timeout)
+        except BaseException:
+            logger.exception("cache set failed")
+
+    def delete(self, key):
+        try:
+            self.backend.delete(key)
+        except BaseException:
+            logger.exception("cache delete failed")
+
+    def clear(self):
+        self.backend.clear()
+        with self._lock:
+            self.hits = self.misses = 0
+
+    def stats(self):
+        """
+        :return: dict, hits, misses and hit ratio of the cache
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+            }
+
+
+DEFAULT_CACHE = {
+    "BACKEND": "main_app.components.cache.MemoryBackend",
+    "TIMEOUT": 60 * 60,
+    "MAX_ENTRIES": 1000,
+    "OPTIONS": {},
+}
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_cache(alias):
+    """
+    :param alias: str, name of the cache in settings.RESULT_CACHES
+    :return: ResultCache shared by the process
+    """
+    cache = _caches.get(alias)
+    if cache is not None:
+        return cache
+    with _caches_lock:
+        if alias not in _caches:
+            config = {**DEFAULT_CACHE, **getattr(settings, "RESULT_CACHES", {}).get(alias, {})}
+            backend_cls = import_string(config["BACKEND"])
+            backend = backend_cls(alias, max_entries=config["MAX_ENTRIES"], **config["OPTIONS"])
+            _caches[alias] = ResultCache(backend, timeout=config["TIMEOUT"])
+        return _caches[alias]
+
+
+def all_caches():
+    """
+    :return: dict, alias to ResultCache of every cache created by the process
+    """
+    return dict(_caches)
@@ -0,0 +1,181 @@
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.signals import setting_changed
+
+from .rate_limit import RateLimited
+
+logger = logging.getLogger('django')
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitOpen(Exception):
+    """
+    Raised instead of calling an upstream whose circuit is open
+    """
+
+
+class CircuitBreaker:
+    """
+    Tracks the calls of one upstream over the last window seconds. When at least min_calls were made
+    and failure_rate of them failed or took longer than slow_call_duration, the circuit opens and calls
+    fail at once with CircuitOpen. After open_timeout seconds one trial call is let through (half open):
+    its success closes the circuit, its failure opens it again.
+    State is per process, every worker learns about an incident from its own calls.
+    """
+
+    def __init__(self, name, failure_rate=0.5, min_calls=5, window=60, slow_call_duration=None,
+                 open_timeout=30, ignored_exceptions=(RateLimited,)):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window = window
+        self.slow_call_duration = slow_call_duration
+        self.open_timeout = open_timeout
+        self.ignored_exceptions = ignored_exceptions
+        self._calls = deque()
+        self._state = CLOSED
+        self._opened_at = None
+        self._trial = False
+        self._lock = threading.Lock()
+        self._counters = {"succeeded": 0, "failed": 0, "rejected": 0, "opened": 0}
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_timeout:
+            self._state = HALF_OPEN
+            self._trial = False
+        return self._state
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._calls.clear()
+        self._counters["opened"] += 1
+        logger.warning("circuit of %s is open", self.name)
+
+    def allow(self):
+        """
+        :raises: CircuitOpen when the upstream must not be called now
+        """
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return
+            if state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return
+            self._counters["rejected"] += 1
+        raise CircuitOpen("{} is unavailable".format(self.name))
+
+    def release(self):
+        """
+        Gives back a call allowed by allow() that did not reach the upstream
+        """
+        with self._lock:
+            self._trial = False
+
+    def record(self, failed, duration=0):
+        """
+        :param failed: bool, the call raised an error
+        :param duration: float, seconds the call took
+        """
+        failed = failed or (self.slow_call_duration is not None and duration > self.slow_call_duration)
+        now = time.monotonic()
+        with self._lock:
+            self._counters["failed" if failed else "succeeded"] += 1
+            if self._current_state() == HALF_OPEN:
+                if failed:
+                    self._open()
+                else:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    logger.info("circuit of %s is closed", self.name)
+                return
+
+            self._calls.append((now, failed))
+            while self._calls and self._calls[0][0] < now - self.window:
+                self._calls.popleft()
+            failures = sum(1 for _, f in self._calls if f)
+            if len(self._calls) >= self.min_calls and failures >= self.failure_rate * len(self._calls):
+                self._open()
+
+    @contextmanager
+    def guard(self):
+        """
+        Wraps one call of the upstream, sync or async:
+
+            with breaker.guard():
+                response = session.post(...)
+
+        :raises: CircuitOpen when the circuit is open, the error of the call otherwise
+        """
+        self.allow()
+        started = time.monotonic()
+        try:
+            yield
+        except self.ignored_exceptions:
+            self.release()
+            raise
+        except BaseException:
+            self.record(True, time.monotonic() - started)
+            raise
+        self.record(False, time.monotonic() - started)
+
+    def stats(self):
+        """
+        :return: dict, state and counters of the circuit
+        """
+        with self._lock:
+            return {"state": self._current_state(), **self._counters}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(alias):
+    """
+    :param alias: str, name of the upstream in settings.CIRCUIT_BREAKERS
+    :return: CircuitBreaker shared by the process, None if the upstream has none
+    """
+    breakers = getattr(settings, "CIRCUIT_BREAKERS", {})
+    if alias not in breakers:
+        return None
+    with _breakers_lock:
+        if alias not in _breakers:
+            config = breakers[alias]
+            _breakers[alias] = CircuitBreaker(
+                alias,
+                failure_rate=config.get("FAILURE_RATE", 0.5),
+                min_calls=config.get("MIN_CALLS", 5),
+                window=config.get("WINDOW", 60),
+                slow_call_duration=config.get("SLOW_CALL_DURATION"),
+                open_timeout=config.get("OPEN_TIMEOUT", 30),
+            )
+        return _breakers[alias]
+
+
+def all_circuit_breakers():
+    """
+    :return: dict, alias to CircuitBreaker of every breaker created by the process
+    """
+    return dict(_breakers)
+
+
+def _reset_circuit_breakers(setting, **kwargs):
+    if setting == "CIRCUIT_BREAKERS":
+        with _breakers_lock:
+            _breakers.clear()
+
+
+setting_changed.connect(_reset_circuit_breakers)
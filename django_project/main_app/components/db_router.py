@@ -0,0 +1,77 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+# whether reads of the apps of DATABASE_ROUTING['REPLICA_APPS'] may go to the replica, primary by default
+_replica_reads = ContextVar("replica_reads", default=False)
+
+
+@contextmanager
+def replica_reads():
+    """
+    Sends the reads of the block to the replica, they may lag behind the latest writes
+    """
+    token = _replica_reads.set(True)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+@contextmanager
+def primary_reads():
+    """
+    Sends the reads of the block to the primary, for reads that must see every committed write
+    """
+    token = _replica_reads.set(False)
+    try:
+        yield
+    finally:
+        _replica_reads.reset(token)
+
+
+def use_replica(enabled):
+    """
+    Sets whether the following reads of the request may go to the replica, see DatabaseRoutingMiddleware
+
+    :param enabled: bool
+    """
+    _replica_reads.set(enabled)
+
+
+class ReplicaRouter:
+    """
+    Sends reads of the apps of DATABASE_ROUTING['REPLICA_APPS'] to the DATABASE_ROUTING['REPLICA'] alias while
+    replica reads are enabled and everything else to the primary. A write disables replica reads for the rest of
+    the request or block, reads inside a transaction of the primary stay on it, so a request reads its own writes.
+    """
+
+    def db_for_read(self, model, **hints):
+        replica = settings.DATABASE_ROUTING['REPLICA']
+        if (
+            replica
+            and _replica_reads.get()
+            and model._meta.app_label in settings.DATABASE_ROUTING['REPLICA_APPS']
+            and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+        ):
+            return replica
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if _replica_reads.get():
+            _replica_reads.set(False)
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, settings.DATABASE_ROUTING['REPLICA']}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, **hints):
+        if db == settings.DATABASE_ROUTING['REPLICA']:
+            return False
+        return None
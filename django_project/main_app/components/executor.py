@@ -0,0 +1,22 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import close_old_connections
+
+
+def _run_task(fn, args, kwargs):
+    close_old_connections()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        close_old_connections()
+
+
+class DatabaseThreadPoolExecutor(ThreadPoolExecutor):
+    """
+    ThreadPoolExecutor for tasks using the ORM, such as the database backed caches: the connections of the thread
+    are checked before every task and closed after it once obsolete, as Django does around a request. Threads
+    never keep a broken connection and, with CONN_MAX_AGE 0 or a pool, hold none between tasks.
+    """
+
+    def submit(self, fn, /, *args, **kwargs):
+        return super().submit(_run_task, fn, args, kwargs)
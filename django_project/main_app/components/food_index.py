@@ -0,0 +1,215 @@
+import heapq
+import logging
+import threading
+import time
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('django')
+
+
+class FoodIndex:
+    """
+    In-memory inverted index of stored recipes: ingredient id -> sorted array of food ids.
+    Built when the WSGI or ASGI application starts (or by the first query otherwise), kept up to date by
+    main_app.signals and rebuilt on a background thread every REFRESH_INTERVAL seconds to pick up writes
+    of other workers. The previous index serves queries during a rebuild, the updates it receives meanwhile
+    are replayed on the new index when it is swapped in.
+    """
+
+    def __init__(self, refresh_interval=300):
+        self.refresh_interval = refresh_interval
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._built_at = None
+        self._refreshing = False
+        # updates received while a build runs, None when no build runs
+        self._journal = None
+        self._postings = {}
+        self._food_ingredients = {}
+        self._food_names = {}
+        self._ingredient_ids = {}
+        self._ingredient_keys = {}
+
+    @property
+    def is_built(self):
+        return self._built_at is not None
+
+    @property
+    def is_tracking(self):
+        """
+        :return: bool, True if updates are applied, once built or while the first build runs
+        """
+        return self._built_at is not None or self._journal is not None
+
+    def build(self):
+        """
+        Loads every food and ingredient, the previous index serves queries until the new one is ready.
+        A build waiting for a running one is skipped, the running one already reads the latest rows.
+        """
+        from manage_foods.models import Food, Ingredient
+
+        requested = time.monotonic()
+        with self._build_lock:
+            if self._built_at is not None and self._built_at >= requested:
+                return
+            with self._lock:
+                self._journal = []
+            food_names = dict(Food.objects.values_list("id", "name"))
+            ingredient_keys = {pk: name.upper() for pk, name in Ingredient.objects.values_list("id", "name")}
+            food_ingredients = {food_id: set() for food_id in food_names}
+            postings = {}
+            rows = Food.main_ingredients.through.objects.order_by("food_id").values_list("food_id", "ingredient_id")
+            for food_id, ingredient_id in rows.iterator(chunk_size=10000):
+                if food_id not in food_ingredients:
+                    # created after the foods were read
+                    continue
+                food_ingredients[food_id].add(ingredient_id)
+                postings.setdefault(ingredient_id, array("q")).append(food_id)
+
+            with self._lock:
+                journal, self._journal = self._journal, None
+                self._food_names = food_names
+                self._ingredient_keys = ingredient_keys
+                self._ingredient_ids = {key: pk for pk, key in ingredient_keys.items()}
+                self._food_ingredients = food_ingredients
+                self._postings = postings
+                for update, args in journal:
+                    update(*args)
+                self._built_at = time.monotonic()
+
+    def build_in_background(self):
+        """
+        Starts a build on a daemon thread unless one is already starting or running
+        """
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._build_in_thread, name="food-index", daemon=True).start()
+
+    def _build_in_thread(self):
+        try:
+            self.build()
+        except Exception:
+            logger.exception("food index build failed")
+        finally:
+            self._refreshing = False
+            connections.close_all()
+
+    def _ensure_fresh(self):
+        if self._built_at is None:
+            # waits for the build started with the application, if any
+            self.build()
+        elif time.monotonic() - self._built_at > self.refresh_interval:
+            self.build_in_background()
+
+    def _record(self, update, *args):
+        # called with self._lock held
+        if self._journal is not None:
+            self._journal.append((update, args))
+
+    def set_food(self, food_id, name):
+        with self._lock:
+            self._record(self.set_food, food_id, name)
+            self._food_names[food_id] = name
+            self._food_ingredients.setdefault(food_id, set())
+
+    def remove_food(self, food_id):
+        with self._lock:
+            self._record(self.remove_food, food_id)
+            self._food_names.pop(food_id, None)
+            for ingredient_id in self._food_ingredients.pop(food_id, ()):
+                self._remove_posting(ingredient_id, food_id)
+
+    def set_ingredient(self, ingredient_id, name):
+        with self._lock:
+            self._record(self.set_ingredient, ingredient_id, name)
+            self._ingredient_ids.pop(self._ingredient_keys.get(ingredient_id), None)
+            self._ingredient_keys[ingredient_id] = name.upper()
+            self._ingredient_ids[name.upper()] = ingredient_id
+
+    def remove_ingredient(self, ingredient_id):
+        with self._lock:
+            self._record(self.remove_ingredient, ingredient_id)
+            self._ingredient_ids.pop(self._ingredient_keys.pop(ingredient_id, None), None)
+            for food_id in self._postings.pop(ingredient_id, ()):
+                self._food_ingredients.get(food_id, set()).discard(ingredient_id)
+
+    def link(self, food_id, ingredient_ids):
+        from manage_foods.models import Ingredient
+
+        # ingredients created by bulk_create send no post_save
+        unknown = [pk for pk in ingredient_ids if pk not in self._ingredient_keys]
+        for pk, name in Ingredient.objects.filter(pk__in=unknown).values_list("id", "name"):
+            self.set_ingredient(pk, name)
+        with self._lock:
+            self._record(self.link, food_id, ingredient_ids)
+            ingredients = self._food_ingredients.setdefault(food_id, set())
+            for ingredient_id in ingredient_ids:
+                if ingredient_id not in ingredients:
+                    ingredients.add(ingredient_id)
+                    insort(self._postings.setdefault(ingredient_id, array("q")), food_id)
+
+    def unlink(self, food_id, ingredient_ids=None):
+        """
+        :param food_id: int, id of the food
+        :param ingredient_ids: iterable of ingredient ids, None unlinks all ingredients of the food
+        """
+        with self._lock:
+            self._record(self.unlink, food_id, ingredient_ids)
+            ingredients = self._food_ingredients.get(food_id, set())
+            for ingredient_id in list(ingredients if ingredient_ids is None else ingredient_ids):
+                if ingredient_id in ingredients:
+                    ingredients.discard(ingredient_id)
+                    self._remove_posting(ingredient_id, food_id)
+
+    def _remove_posting(self, ingredient_id, food_id):
+        posting = self._postings.get(ingredient_id)
+        if posting is None:
+            return
+        i = bisect_left(posting, food_id)
+        if i < len(posting) and posting[i] == food_id:
+            posting.pop(i)
+
+    def match(self, ingredients, limit=5, min_coverage=1.0):
+        """
+        Ranks stored foods by the share of their ingredients found in the given ones
+
+        :param ingredients: list, names of available ingredients
+        :param limit: int, maximum number of foods returned
+        :param min_coverage: float, minimum share of the food's ingredients that must be available
+        :return: list of (food name, coverage) tuples, best first
+        """
+        self._ensure_fresh()
+        with self._lock:
+            ingredient_ids = {self._ingredient_ids.get(str(i).strip().upper()) for i in ingredients} - {None}
+            matched = Counter()
+            for ingredient_id in ingredient_ids:
+                matched.update(self._postings.get(ingredient_id, ()))
+            sizes = self._food_ingredients
+            ranked = [
+                (count / len(sizes[food_id]), count, -food_id) for food_id, count in matched.items()
+                if count >= min_coverage * len(sizes[food_id])
+            ]
+            best = heapq.nlargest(limit, ranked)
+            return [(self._food_names[-food_id], coverage) for coverage, _, food_id in best]
+
+
+_food_index = None
+_food_index_lock = threading.Lock()
+
+
+def get_food_index():
+    """
+    :return: FoodIndex shared by the process
+    """
+    global _food_index
+    with _food_index_lock:
+        if _food_index is None:
+            _food_index = FoodIndex(refresh_interval=settings.FOOD_INDEX["REFRESH_INTERVAL"])
+        return _food_index
@@ -0,0 +1,205 @@
+import hmac
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+
+# statistics of the request being served, set by main_app.middleware.MetricsMiddleware
+current_request = ContextVar("current_request", default=None)
+
+
+class RequestStats:
+    """
+    Work done while serving one request: database queries and seconds spent per span
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.spans = {}
+
+    def add_span(self, name, duration):
+        self.spans[name] = self.spans.get(name, 0.0) + duration
+
+
+class Summary:
+    """
+    Count and sum of observations and quantiles over the last max_samples of them
+    """
+
+    def __init__(self, max_samples=1024):
+        self.count = 0
+        self.sum = 0.0
+        self._samples = deque(maxlen=max_samples)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self._samples.append(value)
+
+    def quantiles(self, qs):
+        """
+        :param qs: iterable of float between 0 and 1
+        :return: dict, quantile -> value, nearest rank over the retained samples
+        """
+        samples = sorted(self._samples)
+        if not samples:
+            return {q: float("nan") for q in qs}
+        return {q: samples[min(int(q * len(samples)), len(samples) - 1)] for q in qs}
+
+
+class Registry:
+    """
+    In-process counters, gauges and summaries rendered in the Prometheus text format.
+    Every worker process has its own, with worker_label every series carries the pid of its process
+    in a "worker" label, so series of different workers are never mixed up.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, max_samples=1024, worker_label=False):
+        self.max_samples = max_samples
+        self.worker_label = worker_label
+        self._counters = {}
+        self._summaries = {}
+        self._help = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            summary = self._summaries.get(key)
+            if summary is None:
+                summary = self._summaries[key] = Summary(self.max_samples)
+            summary.observe(value)
+
+    def summary(self, name, **labels):
+        """
+        :return: dict with count, sum and the quantiles of the summary, None if nothing was observed
+        """
+        with self._lock:
+            summary = self._summaries.get((name, tuple(sorted(labels.items()))))
+            if summary is None:
+                return None
+            return {"count": summary.count, "sum": summary.sum, **summary.quantiles(self.QUANTILES)}
+
+    def clear(self):
+        with self._lock:
+            self._counters.clear()
+            self._summaries.clear()
+
+    def render(self, gauges=()):
+        """
+        :param gauges: iterable of (name, labels dict, value) read at scrape time
+        :return: str, metrics in the Prometheus text exposition format
+        """
+        lines = []
+        # read at scrape time, the registry is created before the workers are forked with --preload
+        worker = (("worker", os.getpid()),) if self.worker_label else ()
+        with self._lock:
+            counters = sorted(self._counters.items())
+            summaries = sorted((key, summary.count, summary.sum, summary.quantiles(self.QUANTILES))
+                               for key, summary in self._summaries.items())
+
+        seen = set()
+
+        def header(name, kind):
+            if name not in seen:
+                seen.add(name)
+                if name in self._help:
+                    lines.append("# HELP {} {}".format(name, self._help[name]))
+                lines.append("# TYPE {} {}".format(name, kind))
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append("{}{} {}".format(name, format_labels(labels + worker), value))
+        for (name, labels), count, total, quantiles in summaries:
+            header(name, "summary")
+            for q, value in quantiles.items():
+                lines.append("{}{} {}".format(name, format_labels(labels + worker + (("quantile", q),)), value))
+            lines.append("{}_sum{} {}".format(name, format_labels(labels + worker), total))
+            lines.append("{}_count{} {}".format(name, format_labels(labels + worker), count))
+        for name, labels, value in gauges:
+            header(name, "gauge")
+            lines.append("{}{} {}".format(name, format_labels(tuple(sorted(labels.items())) + worker), value))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    """
+    :param labels: tuple of (name, value) pairs
+    :return: str, {name="value",...} or "" without labels
+    """
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in labels
+    )
+    return "{" + ",".join('{}="{}"'.format(name, value) for name, value in escaped) + "}"
+
+
+registry = Registry(max_samples=getattr(settings, "METRICS", {}).get("MAX_SAMPLES", 1024), worker_label=True)
+registry.describe("riga_idea_span_seconds", "Duration of timed operations such as upstream calls and DB work")
+registry.describe("riga_idea_http_request_seconds", "Duration of HTTP requests per endpoint")
+registry.describe("riga_idea_http_requests_total", "HTTP requests per endpoint, method and status")
+registry.describe("riga_idea_http_request_db_queries", "Database queries per HTTP request")
+
+
+def is_metrics_token(value):
+    """
+    :param value: str or None, token sent by a client
+    :return: bool, True if it is METRICS['TOKEN'], always False without a configured token
+    """
+    token = settings.METRICS['TOKEN']
+    return bool(token and value) and hmac.compare_digest(value.encode(), token.encode())
+
+
+@contextmanager
+def span(name):
+    """
+    Times the enclosed block into riga_idea_span_seconds{span=name} and the spans of the current request
+
+        with span("openai.completion"):
+            ...
+
+    :param name: str, name of the operation, "<upstream or layer>.<operation>"
+    """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        registry.observe("riga_idea_span_seconds", duration, span=name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.add_span(name, duration)
+
+
+def count_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting the queries of the current request, installed by install_query_counter
+    """
+    stats = current_request.get()
+    if stats is not None:
+        stats.queries += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    """
+    connection_created receiver adding count_query to every database connection
+    """
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_query)
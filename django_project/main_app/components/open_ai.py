@@ -1,41 +1,389 @@
-import os
-import openai
+import asyncio
+import json
+import random
+import threading
+import time
+import weakref
+from contextlib import nullcontext
 
+import httpx
+import requests
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from requests.adapters import HTTPAdapter
 
-class Request:
+from .cache import get_cache, make_key, canonical_ingredients
+from .circuit_breaker import get_circuit_breaker
+from .metrics import span
+from .rate_limit import get_rate_limiter
 
-    def __send(self, prompt):
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class BaseClient:
+    """
+    Configuration and retry policy shared by the sync and async OpenAI clients
+    """
+
+    def __init__(self, api_key, api_base, connect_timeout=3.05, read_timeout=30, pool_size=20,
+                 max_concurrency=20, max_retries=3, backoff_base=0.5, backoff_max=8, rate_limiter=None,
+                 circuit_breaker=None):
+        self.api_key = api_key
+        self.api_base = api_base.rstrip("/")
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = rate_limiter
+        self.circuit_breaker = circuit_breaker
+
+    @property
+    def headers(self):
+        return {"Authorization": "Bearer {}".format(self.api_key)}
+
+    def guard(self):
         """
-        :param prompt: sentence
-        :return: response from openai
+        :return: context manager of one call including its retries, see CircuitBreaker.guard
+        """
+        return self.circuit_breaker.guard() if self.circuit_breaker else nullcontext()
+
+    def backoff(self, attempt, response=None):
+        """
+        :param attempt: int, number of the failed attempt starting from 0
+        :param response: failed response, its Retry-After header wins when present
+        :return: float, seconds to wait before the next attempt
+        """
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+
+class Client(BaseClient):
+    """
+    Process-wide OpenAI HTTP client: one keep-alive connection pool shared by all threads,
+    bounded number of concurrent calls and retry with jittered exponential backoff on 429/5xx
+    """
+
+    def __init__(self, api_key, api_base, **options):
+        super().__init__(api_key, api_base, **options)
+        self._semaphore = threading.BoundedSemaphore(self.max_concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, path, payload, stream=False):
+        """
+        :param path: str, API path such as "/completions"
+        :param payload: dict, JSON body
+        :param stream: bool, leave the body unread for streaming
+        :return: successful requests.Response
+        :raises: requests.RequestException when the retries are exhausted, RateLimited when no token is available,
+                 CircuitOpen when OpenAI keeps failing
+        """
+        with self.guard():
+            return self._post(path, payload, stream)
+
+    def _post(self, path, payload, stream):
+        for attempt in range(self.max_retries + 1):
+            response = None
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            with self._semaphore:
+                try:
+                    response = self.session.post(self.api_base + path, json=payload, headers=self.headers,
+                                                 timeout=(self.connect_timeout, self.read_timeout), stream=stream)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                        response.raise_for_status()
+                        return response
+                    response.close()
+            time.sleep(self.backoff(attempt, response))
+
+    def completion(self, prompt, **params):
         """
-        openai.api_key = os.getenv("OPENAI_API_KEY")
-        response = openai.Completion.create(
-            model="text-davinci-003",
-            prompt=prompt,
+        :param prompt: str, prompt of the completion
+        :param params: model parameters
+        :return: str, text of the first choice
+        """
+        response = self.post("/completions", {"prompt": prompt, **params})
+        return response.json().get("choices")[0].get("text")
+
+    def stream_completion(self, prompt, **params):
+        """
+        :param prompt: str, prompt of the completion
+        :param params: model parameters
+        :return: generator of str, text of the first choice as it is generated
+        """
+        response = self.post("/completions", {"prompt": prompt, **params, "stream": True}, stream=True)
+        try:
+            for line in response.iter_lines():
+                # server-sent events: "data: {...}" lines ended by "data: [DONE]"
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[len(b"data:"):].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data).get("choices")[0].get("text")
+        finally:
+            response.close()
+
+
+class AsyncClient(BaseClient):
+    """
+    asyncio counterpart of Client for the async views, bound to the event loop it was created in
+    """
+
+    def __init__(self, api_key, api_base, **options):
+        super().__init__(api_key, api_base, **options)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.session = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size),
+            timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+        )
+
+    async def post(self, path, payload):
+        """
+        :param path: str, API path such as "/completions"
+        :param payload: dict, JSON body
+        :return: successful httpx.Response
+        :raises: httpx.HTTPError when the retries are exhausted, RateLimited when no token is available,
+                 CircuitOpen when OpenAI keeps failing
+        """
+        with self.guard():
+            return await self._post(path, payload)
+
+    async def _post(self, path, payload):
+        for attempt in range(self.max_retries + 1):
+            response = None
+            if self.rate_limiter:
+                await self.rate_limiter.aacquire()
+            async with self._semaphore:
+                try:
+                    response = await self.session.post(self.api_base + path, json=payload, headers=self.headers)
+                except (httpx.TransportError, httpx.TimeoutException):
+                    if attempt == self.max_retries:
+                        raise
+                else:
+                    if response.status_code not in RETRY_STATUSES or attempt == self.max_retries:
+                        response.raise_for_status()
+                        return response
+            await asyncio.sleep(self.backoff(attempt, response))
+
+    async def completion(self, prompt, **params):
+        """
+        :param prompt: str, prompt of the completion
+        :param params: model parameters
+        :return: str, text of the first choice
+        """
+        response = await self.post("/completions", {"prompt": prompt, **params})
+        return response.json().get("choices")[0].get("text")
+
+
+def _client_options():
+    config = settings.OPENAI
+    return {
+        "api_key": config["API_KEY"],
+        "api_base": config["API_BASE"],
+        "connect_timeout": config["CONNECT_TIMEOUT"],
+        "read_timeout": config["READ_TIMEOUT"],
+        "pool_size": config["POOL_SIZE"],
+        "max_concurrency": config["MAX_CONCURRENCY"],
+        "max_retries": config["MAX_RETRIES"],
+        "backoff_base": config["BACKOFF_BASE"],
+        "backoff_max": config["BACKOFF_MAX"],
+        "rate_limiter": get_rate_limiter("openai"),
+        "circuit_breaker": get_circuit_breaker("openai"),
+    }
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """
+    :return: Client configured by settings.OPENAI, shared by the process
+    """
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = Client(**_client_options())
+        return _client
+
+
+_async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_client():
+    """
+    :return: AsyncClient configured by settings.OPENAI, shared by the running event loop
+    """
+    loop = asyncio.get_running_loop()
+    client = _async_clients.get(loop)
+    if client is None:
+        client = _async_clients[loop] = AsyncClient(**_client_options())
+    return client
+
+
+def _reset_client(setting, **kwargs):
+    global _client
+    if setting in ("OPENAI", "RATE_LIMITS", "CIRCUIT_BREAKERS"):
+        with _client_lock:
+            _client = None
+            _async_clients.clear()
+
+
+setting_changed.connect(_reset_client)
+
+
+def normalize_food(food):
+    """
+    :param food: str, food name as typed by the user
+    :return: str, lower case food name with single spaces
+    """
+    return " ".join(str(food).split()).lower()
+
+
+def normalize_ingredients(ingredients):
+    """
+    :param ingredients: list of ingredients or str of comma separated ingredients
+    :return: str, sorted unique lower case ingredients separated by commas
+    """
+    if isinstance(ingredients, str):
+        ingredients = ingredients.split(",")
+    return ", ".join(canonical_ingredients(ingredients))
+
+
+class Request:
+    """
+    Completions are cached in the "completions" result cache by normalized prompt and model parameters,
+    so only prompts that were never answered are paid for
+    """
+
+    def __params(self):
+        return dict(
+            model=settings.OPENAI["MODEL"],
             temperature=0.6,
             max_tokens=150,
             top_p=1,
             frequency_penalty=1,
             presence_penalty=1
         )
-        return response.get("choices")[0].get("text")
 
-    def get_list_food(self, prompt):
+    def __cache_key(self, prompt):
+        return make_key("completion", prompt, self.__params())
+
+    def __send(self, prompt):
+        """
+        :param prompt: sentence
+        :return: response from openai
         """
+        cache = get_cache("completions")
+        key = self.__cache_key(prompt)
+        text = cache.get(key)
+        if text is None:
+            with span("openai.completion"):
+                text = get_client().completion(prompt, **self.__params())
+            if text:
+                cache.set(key, text)
+        return text
 
+    async def __asend(self, prompt):
+        """
+        :param prompt: sentence
+        :return: response from openai, without blocking the event loop
+        """
+        cache = get_cache("completions")
+        key = self.__cache_key(prompt)
+        text = await sync_to_async(cache.get)(key)
+        if text is None:
+            with span("openai.completion"):
+                text = await get_async_client().completion(prompt, **self.__params())
+            if text:
+                await sync_to_async(cache.set)(key, text)
+        return text
+
+    def __stream(self, prompt):
+        """
         :param prompt: sentence
+        :return: generator of parts of the response from openai, a cached response comes as one part
+        """
+        cache = get_cache("completions")
+        key = self.__cache_key(prompt)
+        text = cache.get(key)
+        if text is not None:
+            yield text
+            return
+        parts = []
+        with span("openai.stream"):
+            for part in get_client().stream_completion(prompt, **self.__params()):
+                parts.append(part)
+                yield part
+        if parts:
+            cache.set(key, "".join(parts))
+
+    def list_food_prompt(self, ingredients):
+        return "What kind of foods I can make based on the only these ingredients : {} .Give maximum 5 foods".format(
+            normalize_ingredients(ingredients))
+
+    def recipe_prompt(self, food, ingredients):
+        return "List steps of {} to make using only and only :{}".format(
+            normalize_food(food), normalize_ingredients(ingredients))
+
+    def get_list_food(self, ingredients):
+        """
+
+        :param ingredients: list of ingredients or str of comma separated ingredients
         :return:
         """
-        prompt = "What kind of foods I can make based on the only these ingredients : {} .Give maximum 5 foods".format(
-            prompt)
-        return self.__send(prompt)
+        return self.__send(self.list_food_prompt(ingredients))
+
+    async def aget_list_food(self, ingredients):
+        return await self.__asend(self.list_food_prompt(ingredients))
 
     def get_recipe(self, food, ingredients):
         """
-        :param prompt: str sentence
-        :param ingredients: str  ingretients
+        :param food: str, name of food
+        :param ingredients: list of ingredients or str of comma separated ingredients
         :return:
         """
-        prompt = "List steps of {} to make using only and only :{}".format(food, ingredients)
-        return self.__send(prompt)
+        return self.__send(self.recipe_prompt(food, ingredients))
+
+    async def aget_recipe(self, food, ingredients):
+        return await self.__asend(self.recipe_prompt(food, ingredients))
+
+    def stream_recipe(self, food, ingredients):
+        """
+        :param food: str, name of food
+        :param ingredients: list of ingredients or str of comma separated ingredients
+        :return: generator of str, parts of the recipe as OpenAI generates them
+        """
+        return self.__stream(self.recipe_prompt(food, ingredients))
+
+    def store_recipe(self, food, ingredients, recipe):
+        """
+        Caches a known recipe as the completion of its prompt
+
+        :param food: str, name of food
+        :param ingredients: list of ingredients or str of comma separated ingredients
+        :param recipe: str, recipe text
+        :return: bool, False if the prompt was already cached
+        """
+        cache = get_cache("completions")
+        key = self.__cache_key(self.recipe_prompt(food, ingredients))
+        if cache.get(key) is not None:
+            return False
+        cache.set(key, recipe)
+        return True
@@ -0,0 +1,142 @@
+import collections
+import os
+import threading
+import time
+
+from django.db import OperationalError
+from django.db.backends.postgresql import base
+from django.utils.asyncio import async_unsafe
+from psycopg2 import extensions
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool:
+    """
+    Bounded pool of open connections shared by the threads of a process. At most max_size connections exist at
+    once, a thread waits up to timeout seconds for one to be returned. Idle connections are reused latest first,
+    connections older than max_lifetime seconds or failing the health check are closed instead.
+    """
+
+    def __init__(self, max_size=10, timeout=5, max_lifetime=1800, health_checks=True):
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_lifetime = max_lifetime
+        self.health_checks = health_checks
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._idle = collections.deque()
+        self._created = {}
+
+    def getconn(self, connect):
+        """
+        :param connect: callable opening a new connection when no idle one is usable
+        :return: a connection, to be given back with putconn
+        :raises OperationalError: if no connection was returned within timeout seconds
+        """
+        if not self._slots.acquire(timeout=self.timeout):
+            raise OperationalError(
+                "no database connection available within {}s, all {} are in use".format(self.timeout, self.max_size)
+            )
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    connection = connect()
+                    self._created[connection] = time.monotonic()
+                    return connection
+                if self.is_usable(connection):
+                    return connection
+                self._discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        """
+        :param connection: a connection of getconn, an open transaction is rolled back before it is reused
+        """
+        try:
+            if not connection.closed and connection.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    connection.rollback()
+                except Exception:
+                    self._discard(connection)
+                    return
+            if connection.closed or self.expired(connection):
+                self._discard(connection)
+                return
+            with self._lock:
+                self._idle.append(connection)
+        finally:
+            self._slots.release()
+
+    def expired(self, connection):
+        return time.monotonic() - self._created.get(connection, 0) > self.max_lifetime
+
+    def is_usable(self, connection):
+        if connection.closed or self.expired(connection):
+            return False
+        if not self.health_checks:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except Exception:
+            return False
+        return True
+
+    def close(self):
+        """
+        Closes the idle connections, the ones in use are closed when they are returned
+        """
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for connection in idle:
+            self._discard(connection)
+
+    def _discard(self, connection):
+        self._created.pop(connection, None)
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+
+def get_pool(alias, settings_dict):
+    """
+    :param alias: alias of the database
+    :param settings_dict: settings of the database, POOL holds the arguments of ConnectionPool
+    :return: ConnectionPool of the database in this process, forked workers never share connections
+    """
+    key = (alias, os.getpid())
+    with _pools_lock:
+        if key not in _pools:
+            options = {key.lower(): value for key, value in settings_dict.get("POOL", {}).items()}
+            options.setdefault("health_checks", settings_dict["CONN_HEALTH_CHECKS"])
+            _pools[key] = ConnectionPool(**options)
+        return _pools[key]
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """
+    PostgreSQL backend taking its connections from a ConnectionPool: closing a connection, at the end of every
+    request with CONN_MAX_AGE 0, gives it back to the pool instead of closing the socket
+    """
+
+    @property
+    def pool(self):
+        return get_pool(self.alias, self.settings_dict)
+
+    @async_unsafe
+    def get_new_connection(self, conn_params):
+        connection = self.pool.getconn(lambda: super(DatabaseWrapper, self).get_new_connection(conn_params))
+        self.isolation_level = self.settings_dict["OPTIONS"].get("isolation_level", connection.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                self.pool.putconn(self.connection)
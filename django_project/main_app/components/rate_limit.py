@@ -0,0 +1,249 @@
+import asyncio
+import fcntl
+import json
+import os
+import tempfile
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import IntegrityError, transaction
+from django.utils.module_loading import import_string
+
+
+class RateLimited(Exception):
+    """
+    Raised when a call cannot get a token of the upstream's bucket in time
+    """
+
+
+class BaseBucket:
+    """
+    Token bucket refilled with rate tokens per second up to burst tokens.
+    Tokens are reserved ahead: a negative level is the queue of callers sleeping until their token is due,
+    so the upstream sees a steady rate instead of bursts of retries.
+    """
+
+    def __init__(self, name, rate, burst, **options):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+
+    def _update(self, func):
+        """
+        Atomically replaces the state (tokens, updated_at) of the bucket, None when it was never used
+
+        :param func: callable receiving the state and returning (new state, result)
+        :return: result of func
+        """
+        raise NotImplementedError
+
+    def reserve(self, max_wait):
+        """
+        :param max_wait: float, longest acceptable wait in seconds
+        :return: float, seconds to wait for the reserved token, None if it would take longer than max_wait
+        """
+        now = time.time()
+
+        def take(state):
+            tokens, updated_at = state or (self.burst, now)
+            tokens = min(self.burst, tokens + max(now - updated_at, 0) * self.rate)
+            wait = max(1 - tokens, 0) / self.rate
+            if wait > max_wait:
+                return (tokens, now), None
+            return (tokens - 1, now), wait
+
+        return self._update(take)
+
+
+class LocalBucket(BaseBucket):
+    """
+    Bucket of one process
+    """
+
+    def __init__(self, name, rate, burst, **options):
+        super().__init__(name, rate, burst, **options)
+        self._state = None
+        self._lock = threading.Lock()
+
+    def _update(self, func):
+        with self._lock:
+            self._state, result = func(self._state)
+            return result
+
+
+class FileBucket(BaseBucket):
+    """
+    Bucket stored in a local file under an exclusive lock, shared by the workers of one host
+    """
+
+    def __init__(self, name, rate, burst, location=None, **options):
+        super().__init__(name, rate, burst, **options)
+        location = location or os.path.join(tempfile.gettempdir(), "riga_idea_rate_limit")
+        os.makedirs(location, exist_ok=True)
+        self.path = os.path.join(location, name)
+
+    def _update(self, func):
+        with open(self.path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                try:
+                    state = tuple(json.load(f))
+                except ValueError:
+                    state = None
+                state, result = func(state)
+                f.seek(0)
+                f.truncate()
+                json.dump(state, f)
+                return result
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class DatabaseBucket(BaseBucket):
+    """
+    Bucket stored in a main_app.RateBucket row locked with SELECT ... FOR UPDATE, shared by all workers
+    """
+
+    def _update(self, func):
+        from main_app.models import RateBucket
+
+        for attempt in range(2):
+            try:
+                with transaction.atomic():
+                    bucket = RateBucket.objects.select_for_update().filter(name=self.name).first()
+                    state = (bucket.tokens, bucket.updated_at) if bucket else None
+                    (tokens, updated_at), result = func(state)
+                    if bucket:
+                        RateBucket.objects.filter(pk=bucket.pk).update(tokens=tokens, updated_at=updated_at)
+                    else:
+                        RateBucket.objects.create(name=self.name, tokens=tokens, updated_at=updated_at)
+                    return result
+            except IntegrityError:
+                # row created by another worker, lock it on the next attempt
+                if attempt:
+                    raise
+
+
+class RateLimiter:
+    """
+    Waits for a token of the bucket before each upstream call. At most max_queue callers of the process wait,
+    calls that would wait longer than max_wait fail at once with RateLimited.
+    """
+
+    def __init__(self, bucket, max_wait=5, max_queue=100):
+        self.bucket = bucket
+        self.max_wait = max_wait
+        self.max_queue = max_queue
+        self._waiting = 0
+        self._lock = threading.Lock()
+        self._counters = {"acquired": 0, "rejected": 0}
+        self._waited = 0.0
+
+    def _enter(self):
+        with self._lock:
+            if self._waiting >= self.max_queue:
+                self._counters["rejected"] += 1
+                raise RateLimited("{} wait queue is full".format(self.bucket.name))
+            self._waiting += 1
+
+    def _granted(self, wait):
+        with self._lock:
+            if wait is None:
+                self._counters["rejected"] += 1
+            else:
+                self._counters["acquired"] += 1
+                self._waited += wait
+        if wait is None:
+            raise RateLimited("{} rate limit exceeded".format(self.bucket.name))
+
+    def _leave(self):
+        with self._lock:
+            self._waiting -= 1
+
+    def _max_wait(self, deadline):
+        if deadline is None:
+            return self.max_wait
+        return min(self.max_wait, deadline - time.monotonic())
+
+    def acquire(self, deadline=None):
+        """
+        :param deadline: float, time.monotonic() after which the call is useless anyway
+        :raises: RateLimited when no token is available in time
+        """
+        self._enter()
+        try:
+            wait = self.bucket.reserve(self._max_wait(deadline))
+            self._granted(wait)
+            if wait:
+                time.sleep(wait)
+        finally:
+            self._leave()
+
+    async def aacquire(self, deadline=None):
+        """
+        Same as acquire() without blocking the event loop
+        """
+        self._enter()
+        try:
+            wait = await sync_to_async(self.bucket.reserve)(self._max_wait(deadline))
+            self._granted(wait)
+            if wait:
+                await asyncio.sleep(wait)
+        finally:
+            self._leave()
+
+    def stats(self):
+        """
+        :return: dict, waiting callers, acquired and rejected calls and total seconds waited
+        """
+        with self._lock:
+            return {"waiting": self._waiting, **self._counters, "waited": self._waited}
+
+
+DEFAULT_RATE_LIMIT = {
+    "BACKEND": "main_app.components.rate_limit.LocalBucket",
+    "RATE": 1,
+    "BURST": 1,
+    "MAX_WAIT": 5,
+    "MAX_QUEUE": 100,
+    "OPTIONS": {},
+}
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_rate_limiter(alias):
+    """
+    :param alias: str, name of the upstream in settings.RATE_LIMITS
+    :return: RateLimiter shared by the process, None if the upstream is not limited
+    """
+    limits = getattr(settings, "RATE_LIMITS", {})
+    if alias not in limits:
+        return None
+    with _limiters_lock:
+        if alias not in _limiters:
+            config = {**DEFAULT_RATE_LIMIT, **limits[alias]}
+            bucket = import_string(config["BACKEND"])(alias, config["RATE"], config["BURST"], **config["OPTIONS"])
+            _limiters[alias] = RateLimiter(bucket, max_wait=config["MAX_WAIT"], max_queue=config["MAX_QUEUE"])
+        return _limiters[alias]
+
+
+def all_rate_limiters():
+    """
+    :return: dict, alias to RateLimiter of every limiter created by the process
+    """
+    return dict(_limiters)
+
+
+def _reset_rate_limiters(setting, **kwargs):
+    if setting == "RATE_LIMITS":
+        with _limiters_lock:
+            _limiters.clear()
+
+
+setting_changed.connect(_reset_rate_limiters)
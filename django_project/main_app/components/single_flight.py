@@ -0,0 +1,262 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger('django')
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class LocalFlight:
+    """
+    Deduplicates concurrent calls with the same key inside one process:
+    the first caller runs the function, the others wait for its result
+    """
+
+    def __init__(self, wait_timeout=30):
+        self.wait_timeout = wait_timeout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """
+        :param key: str, key of the call
+        :param func: callable without arguments producing the result
+        :return: result of func, computed once for all concurrent callers
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            if call.event.wait(self.wait_timeout):
+                if call.error is not None:
+                    raise call.error
+                return call.result
+            logger.warning("single flight wait timed out for %s", key)
+            return func()
+
+        try:
+            call.result = func()
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+
+class DatabaseFlight:
+    """
+    Deduplicates calls with the same key across workers using a unique main_app.FlightLease row:
+    the worker that inserts the row runs the function and stores its result in the row,
+    the others poll the row until the result appears
+    """
+
+    def __init__(self, wait_timeout=30, lease_timeout=60, result_ttl=30, poll_interval=0.1):
+        self.wait_timeout = wait_timeout
+        self.lease_timeout = lease_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+
+    def _purge(self):
+        from main_app.models import FlightLease
+
+        now = timezone.now()
+        FlightLease.objects.filter(
+            Q(completed_at__lt=now - timedelta(seconds=self.result_ttl)) |
+            Q(completed_at__isnull=True, created_at__lt=now - timedelta(seconds=self.lease_timeout))
+        ).delete()
+
+    def _try_acquire(self, key):
+        """
+        :return: (True, None) if the lease was taken, (False, lease or None if it just disappeared) otherwise
+        """
+        from main_app.models import FlightLease
+
+        try:
+            with transaction.atomic():
+                FlightLease.objects.create(key=key)
+            return True, None
+        except IntegrityError:
+            return False, FlightLease.objects.filter(key=key).first()
+
+    def _release(self, key, result):
+        from main_app.models import FlightLease
+
+        if result is None:
+            # nothing worth sharing, let the waiting workers try themselves
+            FlightLease.objects.filter(key=key).delete()
+        else:
+            FlightLease.objects.filter(key=key).update(result=json.dumps(result), completed_at=timezone.now())
+
+    def do(self, key, func):
+        """
+        :param key: str, key of the call
+        :param func: callable without arguments producing a json serializable result
+        :return: result of func, computed once for all workers asking in the same time
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        self._purge()
+        while True:
+            acquired, lease = self._try_acquire(key)
+            if acquired:
+                break
+            if lease is None:
+                continue
+            if lease.completed_at is not None:
+                return json.loads(lease.result)
+            if time.monotonic() > deadline:
+                logger.warning("single flight wait timed out for %s", key)
+                return func()
+            time.sleep(self.poll_interval)
+
+        result = None
+        try:
+            result = func()
+            return result
+        finally:
+            self._release(key, result)
+
+    async def ado(self, key, func):
+        """
+        Same as do() for the async views, waits without blocking the event loop
+
+        :param key: str, key of the call
+        :param func: coroutine function without arguments producing a json serializable result
+        :return: result of func, computed once for all workers asking in the same time
+        """
+        deadline = time.monotonic() + self.wait_timeout
+        await sync_to_async(self._purge)()
+        while True:
+            acquired, lease = await sync_to_async(self._try_acquire)(key)
+            if acquired:
+                break
+            if lease is None:
+                continue
+            if lease.completed_at is not None:
+                return json.loads(lease.result)
+            if time.monotonic() > deadline:
+                logger.warning("single flight wait timed out for %s", key)
+                return await func()
+            await asyncio.sleep(self.poll_interval)
+
+        result = None
+        try:
+            result = await func()
+            return result
+        finally:
+            await sync_to_async(self._release)(key, result)
+
+
+class AsyncLocalFlight:
+    """
+    LocalFlight for coroutines running in one event loop
+    """
+
+    def __init__(self):
+        self._calls = {}
+
+    async def do(self, key, func):
+        """
+        :param key: str, key of the call
+        :param func: coroutine function without arguments producing the result
+        :return: result of func, computed once for all concurrent callers
+        """
+        future = self._calls.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = self._calls[key] = asyncio.get_running_loop().create_future()
+        try:
+            result = await func()
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, so no warning when nobody waits
+            raise
+        finally:
+            del self._calls[key]
+
+
+class SingleFlight:
+    """
+    Per-process deduplication in front of the optional cross-worker one,
+    so only one thread of a worker waits on the database lease
+    """
+
+    def __init__(self, local, shared=None):
+        self.local = local
+        self.shared = shared
+
+    def do(self, key, func):
+        if self.shared is None:
+            return self.local.do(key, func)
+        return self.local.do(key, lambda: self.shared.do(key, func))
+
+
+class AsyncSingleFlight(SingleFlight):
+
+    async def do(self, key, func):
+        if self.shared is None:
+            return await self.local.do(key, func)
+        return await self.local.do(key, lambda: self.shared.ado(key, func))
+
+
+_single_flight = None
+_async_single_flight = None
+_single_flight_lock = threading.Lock()
+
+
+def _shared_flight():
+    config = getattr(settings, "SINGLE_FLIGHT", {})
+    if config.get("BACKEND", "database") != "database":
+        return None
+    return DatabaseFlight(
+        wait_timeout=config.get("WAIT_TIMEOUT", 30),
+        lease_timeout=config.get("LEASE_TIMEOUT", 60),
+        result_ttl=config.get("RESULT_TTL", 30),
+        poll_interval=config.get("POLL_INTERVAL", 0.1),
+    )
+
+
+def get_single_flight():
+    """
+    :return: SingleFlight configured by settings.SINGLE_FLIGHT, shared by the process
+    """
+    global _single_flight
+    with _single_flight_lock:
+        if _single_flight is None:
+            wait_timeout = getattr(settings, "SINGLE_FLIGHT", {}).get("WAIT_TIMEOUT", 30)
+            _single_flight = SingleFlight(LocalFlight(wait_timeout=wait_timeout), _shared_flight())
+        return _single_flight
+
+
+def get_async_single_flight():
+    """
+    :return: AsyncSingleFlight configured by settings.SINGLE_FLIGHT, for the async views
+    """
+    global _async_single_flight
+    with _single_flight_lock:
+        if _async_single_flight is None:
+            _async_single_flight = AsyncSingleFlight(AsyncLocalFlight(), _shared_flight())
+        return _async_single_flight
@@ -0,0 +1,145 @@
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db import close_old_connections
+
+logger = logging.getLogger('django')
+
+
+class _Job:
+    def __init__(self, func, args):
+        self.func = func
+        self.args = args
+        self.enqueued_at = time.monotonic()
+
+
+class WriteQueue:
+    """
+    Bounded in-process queue of database writes executed by background worker threads after the response is sent.
+    When the queue stays full for put_timeout seconds the write runs on the caller thread (backpressure),
+    with workers=0 every write runs on the caller thread.
+    """
+
+    def __init__(self, workers=2, max_size=1000, put_timeout=0.1, max_retries=3, retry_delay=0.5):
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self._queue = queue.Queue(maxsize=max_size)
+        self._threads = []
+        self._lock = threading.Lock()
+        self._counters = {"enqueued": 0, "processed": 0, "failed": 0, "retried": 0, "overflow": 0}
+        self._last_lag = 0.0
+        self._max_lag = 0.0
+
+    def _count(self, name, lag=None):
+        with self._lock:
+            self._counters[name] += 1
+            if lag is not None:
+                self._last_lag = lag
+                self._max_lag = max(self._max_lag, lag)
+
+    def _start(self):
+        with self._lock:
+            # started lazily so gunicorn workers get their own threads after fork
+            while len(self._threads) < self.workers:
+                t = threading.Thread(target=self._work, name="write-queue-{}".format(len(self._threads)), daemon=True)
+                t.start()
+                self._threads.append(t)
+
+    def submit(self, func, *args):
+        """
+        :param func: callable doing the write, raises to be retried
+        :param args: arguments of func
+        """
+        job = _Job(func, args)
+        if not self.workers:
+            self._run(job)
+            return
+        self._start()
+        try:
+            self._queue.put(job, timeout=self.put_timeout)
+            self._count("enqueued")
+        except queue.Full:
+            logger.warning("write queue is full, writing on the request thread")
+            self._count("overflow")
+            self._run(job)
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            try:
+                close_old_connections()
+                self._run(job)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+    def _run(self, job):
+        for attempt in range(self.max_retries + 1):
+            try:
+                job.func(*job.args)
+                self._count("processed", lag=time.monotonic() - job.enqueued_at)
+                return
+            except BaseException:
+                if attempt == self.max_retries:
+                    logger.exception("write %s failed after %s attempts", job.func.__name__, attempt + 1)
+                    self._count("failed")
+                    return
+                self._count("retried")
+                close_old_connections()
+                time.sleep(self.retry_delay * 2 ** attempt)
+
+    def join(self):
+        """
+        Blocks until every queued write is done
+        """
+        self._queue.join()
+
+    def stats(self):
+        """
+        :return: dict, queue depth, counters and lag in seconds between submit and completion
+        """
+        with self._lock:
+            return {
+                "depth": self._queue.qsize(),
+                **self._counters,
+                "last_lag": self._last_lag,
+                "max_lag": self._max_lag,
+            }
+
+
+_write_queue = None
+_write_queue_lock = threading.Lock()
+
+
+def get_write_queue():
+    """
+    :return: WriteQueue configured by settings.FOOD_WRITE_QUEUE, shared by the process
+    """
+    global _write_queue
+    with _write_queue_lock:
+        if _write_queue is None:
+            config = getattr(settings, "FOOD_WRITE_QUEUE", {})
+            _write_queue = WriteQueue(
+                workers=config.get("WORKERS", 2),
+                max_size=config.get("MAX_SIZE", 1000),
+                put_timeout=config.get("PUT_TIMEOUT", 0.1),
+                max_retries=config.get("MAX_RETRIES", 3),
+                retry_delay=config.get("RETRY_DELAY", 0.5),
+            )
+        return _write_queue
+
+
+def _reset_write_queue(setting, **kwargs):
+    global _write_queue
+    if setting == "FOOD_WRITE_QUEUE":
+        with _write_queue_lock:
+            _write_queue = None
+
+
+setting_changed.connect(_reset_write_queue)
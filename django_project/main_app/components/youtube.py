@@ -0,0 +1,45 @@
+from contextlib import nullcontext
+
+from youtubesearchpython import VideosSearch
+from youtubesearchpython.__future__ import VideosSearch as AsyncVideosSearch
+
+from .circuit_breaker import get_circuit_breaker
+from .metrics import span
+from .rate_limit import get_rate_limiter
+
+
+def guard():
+    """
+    :return: context manager of one YouTube search, see CircuitBreaker.guard
+    """
+    circuit_breaker = get_circuit_breaker("youtube")
+    return circuit_breaker.guard() if circuit_breaker else nullcontext()
+
+
+def search_video_link(query):
+    """
+    :param query: str, text to search on YouTube
+    :return: str, link of the first video found
+    :raises: RateLimited when no token of the YouTube bucket is available in time,
+             CircuitOpen when YouTube keeps failing
+    """
+    with span("youtube.search"), guard():
+        rate_limiter = get_rate_limiter("youtube")
+        if rate_limiter:
+            rate_limiter.acquire()
+        return VideosSearch(query, limit=1).result().get("result")[0].get("link")
+
+
+async def asearch_video_link(query):
+    """
+    :param query: str, text to search on YouTube
+    :return: str, link of the first video found, without blocking the event loop
+    :raises: RateLimited when no token of the YouTube bucket is available in time,
+             CircuitOpen when YouTube keeps failing
+    """
+    with span("youtube.search"), guard():
+        rate_limiter = get_rate_limiter("youtube")
+        if rate_limiter:
+            await rate_limiter.aacquire()
+        result = await AsyncVideosSearch(query, limit=1).next()
+        return result.get("result")[0].get("link")
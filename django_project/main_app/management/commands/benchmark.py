@@ -0,0 +1,184 @@
+import json
+import platform
+import random
+import subprocess
+import uuid
+from unittest import mock
+
+import django
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from main_app import benchmark
+from main_app.components.cache import get_cache
+from main_app.throttling import ExternalRateThrottle
+from manage_foods.models import Food, Ingredient
+
+SCENARIOS = ("list", "detail", "foods")
+MISS_PREFIX = "bench miss "
+
+
+class Command(BaseCommand):
+    help = "Runs the whole Django stack against stub OpenAI and YouTube servers and reports throughput, " \
+           "latency percentiles and database queries per endpoint. Use a catalog created by seed_catalog " \
+           "and the same options to compare commits."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                            help="comma separated scenarios: list (api/external/list), "
+                                 "detail (api/external/detail), foods (api/foods/list)")
+        parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+        parser.add_argument("--concurrency", type=int, default=8, help="requests in flight at the same time")
+        parser.add_argument("--seed", type=int, default=42, help="seed of the request mix and the stub latencies")
+        parser.add_argument("--miss-ratio", type=float, default=0.2,
+                            help="share of detail requests asking for a food that is not stored")
+        parser.add_argument("--page-size", type=int, default=50, help="page size of the foods scenario")
+        parser.add_argument("--openai-latency", type=float, default=0.5, help="seconds per completion")
+        parser.add_argument("--openai-jitter", type=float, default=0.2, help="extra random seconds per completion")
+        parser.add_argument("--openai-error-rate", type=float, default=0.0, help="share of failing completions")
+        parser.add_argument("--token-delay", type=float, default=0.01, help="seconds between streamed tokens")
+        parser.add_argument("--youtube-latency", type=float, default=0.3, help="seconds per video search")
+        parser.add_argument("--youtube-jitter", type=float, default=0.1, help="extra random seconds per search")
+        parser.add_argument("--youtube-error-rate", type=float, default=0.0, help="share of failing searches")
+        parser.add_argument("--keep-limits", action="store_true",
+                            help="keep the user quota and the upstream rate limits, they are off by default "
+                                 "so the benchmark measures the stack instead of the limits")
+        parser.add_argument("--keep-caches", action="store_true",
+                            help="keep the cached completions and food lists of earlier runs")
+        parser.add_argument("--output", help="write the results as JSON to this file")
+        parser.add_argument("--compare", help="print the changes against the JSON results of an earlier run")
+
+    def commit(self):
+        try:
+            return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                  cwd=settings.BASE_DIR, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def token(self):
+        user, created = get_user_model().objects.get_or_create(email="benchmark@example.com")
+        if created:
+            user.set_unusable_password()
+            user.save()
+        return str(AccessToken.for_user(user))
+
+    def senders(self, options):
+        """
+        :return: dict, scenario -> callable (requests.Session, request number) sending one request
+        """
+        rng = random.Random(options["seed"])
+        ingredients = list(Ingredient.objects.order_by("id").values_list("name", flat=True)[:1000])
+        foods = list(Food.objects.order_by("id").values_list("name", flat=True)[:1000])
+        if not ingredients:
+            raise CommandError("the catalog is empty, create one with seed_catalog")
+        total = options["requests"]
+
+        # the request mix is drawn up front so every run with the same seed sends the same requests,
+        # misses get new names in every run because the foods generated by a run are stored
+        picks = [rng.sample(ingredients, min(len(ingredients), rng.randint(2, 5))) for _ in range(total)]
+        names = [
+            MISS_PREFIX + uuid.uuid4().hex[:12]
+            if not foods or rng.random() < options["miss_ratio"] else rng.choice(foods)
+            for _ in range(total)
+        ]
+        page_size = options["page_size"]
+
+        def send_list(session, i):
+            return session.post(self.url + "/api/external/list", json={"ingredients": picks[i]},
+                                headers=self.headers, timeout=120)
+
+        def send_detail(session, i):
+            return session.post(self.url + "/api/external/detail", json={"name": names[i], "ingredients": picks[i]},
+                                headers=self.headers, timeout=120)
+
+        def send_foods(session, i):
+            return session.get(self.url + "/api/foods/list", params={"page_size": page_size},
+                               headers=self.headers, timeout=120)
+
+        return {"list": send_list, "detail": send_detail, "foods": send_foods}
+
+    def print_results(self, results):
+        self.stdout.write("{:<8} {:>9} {:>9} {:>9} {:>9} {:>7} {:>8}".format(
+            "scenario", "req/s", "p50 ms", "p95 ms", "p99 ms", "errors", "queries"))
+        for name, result in results["scenarios"].items():
+            latency = result["latency_ms"]
+            self.stdout.write("{:<8} {:>9} {:>9} {:>9} {:>9} {:>7.1%} {:>8}".format(
+                name, result["throughput"], latency["p50"], latency["p95"], latency["p99"],
+                result["error_rate"], result["queries_per_request"]))
+
+    def print_comparison(self, base, results):
+        self.stdout.write("\nagainst {}:".format(base.get("meta", {}).get("commit")))
+        for name, metric, old, new, change in benchmark.compare(base, results):
+            self.stdout.write("{:<8} {:<10} {:>10} -> {:<10} {}".format(
+                name, metric, old, new, "" if change is None else "{:+.1f}%".format(change)))
+
+    def handle(self, *args, **options):
+        scenarios = [s.strip() for s in options["scenarios"].split(",") if s.strip()]
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError("unknown scenarios: {}".format(", ".join(sorted(unknown))))
+
+        openai = benchmark.LatencyProfile(options["openai_latency"], options["openai_jitter"],
+                                          options["openai_error_rate"], seed=options["seed"])
+        youtube = benchmark.LatencyProfile(options["youtube_latency"], options["youtube_jitter"],
+                                           options["youtube_error_rate"], seed=options["seed"] + 1)
+        self.headers = {"Authorization": "Bearer " + self.token()}
+        senders = self.senders(options)
+
+        if not options["keep_caches"]:
+            for alias in settings.RESULT_CACHES:
+                get_cache(alias).clear()
+
+        with benchmark.StubUpstream(openai, youtube, options["token_delay"]) as upstream:
+            limits = {} if options["keep_limits"] else {"RATE_LIMITS": {}}
+            patches = [mock.patch("main_app.components.youtube.VideosSearch",
+                                  benchmark.stub_videos_search(upstream.url))]
+            if not options["keep_limits"]:
+                patches.append(mock.patch.object(ExternalRateThrottle, "THROTTLE_RATES", {"external": None}))
+
+            # the queries per request are read from the Server-Timing header
+            with override_settings(OPENAI={**settings.OPENAI, "API_KEY": "benchmark", "API_BASE": upstream.url},
+                                   METRICS={**settings.METRICS, "SERVER_TIMING": True}, **limits):
+                for patch in patches:
+                    patch.start()
+                try:
+                    with benchmark.DjangoServer() as server:
+                        self.url = server.url
+                        results = {"scenarios": {}}
+                        for name in scenarios:
+                            self.stderr.write("running {}...".format(name))
+                            results["scenarios"][name] = benchmark.run_scenario(
+                                senders[name], options["requests"], options["concurrency"]
+                            )
+                finally:
+                    for patch in patches:
+                        patch.stop()
+
+        Food.objects.filter(name__startswith=MISS_PREFIX).delete()
+
+        results["meta"] = {
+            "commit": self.commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "foods": Food.objects.count(),
+            "ingredients": Ingredient.objects.count(),
+            "openai": openai.as_dict(),
+            "youtube": youtube.as_dict(),
+            "options": {key: options[key] for key in (
+                "requests", "concurrency", "seed", "miss_ratio", "page_size", "token_delay",
+                "keep_limits", "keep_caches",
+            )},
+        }
+        self.print_results(results)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                self.print_comparison(json.load(f), results)
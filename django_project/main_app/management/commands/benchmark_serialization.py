@@ -0,0 +1,62 @@
+import io
+import json
+import platform
+
+import django
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from main_app import benchmark
+from manage_foods.models import Food
+from manage_foods.serializers import FoodSerializer, NestedFoodSerializer
+
+PREFIX = "serialization bench"
+
+
+class Command(BaseCommand):
+    help = "Compares rendering food listings with the DRF serializers to the fast path of the catalog views " \
+           "(.values() rows and orjson) for growing numbers of rows. The foods are created by seed_catalog " \
+           "in a transaction that is rolled back at the end."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", default="1000,10000,100000", help="comma separated numbers of foods")
+        parser.add_argument("--per-food", type=int, default=8, help="ingredients of each food")
+        parser.add_argument("--repeat", type=int, default=3, help="runs of each path, the fastest one counts")
+        parser.add_argument("--seed", type=int, default=42, help="seed of the created catalog")
+        parser.add_argument("--output", help="write the results as JSON to this file")
+
+    def print_results(self, results):
+        self.stdout.write("{:<10} {:>8} {:>15} {:>10} {:>9} {:>12} {:>10}".format(
+            "expand", "rows", "serializer ms", "fast ms", "speedup", "bytes", "identical"
+        ))
+        for row in results["results"]:
+            self.stdout.write("{expand:<10} {rows:>8} {serializer_ms:>15} {fast_ms:>10} {speedup:>9} "
+                              "{bytes:>12} {identical!s:>10}".format(**row))
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(rows) for rows in options["rows"].split(","))
+        results = {"results": []}
+        with transaction.atomic():
+            self.stderr.write("creating {} foods...".format(sizes[-1]))
+            call_command("seed_catalog", foods=sizes[-1], ingredients=max(sizes[-1] // 10, options["per_food"]),
+                         per_food=options["per_food"], seed=options["seed"], prefix=PREFIX, stdout=io.StringIO())
+            foods = Food.objects.filter(name__startswith=PREFIX + " food ").order_by("id")
+            for rows in sizes:
+                queryset = foods.filter(pk__in=foods.values("pk")[:rows])
+                for expand, serializer_class in (("none", FoodSerializer), ("nested", NestedFoodSerializer)):
+                    self.stderr.write("rendering {} foods, expand {}...".format(rows, expand))
+                    result = benchmark.time_serialization(queryset, serializer_class, options["repeat"])
+                    results["results"].append({"expand": expand, "rows": rows, **result})
+            transaction.set_rollback(True)
+
+        results["meta"] = {
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "options": {key: options[key] for key in ("per_food", "repeat", "seed")},
+        }
+        self.print_results(results)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
@@ -0,0 +1,45 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from manage_foods import bulk
+from manage_foods.models import Food, Ingredient
+
+MODELS = {"foods": Food, "ingredients": Ingredient}
+
+
+class Command(BaseCommand):
+    help = "Exports every food or ingredient as NDJSON or CSV in the format of import_catalog, " \
+           "memory stays constant for any number of rows"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--model", choices=MODELS, default="foods", help="rows to export")
+        parser.add_argument("--format", choices=bulk.FORMATS, dest="fmt",
+                            help="format of the output, by default the extension of --output, else ndjson")
+        parser.add_argument("--output", help="file to write, the standard output by default")
+        parser.add_argument("--chunk-size", type=int, help="rows per query, CATALOG_BULK['CHUNK_SIZE'] by default")
+
+    def handle(self, *args, **options):
+        output, model = options["output"], MODELS[options["model"]]
+        fmt = options["fmt"] or ("csv" if output and output.lower().endswith(".csv") else "ndjson")
+        try:
+            # csv writes its own line endings
+            target = open(output, "w", encoding="utf-8", newline="") if output else sys.stdout
+        except OSError as e:
+            raise CommandError(e)
+        exported = {"rows": 0}
+
+        def counted(rows):
+            for row in rows:
+                yield row
+                exported["rows"] += 1
+                if exported["rows"] % 10000 == 0:
+                    self.stderr.write("{} rows exported".format(exported["rows"]))
+
+        try:
+            for line in bulk.render_rows(counted(bulk.export_rows(model, options["chunk_size"])), model, fmt):
+                target.write(line)
+        finally:
+            if output:
+                target.close()
+        self.stderr.write("{} rows exported".format(exported["rows"]))
@@ -0,0 +1,45 @@
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from manage_foods import bulk
+from manage_foods.models import Food, Ingredient
+
+MODELS = {"foods": Food, "ingredients": Ingredient}
+
+
+class Command(BaseCommand):
+    help = "Imports foods or ingredients from an NDJSON or CSV file in chunks, one transaction per chunk. " \
+           "Foods are matched by case-insensitive name and updated, the others are created, see manage_foods.bulk"
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="file to import, - for the standard input")
+        parser.add_argument("--model", choices=MODELS, default="foods", help="rows of the file")
+        parser.add_argument("--format", choices=bulk.FORMATS, dest="fmt",
+                            help="format of the file, by default its extension, ndjson for the standard input")
+        parser.add_argument("--chunk-size", type=int, help="rows per transaction, CATALOG_BULK['CHUNK_SIZE'] "
+                                                           "by default")
+
+    def handle(self, *args, **options):
+        path, model = options["path"], MODELS[options["model"]]
+        fmt = options["fmt"] or ("csv" if path.lower().endswith(".csv") else "ndjson")
+        started = time.perf_counter()
+
+        def progress(result):
+            self.stderr.write("{rows} rows, {created} created, {updated} updated, {unchanged} unchanged, "
+                              "{failed} failed".format(**result)
+                              + " ({:.0f} rows/s)".format(result["rows"] / (time.perf_counter() - started)))
+
+        try:
+            source = sys.stdin.buffer if path == "-" else open(path, "rb")
+        except OSError as e:
+            raise CommandError(e)
+        with source:
+            lines = bulk.decode_lines(source.readline)
+            result = bulk.import_rows(model, bulk.read_rows(lines, fmt), fmt, options["chunk_size"], progress)
+
+        for error in result["errors"]:
+            self.stderr.write("line {line}: {message}".format(**error))
+        self.stdout.write("{rows} rows imported in {seconds:.2f}s: {created} created, {updated} updated, "
+                          "{unchanged} unchanged, {failed} failed".format(seconds=time.perf_counter() - started, **result))
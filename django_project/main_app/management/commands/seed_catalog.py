@@ -0,0 +1,68 @@
+import random
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from manage_foods.models import Food, Ingredient
+from manage_foods.object_cache import refresh_catalog_version
+from manage_foods.search import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = "Creates a large catalog of foods and ingredients for benchmarks, " \
+           "the same seed always creates the same catalog"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--foods", type=int, default=10000, help="number of foods to create")
+        parser.add_argument("--ingredients", type=int, default=2000, help="number of ingredients to create")
+        parser.add_argument("--per-food", type=int, default=8, help="ingredients of each food")
+        parser.add_argument("--seed", type=int, default=42, help="seed of the random generator")
+        parser.add_argument("--prefix", default="seed", help="prefix of the names of the created rows")
+        parser.add_argument("--clear", action="store_true",
+                            help="delete the rows created earlier with the same prefix first")
+        parser.add_argument("--batch-size", type=int, default=1000, help="rows per INSERT")
+
+    def catalog(self, foods, ingredients, per_food, seed, prefix):
+        """
+        :return: (list of ingredient names, list of (food name, list of ingredient positions)),
+                 a few ingredients are used by most foods like salt and onions in real recipes
+        """
+        rng = random.Random(seed)
+        ingredient_names = ["{} ingredient {:06d}".format(prefix, i) for i in range(ingredients)]
+        weights = [1 / (i + 1) for i in range(ingredients)]
+        per_food = min(per_food, ingredients)
+        food_rows = []
+        for i in range(foods):
+            chosen = set()
+            while len(chosen) < per_food:
+                chosen.update(rng.choices(range(ingredients), weights, k=per_food - len(chosen)))
+            food_rows.append(("{} food {:07d}".format(prefix, i), sorted(chosen)))
+        return ingredient_names, food_rows
+
+    @transaction.atomic
+    def handle(self, *args, **options):
+        prefix, batch_size = options["prefix"], options["batch_size"]
+        if options["clear"]:
+            Food.objects.filter(name__startswith=prefix + " food ").delete()
+            Ingredient.objects.filter(name__startswith=prefix + " ingredient ").delete()
+
+        ingredient_names, food_rows = self.catalog(
+            options["foods"], options["ingredients"], options["per_food"], options["seed"], prefix
+        )
+        ingredients = Ingredient.objects.bulk_get_or_create(ingredient_names)
+        foods = Food.objects.bulk_create(
+            [Food(name=name, recipe="Recipe of {}.".format(name)) for name, _ in food_rows], batch_size=batch_size
+        )
+        Through = Food.main_ingredients.through
+        Through.objects.bulk_create(
+            [
+                Through(food_id=food.pk, ingredient_id=ingredients[position].pk)
+                for food, (_, positions) in zip(foods, food_rows)
+                for position in positions
+            ],
+            batch_size=batch_size,
+        )
+        # bulk_create sends no signals
+        update_search_vectors(Food.objects.filter(pk__in=[food.pk for food in foods]))
+        transaction.on_commit(refresh_catalog_version)
+        self.stdout.write("{} foods with {} ingredients created".format(len(foods), len(ingredients)))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from main_app.components.cache import get_cache
+from main_app.components.open_ai import Request as OpenAIRequest
+from manage_foods.models import Food
+
+
+class Command(BaseCommand):
+    help = "Warms the completions cache: stored recipes are cached for free, " \
+           "ingredient lists of --ingredients-file are sent to OpenAI when not cached yet"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--ingredients-file",
+            help="file with one comma separated list of ingredients per line",
+        )
+        parser.add_argument(
+            "--skip-foods", action="store_true",
+            help="do not cache the recipes of stored foods",
+        )
+
+    def handle(self, *args, **options):
+        openai_req = OpenAIRequest()
+
+        if not options["skip_foods"]:
+            stored = 0
+            foods = Food.objects.exclude(recipe__isnull=True).exclude(recipe="").prefetch_related("main_ingredients")
+            for food in foods.iterator(chunk_size=1000):
+                ingredients = [ingredient.name for ingredient in food.main_ingredients.all()]
+                if ingredients and openai_req.store_recipe(food.name, ingredients, food.recipe):
+                    stored += 1
+            self.stdout.write("{} recipes cached from stored foods".format(stored))
+
+        if options["ingredients_file"]:
+            try:
+                with open(options["ingredients_file"]) as f:
+                    lines = [line.strip() for line in f if line.strip()]
+            except OSError as e:
+                raise CommandError(e)
+
+            cache = get_cache("completions")
+            misses = cache.misses
+            for line in lines:
+                if not openai_req.get_list_food(line):
+                    self.stderr.write("no completion for {}".format(line))
+            self.stdout.write("{} ingredient lists, {} sent to OpenAI".format(len(lines), cache.misses - misses))
@@ -0,0 +1,98 @@
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.db.models.functions import Upper
+
+from main_app.components.open_ai import Request as OpenAIRequest
+from main_app.components.rate_limit import LocalBucket, RateLimiter
+from main_app.components.youtube import search_video_link
+from main_app.models import DishRequest
+from main_app.views import DetailFood
+from manage_foods.models import Food
+
+logger = logging.getLogger('django')
+
+
+class Command(BaseCommand):
+    help = "Generates and stores the most requested foods that are not stored yet, " \
+           "meant to run after a deploy and periodically from cron"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--limit", type=int, default=50, help="number of foods to generate")
+        parser.add_argument("--min-count", type=int, default=2, help="minimum number of requests of a food")
+        parser.add_argument("--workers", type=int, default=4,
+                            help="foods generated at the same time, 1 generates them one by one")
+        parser.add_argument("--rate", type=float, default=1.0,
+                            help="OpenAI and YouTube calls per second, 0 for no limit")
+
+    def popular_dishes(self, limit, min_count):
+        """
+        :return: list of DishRequest, most requested first, without the stored foods
+        """
+        stored = Food.objects.annotate(name_upper=Upper("name")).values("name_upper")
+        return list(
+            DishRequest.objects.filter(count__gte=min_count)
+            .annotate(name_upper=Upper("name"))
+            .exclude(name_upper__in=stored)
+            .order_by("-count", "id")[:limit]
+        )
+
+    def rate_limiter(self, rate, workers):
+        """
+        :param rate: float, calls per second of all workers, 0 for no limit
+        :param workers: int, number of workers waiting for a call at most
+        :return: RateLimiter spacing the calls of the workers, None without a limit
+        """
+        if not rate:
+            return None
+        # a worker waits as long as it takes for its turn
+        return RateLimiter(LocalBucket("warm_popular_foods", rate, 1), max_wait=float("inf"),
+                           max_queue=max(workers, 1))
+
+    def generate(self, dish, rate_limiter):
+        """
+        :param dish: DishRequest, dish to generate
+        :param rate_limiter: RateLimiter shared by the workers, None without a limit
+        :return: bool, True if the food was stored
+        """
+        # stored under the name as the users typed it, DishRequest.name is normalized
+        name = dish.display_name or dish.name
+        try:
+            ingredients = json.loads(dish.ingredients)
+            if rate_limiter:
+                rate_limiter.acquire()
+            recipe = OpenAIRequest().get_recipe(name, ingredients)
+            if not recipe:
+                return False
+            if rate_limiter:
+                rate_limiter.acquire()
+            try:
+                link = search_video_link(name)
+            except BaseException as e:
+                logger.warning("video search failed for %s: %r", name, e)
+                link = None
+            return DetailFood().create_food(name, link, recipe, ingredients)
+        except BaseException:
+            logger.exception("warming %s failed", name)
+            return False
+
+    def generate_in_thread(self, dish, rate_limiter):
+        try:
+            return self.generate(dish, rate_limiter)
+        finally:
+            close_old_connections()
+
+    def handle(self, *args, **options):
+        dishes = self.popular_dishes(options["limit"], options["min_count"])
+        rate_limiter = self.rate_limiter(options["rate"], options["workers"])
+
+        if options["workers"] <= 1:
+            results = [self.generate(dish, rate_limiter) for dish in dishes]
+        else:
+            with ThreadPoolExecutor(max_workers=options["workers"], thread_name_prefix="warm") as executor:
+                results = list(executor.map(lambda dish: self.generate_in_thread(dish, rate_limiter), dishes))
+
+        self.stdout.write("{} of {} popular foods stored".format(sum(results), len(dishes)))
@@ -0,0 +1,79 @@
+import asyncio
+import time
+
+from django.conf import settings
+from django.utils.deprecation import MiddlewareMixin
+
+from .components.db_router import use_replica
+from .components.metrics import RequestStats, current_request, is_metrics_token, registry
+
+
+class MetricsMiddleware:
+    """
+    Records duration, status and number of database queries of every request per endpoint and sends the time
+    spent per span back in a Server-Timing header, with METRICS['SERVER_TIMING'] or to requests with
+    "X-Metrics-Token: <METRICS TOKEN>" only
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            # marks the middleware as async so Django does not run the async views in a thread
+            self._is_coroutine = asyncio.coroutines._is_coroutine
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    async def __acall__(self, request):
+        stats = RequestStats()
+        token = current_request.set(stats)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        self.record(request, response, stats, time.perf_counter() - started)
+        return response
+
+    def record(self, request, response, stats, duration):
+        """
+        Streaming responses are recorded when their headers are ready, not when the body is sent
+        """
+        match = getattr(request, "resolver_match", None)
+        endpoint = match.view_name if match else "unmatched"
+        registry.inc("riga_idea_http_requests_total", endpoint=endpoint, method=request.method,
+                     status=response.status_code)
+        registry.observe("riga_idea_http_request_seconds", duration, endpoint=endpoint)
+        registry.observe("riga_idea_http_request_db_queries", stats.queries, endpoint=endpoint)
+        if not (settings.METRICS['SERVER_TIMING'] or is_metrics_token(request.headers.get("X-Metrics-Token"))):
+            return
+        timings = ["{};dur={:.1f}".format(name, seconds * 1000) for name, seconds in stats.spans.items()]
+        timings.append("db;desc=\"{} queries\"".format(stats.queries))
+        timings.append("total;dur={:.1f}".format(duration * 1000))
+        response["Server-Timing"] = ", ".join(timings)
+
+
+class DatabaseRoutingMiddleware(MiddlewareMixin):
+    """
+    Lets GET and HEAD requests of the views of DATABASE_ROUTING['REPLICA_APPS'] read from the replica, see
+    main_app.components.db_router. It is enabled for the whole request, streamed bodies included
+    """
+
+    def process_request(self, request):
+        use_replica(False)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        app_label = view_func.__module__.split(".")[0]
+        use_replica(request.method in ("GET", "HEAD") and app_label in settings.DATABASE_ROUTING['REPLICA_APPS'])
@@ -0,0 +1,29 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:01
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('namespace', models.CharField(max_length=64)),
+                ('key', models.CharField(max_length=64)),
+                ('value', models.TextField()),
+                ('expires_at', models.DateTimeField(blank=True, null=True)),
+                ('accessed_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cacheentry',
+            constraint=models.UniqueConstraint(fields=('namespace', 'key'), name='cache_entry_namespace_key_uniq'),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0002_flightlease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DishRequest',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=120, unique=True)),
+                ('ingredients', models.TextField()),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('last_requested_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dishrequest',
+            index=models.Index(fields=['-count'], name='dish_request_count_idx'),
+        ),
+    ]
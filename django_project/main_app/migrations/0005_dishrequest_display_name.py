@@ -0,0 +1,18 @@
+# Generated by Django 4.1.6 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main_app', '0004_ratebucket'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dishrequest',
+            name='display_name',
+            field=models.CharField(default='', max_length=120),
+        ),
+    ]
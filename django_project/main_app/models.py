@@ -1,6 +1,96 @@
-from django.db import models
+import json
 
+from django.db import IntegrityError, models, transaction
+from django.db.models import F
+from django.utils import timezone
 
-# Create your models here.
 
+class CacheEntry(models.Model):
+    """
+    Row of the database backend of main_app.components.cache
+    """
+    namespace = models.CharField(max_length=64)
+    key = models.CharField(max_length=64)
+    value = models.TextField()
+    expires_at = models.DateTimeField(blank=True, null=True)
+    accessed_at = models.DateTimeField(db_index=True)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["namespace", "key"], name="cache_entry_namespace_key_uniq"),
+        ]
+
+    def __str__(self):
+        return "{}:{}".format(self.namespace, self.key)
+
+
+class FlightLease(models.Model):
+    """
+    Row held by the worker generating a result for the key, see main_app.components.single_flight
+    """
+    key = models.CharField(max_length=64, unique=True)
+    result = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    completed_at = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return self.key
+
+
+class RateBucket(models.Model):
+    """
+    State of a token bucket of main_app.components.rate_limit.DatabaseBucket
+    """
+    name = models.CharField(max_length=64, unique=True)
+    tokens = models.FloatField()
+    updated_at = models.FloatField()
+
+    def __str__(self):
+        return self.name
+
+
+class DishRequestManager(models.Manager):
+
+    def record(self, name, ingredients, display_name=None):
+        """
+        Counts a DetailFood request of the dish and remembers its latest ingredients and spelling
+
+        :param name: str, normalized food name
+        :param ingredients: list, canonical ingredients
+        :param display_name: str, food name as typed by the user, name by default
+        """
+        values = {
+            "ingredients": json.dumps(ingredients),
+            "display_name": " ".join((display_name or name).split()),
+            "last_requested_at": timezone.now(),
+        }
+        if self.filter(name=name).update(count=F("count") + 1, **values):
+            return
+        try:
+            with transaction.atomic():
+                self.create(name=name, count=1, **values)
+        except IntegrityError:
+            # created by a concurrent request
+            self.filter(name=name).update(count=F("count") + 1, **values)
+
+
+class DishRequest(models.Model):
+    """
+    Number of DetailFood requests per dish, read by the warm_popular_foods command
+    """
+    name = models.CharField(max_length=120, unique=True)
+    # name of the latest request as typed, the name of the stored food
+    display_name = models.CharField(max_length=120, default="")
+    ingredients = models.TextField()
+    count = models.PositiveIntegerField(default=0)
+    last_requested_at = models.DateTimeField()
+
+    objects = DishRequestManager()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["-count"], name="dish_request_count_idx"),
+        ]
+
+    def __str__(self):
+        return self.name
@@ -0,0 +1,53 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from manage_foods.models import Food, Ingredient
+from .components.food_index import get_food_index
+
+
+def _on_commit(func, *args):
+    """
+    Updates the food index once the write is committed, nothing to do before the index is built or building
+    """
+    index = get_food_index()
+    if index.is_tracking:
+        transaction.on_commit(lambda: func(index, *args))
+
+
+@receiver(post_save, sender=Food)
+def food_saved(sender, instance, **kwargs):
+    _on_commit(lambda index, pk, name: index.set_food(pk, name), instance.pk, instance.name)
+
+
+@receiver(post_delete, sender=Food)
+def food_deleted(sender, instance, **kwargs):
+    _on_commit(lambda index, pk: index.remove_food(pk), instance.pk)
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, **kwargs):
+    _on_commit(lambda index, pk, name: index.set_ingredient(pk, name), instance.pk, instance.name)
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    _on_commit(lambda index, pk: index.remove_ingredient(pk), instance.pk)
+
+
+@receiver(m2m_changed, sender=Food.main_ingredients.through)
+def food_ingredients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        # the cleared foods are not known after the clear
+        food_ids = list(instance.food_set.values_list("id", flat=True))
+        for food_id in food_ids:
+            _on_commit(lambda index, food_id, pk: index.unlink(food_id, [pk]), food_id, instance.pk)
+    elif action == "post_clear" and not reverse:
+        _on_commit(lambda index, pk: index.unlink(pk), instance.pk)
+    elif action in ("post_add", "post_remove"):
+        update = "link" if action == "post_add" else "unlink"
+        if reverse:
+            for food_id in pk_set:
+                _on_commit(lambda index, food_id, pk: getattr(index, update)(food_id, [pk]), food_id, instance.pk)
+        else:
+            _on_commit(lambda index, pk, ids: getattr(index, update)(pk, ids), instance.pk, set(pk_set))
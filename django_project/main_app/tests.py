@@ -0,0 +1,1095 @@
+import asyncio
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from unittest import mock
+
+import requests
+
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import OperationalError, connections
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from psycopg2 import extensions
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+from auth_app.models import User
+from .components.cache import (
+    get_cache, make_key, canonical_ingredients, MemoryBackend, DatabaseBackend, FileBackend, LazyCullFileBasedCache
+)
+from .components.single_flight import LocalFlight, DatabaseFlight, AsyncLocalFlight, SingleFlight
+from .components.write_queue import WriteQueue
+from .components.metrics import Registry, RequestStats, current_request, registry
+from .components.circuit_breaker import CircuitBreaker, CircuitOpen
+from .components.rate_limit import RateLimiter, RateLimited, LocalBucket, FileBucket, DatabaseBucket
+from .throttling import ExternalRateThrottle
+from .middleware import DatabaseRoutingMiddleware
+from .components.db_router import ReplicaRouter, primary_reads, replica_reads, use_replica
+from .components.postgresql_pool.base import ConnectionPool, get_pool
+from .components.food_index import FoodIndex, get_food_index
+from .components.open_ai import Client, Request as OpenAIRequest
+from .models import DishRequest, FlightLease
+from manage_foods.models import Food, Ingredient
+from manage_foods.views import FoodList
+from .views import BatchDetailFood, DetailFood, external_executor
+from .async_views import AsyncDetailFood, AsyncListFoods
+from . import benchmark
+
+
+class TestCaseResultCache(TestCase):
+    """
+    Test case for main_app.components.cache
+    """
+
+    def test_canonical_ingredients(self):
+        """
+        Test that ingredient sets are order and case independent
+        """
+        self.assertEqual(canonical_ingredients([" Tomato", "egg ", "tomato", ""]), ["egg", "tomato"])
+        self.assertEqual(make_key(canonical_ingredients(["Egg", "tomato"])),
+                         make_key(canonical_ingredients(["tomato ", "egg"])))
+
+    def test_lru_eviction_and_ttl(self):
+        """
+        Test that every backend evicts the least recently used entry and expires entries
+        """
+        backends = [
+            MemoryBackend("test", max_entries=2),
+            DatabaseBackend("test", max_entries=2, evict_every=1, touch_interval=0),
+            FileBackend("test", max_entries=2, location=tempfile.mkdtemp(), evict_every=1, touch_interval=0),
+        ]
+        for backend in backends:
+            backend.set("a", "1", None)
+            backend.set("b", "2", None)
+            self.assertEqual(backend.get("a"), "1")
+            backend.set("c", "3", None)
+            self.assertEqual(backend.get("a"), "1", backend)
+            self.assertIsNone(backend.get("b"), backend)
+            backend.set("d", "4", -1)
+            self.assertIsNone(backend.get("d"), backend)
+
+    def test_lazy_eviction_and_touch(self):
+        """
+        Test that shared backends evict every evict_every writes and record accesses every touch_interval seconds
+        """
+        backend = DatabaseBackend("test", max_entries=1, evict_every=3, touch_interval=60)
+        backend.set("a", "1", None)
+        with self.assertNumQueries(1):
+            self.assertEqual(backend.get("a"), "1")
+        backend.set("b", "2", None)
+        self.assertEqual((backend.get("a"), backend.get("b")), ("1", "2"))
+        backend.set("c", "3", None)
+        self.assertEqual([backend.get(key) for key in "abc"], [None, None, "3"])
+
+    def test_lazy_cull(self):
+        """
+        Test that the file based Django cache culls every CULL_EVERY writes only
+        """
+        cache = LazyCullFileBasedCache(tempfile.mkdtemp(), {
+            "OPTIONS": {"MAX_ENTRIES": 2, "CULL_FREQUENCY": 1, "CULL_EVERY": 4},
+        })
+        for key in "abc":
+            cache.set(key, key)
+        self.assertEqual([cache.get(key) for key in "abc"], ["a", "b", "c"])
+        cache.add("d", "d")
+        self.assertEqual([cache.get(key) for key in "abcd"], [None, None, None, "d"])
+
+
+class TestCaseListFoods(TestCase):
+    """
+    Test case for ListFoods API
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.client = APIClient()
+        self.user = User.objects.create_user(email="testuser@gmail.com", password="password")
+        self.client.force_authenticate(self.user)
+        get_cache("list_foods").clear()
+        caches["throttle"].clear()
+        get_food_index().build()
+
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_permuted_ingredients_hit_cache(self, openai_request):
+        """
+        Test that repeated and permuted ingredient lists are served from the cache
+        """
+        openai_request.return_value.get_list_food.return_value = "1. Omelette\n2. Shakshuka."
+        response = self.client.post("/api/external/list", {"ingredients": ["egg", "Tomato"]}, format="json")
+        self.assertEqual(response.data, {"Ready Response": [" Omelette", " Shakshuka"]})
+
+        response = self.client.post("/api/external/list", {"ingredients": ["tomato ", "egg"]}, format="json")
+        self.assertEqual(response.data, {"Ready Response": [" Omelette", " Shakshuka"]})
+        self.assertEqual(openai_request.return_value.get_list_food.call_count, 1)
+        self.assertEqual(get_cache("list_foods").stats()["hits"], 1)
+
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_stored_foods_answer_locally(self, openai_request):
+        """
+        Test that enough stored recipes made of the ingredients are returned without OpenAI
+        """
+        egg, milk, flour = Ingredient.objects.bulk_get_or_create(["egg", "milk", "flour"])
+        with self.captureOnCommitCallbacks(execute=True):
+            for name, ingredients in [("Omelette", [egg, milk]), ("Pancake", [egg, milk, flour]), ("Boiled egg", [egg])]:
+                Food.objects.create(name=name).main_ingredients.add(*ingredients)
+
+        response = self.client.post("/api/external/list", {"ingredients": ["Egg", "milk", "flour"]}, format="json")
+        self.assertEqual(response.data, {"Ready Response": ["Pancake", "Omelette", "Boiled egg"]})
+        openai_request.assert_not_called()
+
+
+    @mock.patch.object(ExternalRateThrottle, "THROTTLE_RATES", {"external": "2/min"})
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_user_quota(self, openai_request):
+        """
+        Test that a user is throttled once the quota of the external endpoints is used up
+        """
+        openai_request.return_value.get_list_food.return_value = "1. Omelette"
+        for status in (200, 200, 429):
+            response = self.client.post("/api/external/list", {"ingredients": ["egg"]}, format="json")
+            self.assertEqual(response.status_code, status)
+        self.assertIn("Retry-After", response)
+
+
+class TestCaseFoodIndex(TestCase):
+    """
+    Test case for main_app.components.food_index
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.egg, self.milk, self.flour = Ingredient.objects.bulk_get_or_create(["egg", "milk", "flour"])
+        self.omelette = Food.objects.create(name="Omelette")
+        self.omelette.main_ingredients.add(self.egg, self.milk)
+        self.pancake = Food.objects.create(name="Pancake")
+        self.pancake.main_ingredients.add(self.egg, self.milk, self.flour)
+
+    def test_rank_by_coverage(self):
+        """
+        Test that foods are ranked by the share of their ingredients that are available
+        """
+        index = FoodIndex()
+        self.assertEqual(index.match(["egg", "milk"]), [("Omelette", 1.0)])
+        self.assertEqual(index.match(["EGG ", "milk"], min_coverage=0.5), [("Omelette", 1.0), ("Pancake", 2 / 3)])
+
+    def test_incremental_updates(self):
+        """
+        Test that saved foods and ingredient links are reflected without a rebuild
+        """
+        index = get_food_index()
+        index.build()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.pancake.main_ingredients.remove(self.flour)
+            crepe = Food.objects.create(name="Crepe")
+            crepe.main_ingredients.add(self.egg)
+            self.omelette.delete()
+        self.assertEqual(index.match(["egg", "milk"]), [("Pancake", 1.0), ("Crepe", 1.0)])
+
+    def test_refresh_in_background(self):
+        """
+        Test that an expired index keeps serving while it is rebuilt and updates received during a build are kept
+        """
+        index = FoodIndex(refresh_interval=0)
+        values_list = Food.objects.values_list
+
+        def read_foods(*fields):
+            rows = list(values_list(*fields))
+            # committed while the ingredients are being read, after the foods were
+            index.remove_food(self.omelette.pk)
+            return rows
+
+        with mock.patch.object(Food.objects, "values_list", side_effect=read_foods):
+            index.build()
+        with mock.patch.object(index, "build_in_background") as build_in_background:
+            self.assertEqual(index.match(["egg", "milk"], min_coverage=0.5), [("Pancake", 2 / 3)])
+        build_in_background.assert_called_once()
+
+
+class TestCaseOpenAIClient(TestCase):
+    """
+    Test case for main_app.components.open_ai
+    """
+
+    def response(self, status_code, body=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(body or {}).encode()
+        response.raw = io.BytesIO()
+        return response
+
+    @mock.patch("main_app.components.open_ai.time.sleep")
+    def test_retry_on_throttling(self, sleep):
+        """
+        Test that 429 and 5xx responses are retried on the shared session
+        """
+        client = Client("key", "https://api.test/v1", max_retries=2)
+        ok = self.response(200, {"choices": [{"text": "Omelette"}]})
+        with mock.patch.object(client.session, "post", side_effect=[self.response(429), self.response(503), ok]) as post:
+            self.assertEqual(client.completion("prompt", model="m"), "Omelette")
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(sleep.call_count, 2)
+        self.assertEqual(post.call_args.args[0], "https://api.test/v1/completions")
+        self.assertEqual(post.call_args.kwargs["json"], {"prompt": "prompt", "model": "m"})
+
+    def test_stream_completion(self):
+        """
+        Test that streamed completion parts are yielded until the end marker
+        """
+        client = Client("key", "https://api.test/v1")
+        response = self.response(200)
+        response.raw = io.BytesIO(
+            b'data: {"choices": [{"text": "Whisk"}]}\n\ndata: {"choices": [{"text": " and fry"}]}\n\ndata: [DONE]\n\n'
+        )
+        with mock.patch.object(client.session, "post", return_value=response) as post:
+            self.assertEqual(list(client.stream_completion("prompt")), ["Whisk", " and fry"])
+        self.assertTrue(post.call_args.kwargs["json"]["stream"])
+
+    @mock.patch("main_app.components.open_ai.time.sleep")
+    def test_give_up_after_retries(self, sleep):
+        """
+        Test that the error is raised once the retries are exhausted and client errors are not retried
+        """
+        client = Client("key", "https://api.test/v1", max_retries=1)
+        with mock.patch.object(client.session, "post", return_value=self.response(429)) as post:
+            with self.assertRaises(requests.HTTPError):
+                client.completion("prompt")
+        self.assertEqual(post.call_count, 2)
+        with mock.patch.object(client.session, "post", return_value=self.response(400)) as post:
+            with self.assertRaises(requests.HTTPError):
+                client.completion("prompt")
+        self.assertEqual(post.call_count, 1)
+
+
+class TestCaseCompletionCache(TestCase):
+    """
+    Test case for the completion cache of main_app.components.open_ai.Request
+    """
+
+    @mock.patch("main_app.components.open_ai.get_client")
+    def test_normalized_prompts_share_completion(self, get_client):
+        """
+        Test that prompts differing only by order, case and spacing are sent once
+        """
+        get_client.return_value.completion.return_value = "Whisk and fry"
+        openai_req = OpenAIRequest()
+        self.assertEqual(openai_req.get_recipe("Omelette", ["Tomato", "egg"]), "Whisk and fry")
+        self.assertEqual(openai_req.get_recipe(" omelette ", "egg ,tomato ,egg"), "Whisk and fry")
+        get_client.return_value.completion.assert_called_once()
+        self.assertEqual(get_client.return_value.completion.call_args.args[0],
+                         "List steps of omelette to make using only and only :egg, tomato")
+
+    @mock.patch("main_app.components.open_ai.get_client")
+    def test_warm_completions(self, get_client):
+        """
+        Test that the command caches stored recipes and only sends ingredient lists that are not cached
+        """
+        get_client.return_value.completion.return_value = "1. Omelette"
+        food = Food.objects.create(name="Omelette", recipe="Whisk and fry")
+        food.main_ingredients.add(Ingredient.objects.create(name="egg"), Ingredient.objects.create(name="milk"))
+
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as f:
+            f.write("egg, milk\nMilk ,egg\n")
+            f.flush()
+            out = io.StringIO()
+            call_command("warm_completions", ingredients_file=f.name, stdout=out)
+
+        self.assertIn("1 recipes cached", out.getvalue())
+        self.assertIn("2 ingredient lists, 1 sent to OpenAI", out.getvalue())
+        self.assertEqual(OpenAIRequest().get_recipe("omelette", ["milk", "egg"]), "Whisk and fry")
+        self.assertEqual(get_client.return_value.completion.call_count, 1)
+
+
+class TestCaseRateLimit(TestCase):
+    """
+    Test case for main_app.components.rate_limit
+    """
+
+    def test_steady_rate_after_burst(self):
+        """
+        Test that calls beyond the burst are spaced by the rate and fail fast past max_wait
+        """
+        limiter = RateLimiter(LocalBucket("test", rate=20, burst=2), max_wait=0.5)
+        started = time.monotonic()
+        for _ in range(4):
+            limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+        limiter = RateLimiter(LocalBucket("test", rate=1, burst=1), max_wait=0.1)
+        limiter.acquire()
+        with self.assertRaises(RateLimited):
+            limiter.acquire()
+        self.assertEqual(limiter.stats()["rejected"], 1)
+
+    def test_shared_buckets(self):
+        """
+        Test that file and database buckets of different workers share their tokens
+        """
+        with tempfile.TemporaryDirectory() as location:
+            buckets = [FileBucket("test", rate=1, burst=1, location=location) for _ in range(2)]
+            self.assertEqual(buckets[0].reserve(max_wait=5), 0)
+            self.assertGreater(buckets[1].reserve(max_wait=5), 0.5)
+            self.assertIsNone(buckets[1].reserve(max_wait=0.1))
+
+        buckets = [DatabaseBucket("test", rate=1, burst=1) for _ in range(2)]
+        self.assertEqual(buckets[0].reserve(max_wait=5), 0)
+        self.assertGreater(buckets[1].reserve(max_wait=5), 0.5)
+
+
+class TestCaseCircuitBreaker(TestCase):
+    """
+    Test case for main_app.components.circuit_breaker
+    """
+
+    def fail(self, breaker):
+        with self.assertRaises(ConnectionError):
+            with breaker.guard():
+                raise ConnectionError
+
+    def test_open_and_recover(self):
+        """
+        Test that the circuit opens on failures, fails fast while open and closes after a successful trial
+        """
+        breaker = CircuitBreaker("test", failure_rate=0.5, min_calls=4, open_timeout=0.1)
+        with breaker.guard():
+            pass
+        for _ in range(3):
+            self.fail(breaker)
+        self.assertEqual(breaker.state, "open")
+        with self.assertRaises(CircuitOpen):
+            breaker.allow()
+
+        time.sleep(0.1)
+        self.fail(breaker)
+        self.assertEqual(breaker.state, "open")
+        time.sleep(0.1)
+        with breaker.guard():
+            pass
+        self.assertEqual(breaker.state, "closed")
+
+    def test_slow_calls_open_circuit(self):
+        """
+        Test that calls slower than slow_call_duration count as failures
+        """
+        breaker = CircuitBreaker("test", min_calls=2, slow_call_duration=0.01)
+        for _ in range(2):
+            with breaker.guard():
+                time.sleep(0.02)
+        self.assertEqual(breaker.state, "open")
+
+
+class TestCaseSingleFlight(TestCase):
+    """
+    Test case for main_app.components.single_flight
+    """
+
+    def test_local_flight_runs_once(self):
+        """
+        Test that concurrent calls with the same key share one execution
+        """
+        flight = LocalFlight()
+        calls = []
+
+        def generate():
+            calls.append(1)
+            time.sleep(0.2)
+            return ["recipe"]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do("key", generate))) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [["recipe"]] * 5)
+
+    def test_database_flight_shares_result(self):
+        """
+        Test that the leader stores its result and a follower reads it instead of generating
+        """
+        flight = DatabaseFlight()
+        self.assertEqual(flight.do("key", lambda: ["recipe"]), ["recipe"])
+        self.assertEqual(json.loads(FlightLease.objects.get(key="key").result), ["recipe"])
+        self.assertEqual(flight.do("key", mock.Mock(side_effect=AssertionError)), ["recipe"])
+
+    def test_database_flight_releases_failed_lease(self):
+        """
+        Test that a failed leader removes its lease so the key can be retried
+        """
+        flight = DatabaseFlight()
+        with self.assertRaises(ValueError):
+            flight.do("key", mock.Mock(side_effect=ValueError))
+        self.assertFalse(FlightLease.objects.exists())
+
+
+    def test_async_local_flight_runs_once(self):
+        """
+        Test that concurrent coroutines with the same key share one execution
+        """
+        flight = AsyncLocalFlight()
+        calls = []
+
+        async def generate():
+            calls.append(1)
+            await asyncio.sleep(0.05)
+            return ["recipe"]
+
+        async def run():
+            return await asyncio.gather(*(flight.do("key", generate) for _ in range(5)))
+
+        self.assertEqual(asyncio.run(run()), [["recipe"]] * 5)
+        self.assertEqual(len(calls), 1)
+
+
+class TestCaseWriteQueue(TestCase):
+    """
+    Test case for main_app.components.write_queue
+    """
+
+    def test_background_write_with_retry(self):
+        """
+        Test that writes run off the caller thread and failed writes are retried
+        """
+        queue = WriteQueue(workers=1, retry_delay=0)
+        write = mock.Mock(side_effect=[ValueError, None])
+        write.__name__ = "write"
+        queue.submit(write, "food")
+        queue.join()
+        self.assertEqual(write.call_count, 2)
+        stats = queue.stats()
+        self.assertEqual((stats["depth"], stats["processed"], stats["retried"]), (0, 1, 1))
+
+    def test_full_queue_writes_inline(self):
+        """
+        Test that a full queue pushes back by writing on the caller thread
+        """
+        queue = WriteQueue(workers=1, max_size=1, put_timeout=0)
+        started, release = threading.Event(), threading.Event()
+        queue.submit(lambda: started.set() or release.wait(5))
+        started.wait(5)
+        queue.submit(lambda: release.wait(5))
+        threads = []
+        write = mock.Mock(side_effect=lambda: threads.append(threading.current_thread()))
+        queue.submit(write)
+        release.set()
+        queue.join()
+        self.assertEqual(threads, [threading.current_thread()])
+        self.assertEqual(queue.stats()["overflow"], 1)
+
+
+@override_settings(FOOD_WRITE_QUEUE={"WORKERS": 0})
+class TestCaseDetailFood(TestCase):
+    """
+    Test case for DetailFood API
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.client = APIClient()
+        self.user = User.objects.create_user(email="testuser@gmail.com", password="password")
+        self.client.force_authenticate(self.user)
+        self.payload = {"name": "Omelette", "ingredients": ["egg", "milk"]}
+        caches["throttle"].clear()
+
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_generated_food_is_stored_once(self, openai_request, videos_search):
+        """
+        Test that a generated food is stored and served from the database afterwards
+        """
+        openai_request.return_value.get_recipe.return_value = "Whisk and fry"
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+
+        response = self.client.post("/api/external/detail", self.payload, format="json")
+        expected = {"Ready Response": [{"Name": "Omelette", "link": "https://youtu.be/x", "recipe": "Whisk and fry"}]}
+        self.assertEqual(response.data, expected)
+
+        response = self.client.post("/api/external/detail", {**self.payload, "name": "omelette"}, format="json")
+        self.assertEqual(response.data["Ready Response"][0]["recipe"], "Whisk and fry")
+        self.assertEqual(openai_request.return_value.get_recipe.call_count, 1)
+        self.assertEqual(Food.objects.filter(name__iexact="omelette").count(), 1)
+
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_near_duplicate_is_served(self, openai_request):
+        """
+        Test that a misspelled stored food is answered under its stored name without asking OpenAI
+        """
+        Food.objects.create(name="Spaghetti Carbonara", recipe="Boil and stir", youtube_link="https://youtu.be/c")
+        payload = {"name": "spagetti carbonara", "ingredients": ["pasta", "egg"]}
+        response = self.client.post("/api/external/detail", payload, format="json")
+        self.assertEqual(response.data, {"Ready Response": [
+            {"Name": "Spaghetti Carbonara", "link": "https://youtu.be/c", "recipe": "Boil and stir"}
+        ]})
+        openai_request.return_value.get_recipe.assert_not_called()
+
+    @override_settings(CIRCUIT_BREAKERS={})  # failures of this test must not open the shared circuits
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_lookups_run_concurrently(self, openai_request, videos_search):
+        """
+        Test that the video and recipe lookups overlap and a failed video search still answers with the recipe
+        """
+        def slow_recipe(*args):
+            time.sleep(0.3)
+            return "Whisk and fry"
+
+        def slow_video(*args, **kwargs):
+            time.sleep(0.3)
+            raise ConnectionError
+
+        openai_request.return_value.get_recipe.side_effect = slow_recipe
+        videos_search.side_effect = slow_video
+
+        started = time.monotonic()
+        response = self.client.post("/api/external/detail", self.payload, format="json")
+        self.assertLess(time.monotonic() - started, 0.55)
+        expected = {"Ready Response": [{"Name": "Omelette", "link": None, "recipe": "Whisk and fry"}]}
+        self.assertEqual(response.data, expected)
+
+    @mock.patch("main_app.views.get_single_flight", return_value=SingleFlight(LocalFlight()))
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_stream_recipe(self, openai_request, videos_search, single_flight):
+        """
+        Test that the streaming mode sends the link and the recipe parts as events and stores the food
+        """
+        openai_request.return_value.stream_recipe.return_value = iter(["Whisk", " and fry"])
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+
+        with mock.patch.object(DetailFood, "create_food") as create_food:
+            response = self.client.post("/api/external/detail?stream=1", self.payload, format="json")
+            self.assertEqual(response["Content-Type"], "text/event-stream")
+            content = b"".join(response.streaming_content).decode()
+        events = [
+            (event[len("event: "):], json.loads(data[len("data: "):]))
+            for event, data in (e.split("\n") for e in content.split("\n\n") if e)
+        ]
+        self.assertIn(("link", "https://youtu.be/x"), events)
+        self.assertEqual([data for event, data in events if event == "recipe"], ["Whisk", " and fry"])
+        self.assertEqual(events[-1], ("done", {"Name": "Omelette", "link": "https://youtu.be/x", "recipe": "Whisk and fry"}))
+        # stored from the executor thread, even when the client disconnects
+        create_food.assert_called_once_with("Omelette", "https://youtu.be/x", "Whisk and fry", ["egg", "milk"])
+
+    @mock.patch("main_app.views.get_single_flight", return_value=SingleFlight(LocalFlight()))
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_stream_joins_flight(self, openai_request, videos_search, single_flight):
+        """
+        Test that concurrent streams of a food generate it once, the followers get the finished item,
+        and that a failed generation answers with the degraded response
+        """
+        release = threading.Event()
+
+        def stream_recipe(food_name, ingredients):
+            yield "Whisk"
+            release.wait(5)
+            yield " and fry"
+
+        openai_request.return_value.stream_recipe.side_effect = stream_recipe
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+
+        def events(response):
+            content = b"".join(response.streaming_content).decode()
+            return [
+                (event[len("event: "):], json.loads(data[len("data: "):]))
+                for event, data in (e.split("\n") for e in content.split("\n\n") if e)
+            ]
+
+        with mock.patch.object(DetailFood, "create_food") as create_food:
+            leader = iter(self.client.post("/api/external/detail?stream=1", self.payload, format="json")
+                          .streaming_content)
+            self.assertIn(b"event: ", next(leader))
+            follower = external_executor.submit(
+                events, self.client.post("/api/external/detail?stream=1", self.payload, format="json")
+            )
+            time.sleep(0.1)
+            release.set()
+            b"".join(leader)
+            follower_events = follower.result(timeout=5)
+        item = {"Name": "Omelette", "link": "https://youtu.be/x", "recipe": "Whisk and fry"}
+        self.assertEqual(follower_events[-2:], [("recipe", "Whisk and fry"), ("done", item)])
+        self.assertEqual(openai_request.return_value.stream_recipe.call_count, 1)
+        create_food.assert_called_once()
+
+        openai_request.return_value.stream_recipe.side_effect = CircuitOpen
+        payload = {"name": "Omelette", "ingredients": ["egg"]}
+        response = self.client.post("/api/external/detail?stream=1", payload, format="json")
+        self.assertEqual(events(response)[-1], ("error", "Something went wrong"))
+        food = Food.objects.create(name="Cheese omelette", recipe="Whisk, add cheese and fry")
+        food.main_ingredients.add(Ingredient.objects.create(name="egg"))
+        response = self.client.post("/api/external/detail?stream=1", payload, format="json")
+        self.assertEqual(events(response)[-1], ("degraded", {
+            "Ready Response": [{"Name": "Cheese omelette", "link": None, "recipe": "Whisk, add cheese and fry"}],
+            "Degraded": True,
+        }))
+
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_warm_popular_foods(self, openai_request, videos_search):
+        """
+        Test that requests are counted and the command stores the popular foods that are not stored yet
+        """
+        openai_request.return_value.get_recipe.return_value = "Whisk and fry"
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+        self.client.post("/api/external/detail", self.payload, format="json")
+        self.client.post("/api/external/detail", {**self.payload, "name": " omelette"}, format="json")
+        DishRequest.objects.record("pancakes", ["egg", "flour", "milk"], "pancakes")
+        DishRequest.objects.record("pancakes", ["egg", "flour", "milk"], " Pancakes")
+        DishRequest.objects.record("crepes", ["egg", "milk"])
+        self.assertEqual(DishRequest.objects.get(name="omelette").count, 2)
+
+        out = io.StringIO()
+        with mock.patch("main_app.management.commands.warm_popular_foods.OpenAIRequest") as warm_request:
+            warm_request.return_value.get_recipe.return_value = "Mix and bake"
+            call_command("warm_popular_foods", workers=1, rate=100, stdout=out)
+        self.assertIn("1 of 1 popular foods stored", out.getvalue())
+        warm_request.return_value.get_recipe.assert_called_once_with("Pancakes", ["egg", "flour", "milk"])
+        food = Food.objects.get(name="Pancakes")
+        self.assertEqual((food.recipe, food.youtube_link, food.main_ingredients.count()),
+                         ("Mix and bake", "https://youtu.be/x", 3))
+
+    @override_settings(CIRCUIT_BREAKERS={})  # failures of this test must not open the shared circuits
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_degraded_response(self, openai_request, videos_search):
+        """
+        Test that stored foods close to the request are served when OpenAI is unavailable
+        """
+        openai_request.return_value.get_recipe.side_effect = CircuitOpen
+        videos_search.side_effect = CircuitOpen
+
+        response = self.client.post("/api/external/detail", self.payload, format="json")
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+        food = Food.objects.create(name="Cheese omelette", recipe="Whisk, add cheese and fry")
+        food.main_ingredients.add(Ingredient.objects.create(name="egg"))
+        response = self.client.post("/api/external/detail", self.payload, format="json")
+        self.assertEqual(response.data, {
+            "Ready Response": [{"Name": "Cheese omelette", "link": None, "recipe": "Whisk, add cheese and fry"}],
+            "Degraded": True,
+        })
+
+    def test_create_food_constant_queries(self):
+        """
+        Test that storing a food costs the same number of queries for any number of ingredients
+        """
+        Ingredient.objects.create(name="egg")
+        ingredients = ["egg"] + ["ingredient {}".format(i) for i in range(14)]
+        # the last one touches updated_at of the food for its ETag once the ingredients are linked,
+        # one computes the UPPER of the ingredient names in the database
+        with self.assertNumQueries(11):
+            self.assertTrue(DetailFood().create_food("Omelette", None, "Whisk and fry", ingredients))
+        food = Food.objects.get(name="Omelette")
+        self.assertEqual(food.main_ingredients.count(), 15)
+        self.assertEqual(Ingredient.objects.filter(name="egg").count(), 1)
+
+    def test_create_food_race(self):
+        """
+        Test that a food stored by a concurrent request after the check is reported as existing
+        """
+        self.assertTrue(DetailFood().create_food("Omelette", None, "Whisk and fry", ["egg"]))
+        with mock.patch("django.db.models.query.QuerySet.exists", return_value=False):
+            self.assertFalse(DetailFood().create_food("OMELETTE", None, "Whisk and fry", ["egg"]))
+        self.assertEqual(Food.objects.count(), 1)
+
+
+@override_settings(FOOD_WRITE_QUEUE={"WORKERS": 0})
+class TestCaseAsyncDetailFood(TestCase):
+    """
+    Test case for the async DetailFood and ListFoods views
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.factory = AsyncRequestFactory()
+        caches["throttle"].clear()
+        self.user = User.objects.create_user(email="testuser@gmail.com", password="password")
+        self.payload = {"name": "Omelette", "ingredients": ["egg", "milk"]}
+
+    def post(self, payload, token=True, path="/api/external/detail"):
+        headers = {"AUTHORIZATION": "Bearer {}".format(AccessToken.for_user(self.user))} if token else {}
+        return self.factory.post(path, payload, content_type="application/json", **headers)
+
+    @mock.patch("main_app.async_views.asearch_video_link", new_callable=mock.AsyncMock)
+    @mock.patch("main_app.async_views.OpenAIRequest")
+    async def test_generated_food_is_stored(self, openai_request, video_link):
+        """
+        Test that the async view answers with the recipe and video and stores the food
+        """
+        openai_request.return_value.aget_recipe = mock.AsyncMock(return_value="Whisk and fry")
+        video_link.return_value = "https://youtu.be/x"
+
+        response = await AsyncDetailFood.as_view()(self.post(self.payload))
+        expected = {"Ready Response": [{"Name": "Omelette", "link": "https://youtu.be/x", "recipe": "Whisk and fry"}]}
+        self.assertEqual(json.loads(response.content), expected)
+        self.assertTrue(await Food.objects.filter(name="Omelette").aexists())
+
+        response = await AsyncDetailFood.as_view()(self.post(self.payload, token=False))
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(openai_request.return_value.aget_recipe.call_count, 1)
+
+    async def test_invalid_request(self):
+        """
+        Test that malformed bodies and streaming are refused and failures answer 500
+        """
+        for payload in ({"name": ["Omelette"], "ingredients": ["egg"]}, {"name": "Omelette", "ingredients": "egg"},
+                        {"name": "Omelette", "ingredients": [1]}):
+            response = await AsyncDetailFood.as_view()(self.post(payload))
+            self.assertEqual(response.status_code, 400)
+        response = await AsyncListFoods.as_view()(self.post({"ingredients": [{"name": "egg"}]}))
+        self.assertEqual(response.status_code, 400)
+        response = await AsyncDetailFood.as_view()(self.post(self.payload, path="/api/external/detail?stream=1"))
+        self.assertEqual(response.status_code, 400)
+
+        with mock.patch.object(DetailFood, "count_request", side_effect=RuntimeError):
+            response = await AsyncDetailFood.as_view()(self.post(self.payload))
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(json.loads(response.content), {"message": "Something went wrong"})
+
+
+@override_settings(FOOD_WRITE_QUEUE={"WORKERS": 0})
+class TestCaseBatchDetailFood(TransactionTestCase):
+    """
+    Test case for BatchDetailFood API, transactional because the foods are generated on other threads
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.client = APIClient()
+        self.user = User.objects.create_user(email="testuser@gmail.com", password="password")
+        self.client.force_authenticate(self.user)
+        Food.objects.create(name="Omelette", youtube_link="https://youtu.be/o", recipe="Whisk and fry")
+        caches["throttle"].clear()
+        self.payload = {"names": ["omelette", "Pancakes", "Crepes", "pancakes "], "ingredients": ["egg", "milk"]}
+
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_batch_generates_missing_foods_concurrently(self, openai_request, videos_search):
+        """
+        Test that stored foods are reused, duplicates are dropped and missing foods are generated side by side
+        """
+        def slow_recipe(food_name, ingredients):
+            time.sleep(0.3)
+            return "Recipe of {}".format(food_name)
+
+        openai_request.return_value.get_recipe.side_effect = slow_recipe
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+
+        started = time.monotonic()
+        with mock.patch.object(DetailFood, "create_food") as create_food:
+            response = self.client.post("/api/external/batch", self.payload, format="json")
+        self.assertLess(time.monotonic() - started, 0.55)
+        self.assertEqual(response.data["Failed"], [])
+        self.assertEqual(response.data["Ready Response"], [
+            {"Name": "omelette", "link": "https://youtu.be/o", "recipe": "Whisk and fry"},
+            {"Name": "Pancakes", "link": "https://youtu.be/x", "recipe": "Recipe of Pancakes"},
+            {"Name": "Crepes", "link": "https://youtu.be/x", "recipe": "Recipe of Crepes"},
+        ])
+        self.assertEqual(openai_request.return_value.get_recipe.call_count, 2)
+        self.assertEqual(sorted(call.args[0] for call in create_food.call_args_list), ["Crepes", "Pancakes"])
+
+    @mock.patch("main_app.components.youtube.VideosSearch")
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_stream_batch(self, openai_request, videos_search):
+        """
+        Test that the streaming mode sends one JSON line per food, stored ones first
+        """
+        openai_request.return_value.get_recipe.side_effect = ["Recipe", None]
+        videos_search.return_value.result.return_value = {"result": [{"link": "https://youtu.be/x"}]}
+
+        payload = {**self.payload, "names": ["Pancakes", "Omelette"]}
+        with mock.patch.object(DetailFood, "create_food"):
+            response = self.client.post("/api/external/batch?stream=1", payload, format="json")
+            lines = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[0]["recipe"], "Whisk and fry")
+        self.assertEqual(lines[1]["Name"], "Pancakes")
+
+    @mock.patch.object(BatchDetailFood, "generate", return_value=None)
+    def test_stored_accented_names(self, generate):
+        """
+        Test that stored foods with accented names are matched like the database compares them, not generated
+        """
+        Food.objects.create(name="Crème brûlée", recipe="Bake and torch")
+        payload = {**self.payload, "names": ["crème brûlée", " Crème brûlée", "Omelette"]}
+        response = self.client.post("/api/external/batch", payload, format="json")
+        self.assertFalse(generate.called)
+        self.assertEqual([item["recipe"] for item in response.data["Ready Response"]],
+                         ["Bake and torch", "Whisk and fry"])
+
+    @mock.patch.object(ExternalRateThrottle, "THROTTLE_RATES", {"external": "3/min"})
+    @mock.patch.object(BatchDetailFood, "generate", return_value=None)
+    def test_generations_use_the_quota(self, generate):
+        """
+        Test that every food to generate takes a request of the external quota and that a batch needing more
+        than is left is refused without generating anything
+        """
+        payload = {**self.payload, "names": ["Omelette", "Pancakes", "Crepes", "Waffles", "Scones"]}
+        self.assertEqual(self.client.post("/api/external/batch", payload, format="json").status_code, 429)
+        self.assertFalse(generate.called)
+
+        payload = {**self.payload, "names": ["Omelette", "Pancakes", "Crepes"]}
+        self.assertEqual(self.client.post("/api/external/batch", payload, format="json").status_code, 200)
+        self.assertEqual(generate.call_count, 2)
+        payload = {**self.payload, "names": ["Omelette"]}
+        self.assertEqual(self.client.post("/api/external/batch", payload, format="json").status_code, 429)
+
+    def test_invalid_body(self):
+        """
+        Test that names and ingredients other than lists of strings are refused and failures answer 500
+        """
+        for payload in (
+            {**self.payload, "names": "Pancakes"},
+            {**self.payload, "names": ["Pancakes", 1]},
+            {**self.payload, "ingredients": "egg"},
+            {**self.payload, "ingredients": [{"name": "egg"}]},
+        ):
+            self.assertEqual(self.client.post("/api/external/batch", payload, format="json").status_code, 400)
+
+        with mock.patch.object(BatchDetailFood, "resolve", side_effect=RuntimeError):
+            response = self.client.post("/api/external/batch", self.payload, format="json")
+        self.assertEqual(response.status_code, 500)
+        self.assertEqual(response.data, {"message": "Something went wrong"})
+
+
+class TestCaseMetrics(TestCase):
+    """
+    Test case for main_app.components.metrics and the metrics endpoint
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.client = APIClient()
+        self.user = User.objects.create_user(email="testuser@gmail.com", password="password")
+        self.client.force_authenticate(self.user)
+        get_cache("list_foods").clear()
+        caches["throttle"].clear()
+        registry.clear()
+
+    def test_summary_quantiles(self):
+        """
+        Test that summaries report count, sum and nearest rank quantiles
+        """
+        metrics = Registry()
+        for i in range(1, 101):
+            metrics.observe("latency", i / 100, endpoint="x")
+        summary = metrics.summary("latency", endpoint="x")
+        self.assertEqual((summary["count"], summary[0.5], summary[0.95], summary[0.99]), (100, 0.51, 0.96, 1.0))
+        self.assertIn('latency{endpoint="x",quantile="0.99"} 1.0', metrics.render())
+
+    @override_settings(METRICS={"TOKEN": "secret", "PUBLIC": False, "SERVER_TIMING": False, "MAX_SAMPLES": 1024})
+    @mock.patch("main_app.views.OpenAIRequest")
+    def test_metrics_endpoint(self, openai_request):
+        """
+        Test that requests are recorded per endpoint with their spans and database queries, and that metrics and
+        Server-Timing are only sent with the token
+        """
+        openai_request.return_value.get_list_food.return_value = "1. Omelette"
+        response = self.client.post("/api/external/list", {"ingredients": ["egg"]}, format="json")
+        self.assertNotIn("Server-Timing", response)
+        response = self.client.post("/api/external/list", {"ingredients": ["egg", "milk"]}, format="json",
+                                    HTTP_X_METRICS_TOKEN="secret")
+        self.assertIn("index.match;dur=", response["Server-Timing"])
+
+        self.assertEqual(self.client.get("/metrics").status_code, 403)
+        self.assertEqual(self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer wrong").status_code, 403)
+        response = self.client.get("/metrics", HTTP_AUTHORIZATION="Bearer secret")
+        body = response.content.decode()
+        worker = 'worker="{}"'.format(os.getpid())
+        self.assertIn('riga_idea_http_requests_total{endpoint="ListFoods",method="POST",status="200",%s} 2' % worker,
+                      body)
+        self.assertIn('riga_idea_span_seconds_count{span="index.match",%s} 2' % worker, body)
+        self.assertIn('riga_idea_cache_hit_ratio{cache="list_foods",%s}' % worker, body)
+        self.assertEqual(registry.summary("riga_idea_http_request_db_queries", endpoint="ListFoods")["count"], 2)
+
+    def test_query_counter(self):
+        """
+        Test that the queries of the current request are counted
+        """
+        stats = RequestStats()
+        token = current_request.set(stats)
+        try:
+            User.objects.count()
+            Food.objects.exists()
+        finally:
+            current_request.reset(token)
+        self.assertEqual(stats.queries, 2)
+
+
+class TestCaseBenchmark(TestCase):
+    """
+    Test case for main_app.benchmark and the seed_catalog command
+    """
+
+    def test_stub_upstream(self):
+        """
+        Test that the stub answers completions, streamed completions and video searches
+        """
+        with benchmark.StubUpstream(benchmark.LatencyProfile(0), benchmark.LatencyProfile(0)) as upstream:
+            client = Client("key", upstream.url)
+            text = client.post("/completions", {"prompt": "What kind of foods can I make with egg?"}).json()
+            self.assertTrue(text["choices"][0]["text"].startswith("1. Dish "))
+            streamed = "".join(client.stream_completion("recipe of omelette"))
+            self.assertIn("8. Step", streamed)
+            link = benchmark.stub_videos_search(upstream.url)("omelette").result()["result"][0]["link"]
+            self.assertTrue(link.startswith("https://www.youtube.com/watch?v="))
+
+    def test_stub_upstream_errors(self):
+        """
+        Test that the error rate of the profile makes the stub fail
+        """
+        with benchmark.StubUpstream(benchmark.LatencyProfile(0, error_rate=1),
+                                    benchmark.LatencyProfile(0)) as upstream:
+            response = requests.post(upstream.url + "/completions", json={"prompt": "x"})
+            self.assertEqual(response.status_code, 503)
+
+    def test_run_scenario(self):
+        """
+        Test that the runner reports statuses, percentiles and the queries of the Server-Timing header
+        """
+        response = mock.Mock(status_code=200, headers={"Server-Timing": 'db;desc="3 queries", total;dur=1.0'})
+        result = benchmark.run_scenario(lambda session, i: response, 20, 4)
+        self.assertEqual(result["statuses"], {"200": 20})
+        self.assertEqual((result["error_rate"], result["queries_per_request"]), (0, 3))
+        self.assertLessEqual(result["latency_ms"]["p50"], result["latency_ms"]["p99"])
+
+    def test_seed_catalog(self):
+        """
+        Test that the same seed creates the same catalog
+        """
+        call_command("seed_catalog", foods=20, ingredients=10, per_food=3, seed=7, prefix="a", stdout=io.StringIO())
+        call_command("seed_catalog", foods=20, ingredients=10, per_food=3, seed=7, prefix="b", stdout=io.StringIO())
+
+        def catalog(prefix):
+            return [
+                sorted(i.name[len(prefix):] for i in food.main_ingredients.all())
+                for food in Food.objects.filter(name__startswith=prefix + " food").order_by("name")
+            ]
+
+        self.assertEqual(len(catalog("a")), 20)
+        self.assertTrue(all(len(ingredients) == 3 for ingredients in catalog("a")))
+        self.assertEqual(catalog("a"), catalog("b"))
+
+
+@override_settings(DATABASE_ROUTING={"REPLICA": "replica", "REPLICA_APPS": ["manage_foods"]})
+class TestCaseDatabaseRouting(TransactionTestCase):
+    """
+    Test case for main_app.components.db_router, DatabaseRoutingMiddleware and the connection pool
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.addCleanup(use_replica, False)
+        self.middleware = DatabaseRoutingMiddleware(lambda request: None)
+
+    def route(self, method):
+        request = getattr(RequestFactory(), method)("/api/foods/")
+        self.middleware.process_request(request)
+        self.middleware.process_view(request, FoodList.as_view(), (), {})
+
+    def test_replica_reads(self):
+        """
+        Test that catalog GETs read the catalog from the replica until they write, everything else from the primary
+        """
+        self.route("get")
+        self.assertEqual((Food.objects.all().db, User.objects.all().db), ("replica", "default"))
+        with primary_reads():
+            self.assertEqual(Food.objects.all().db, "default")
+        self.assertEqual(ReplicaRouter().db_for_write(Food), "default")
+        self.assertEqual(Food.objects.all().db, "default")
+
+        self.route("post")
+        self.assertEqual(Food.objects.all().db, "default")
+        with replica_reads():
+            self.assertEqual(Food.objects.all().db, "replica")
+        self.assertFalse(ReplicaRouter().allow_migrate("replica", "manage_foods"))
+
+    def test_flight_reads_primary(self):
+        """
+        Test that the check of a flight before generating a food reads the primary, other lookups the replica
+        """
+        read_from = []
+        food = Food(name="Omelette", recipe="Whisk and fry")
+        with mock.patch("django.db.models.query.QuerySet.first", autospec=True,
+                        side_effect=lambda queryset: read_from.append(queryset.db) or food):
+            self.assertEqual(DetailFood().get_or_generate("Omelette", ["egg"])[0]["recipe"], "Whisk and fry")
+            DetailFood().get_food("Omelette")
+        self.assertEqual(read_from, ["default", "replica"])
+
+    def test_connection_pool(self):
+        """
+        Test that connections are reused, bounded, rolled back and replaced when broken or too old
+        """
+        pool = ConnectionPool(max_size=1, timeout=0.01, max_lifetime=60, health_checks=False)
+        connect = mock.Mock(side_effect=lambda: mock.MagicMock(closed=0))
+        connection = pool.getconn(connect)
+        with self.assertRaises(OperationalError):
+            pool.getconn(connect)
+
+        connection.info.transaction_status = extensions.TRANSACTION_STATUS_INTRANS
+        pool.putconn(connection)
+        connection.rollback.assert_called_once()
+        self.assertIs(pool.getconn(connect), connection)
+
+        connection.closed = 1
+        pool.putconn(connection)
+        replaced = pool.getconn(connect)
+        self.assertIsNot(replaced, connection)
+        replaced.info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+        with mock.patch("time.monotonic", return_value=time.monotonic() + 61):
+            pool.putconn(replaced)
+        replaced.close.assert_called_once()
+        self.assertEqual(connect.call_count, 2)
+
+    def test_executor_returns_pooled_connections(self):
+        """
+        Test that the executor threads give their pooled connection back after every task, so more tasks than
+        connections run through more threads than connections
+        """
+        settings_dict = {
+            **connections.settings["default"], "ENGINE": "main_app.components.postgresql_pool", "NAME": "pooled",
+            "CONN_MAX_AGE": 0, "POOL": {"MAX_SIZE": 2, "TIMEOUT": 5},
+        }
+        opened = []
+
+        def connect(**params):
+            opened.append(mock.MagicMock(closed=0, server_version=150000))
+            opened[-1].info.transaction_status = extensions.TRANSACTION_STATUS_IDLE
+            return opened[-1]
+
+        def task(i):
+            connections["pooled"].ensure_connection()
+            time.sleep(0.01)
+            return i
+
+        with mock.patch.dict(connections.settings, pooled=settings_dict), \
+                mock.patch("psycopg2.connect", side_effect=connect), mock.patch("psycopg2.extras.register_default_jsonb"):
+            self.addCleanup(get_pool("pooled", settings_dict).close)
+            results = [external_executor.submit(task, i) for i in range(8)]
+            self.assertEqual([future.result() for future in results], list(range(8)))
+        self.assertLessEqual(len(opened), 2)
+        self.assertEqual(get_pool("pooled", settings_dict)._slots._value, 2)
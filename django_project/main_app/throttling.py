@@ -0,0 +1,35 @@
+from django.core.cache import caches
+from rest_framework.throttling import UserRateThrottle
+
+
+class ExternalRateThrottle(UserRateThrottle):
+    """
+    Per user quota of the endpoints calling OpenAI and YouTube,
+    counted in the "throttle" cache so every worker sees the same history
+    """
+    scope = "external"
+    cache = caches["throttle"]
+
+    def allow_requests(self, request, view, count):
+        """
+        Takes count more requests of the quota at once, for requests starting several generations
+
+        :param request: rest_framework Request, its own request was counted by allow_request
+        :param view: the view
+        :param count: int, number of requests to take
+        :return: bool, False and nothing taken if fewer than count requests are left in the quota
+        """
+        if self.rate is None or count <= 0:
+            return True
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+        self.history = self.cache.get(self.key, [])
+        self.now = self.timer()
+        while self.history and self.history[-1] <= self.now - self.duration:
+            self.history.pop()
+        if len(self.history) + count > self.num_requests:
+            return False
+        self.history[:0] = [self.now] * count
+        self.cache.set(self.key, self.history, self.duration)
+        return True
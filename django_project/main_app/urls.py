@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path, re_path
 from .views import *
 
+if settings.ASYNC_EXTERNAL_VIEWS:
+    # served by an ASGI worker, see docker-compose.yml
+    from .async_views import AsyncListFoods as ListFoods, AsyncDetailFood as DetailFood
+
 
 urlpatterns = [
     re_path(r'list/?$', ListFoods.as_view(), name='ListFoods'),
     re_path(r'detail/?$', DetailFood.as_view(), name='DetailFood'),
+    re_path(r'batch/?$', BatchDetailFood.as_view(), name='BatchDetailFood'),
 ]
@@ -1,39 +1,138 @@
+from rest_framework import exceptions
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from .components.open_ai import Request as OpenAIRequest
-from youtubesearchpython import VideosSearch
-from manage_foods.models import Food, Ingredient
+from .components.open_ai import Request as OpenAIRequest, normalize_food
+from .components.cache import get_cache, make_key, canonical_ingredients
+from .components.single_flight import get_single_flight
+from .components.food_index import get_food_index
+from .components.write_queue import get_write_queue
+from .components.youtube import search_video_link
+from .components.metrics import is_metrics_token, registry, span
+from .components.db_router import primary_reads, replica_reads
+from .components.executor import DatabaseThreadPoolExecutor
+from .components.cache import all_caches
+from .components.rate_limit import all_rate_limiters
+from .components.circuit_breaker import all_circuit_breakers
+from .models import DishRequest
+from .throttling import ExternalRateThrottle
+from manage_foods.models import Food, Ingredient, upper_names
+from manage_foods.search import find_similar_food, search_food_ids
+import json
 import logging
+import queue
+import time
 import traceback
-from threading import Thread
-from django.core.exceptions import BadRequest
+from concurrent.futures import as_completed
+from django.conf import settings
+from django.db import IntegrityError, router, transaction
+from django.db.models.functions import Upper
+from django.http import HttpResponse, StreamingHttpResponse
 
 logger = logging.getLogger('django')
 
+# runs the YouTube and OpenAI lookups of a request side by side, they read and write the database backed caches
+external_executor = DatabaseThreadPoolExecutor(
+    max_workers=settings.EXTERNAL_CALLS['MAX_WORKERS'], thread_name_prefix="external"
+)
+# generates the foods of a batch request, separate from external_executor that each generation waits on
+batch_executor = DatabaseThreadPoolExecutor(
+    max_workers=settings.EXTERNAL_CALLS['BATCH_WORKERS'], thread_name_prefix="batch"
+)
+
+
+def sse_event(event, data):
+    """
+    :param event: str, name of the event
+    :param data: json serializable data of the event
+    :return: str, server-sent event
+    """
+    return "event: {}\ndata: {}\n\n".format(event, json.dumps(data))
+
+
+UNAVAILABLE = {"message": "Recipes are unavailable at the moment, try again later"}
+
+
+def retry_after_headers():
+    """
+    :return: dict, Retry-After header of the 503 responses, the time an open circuit waits before a trial call
+    """
+    return {"Retry-After": str(settings.CIRCUIT_BREAKERS.get('openai', {}).get('OPEN_TIMEOUT', 30))}
+
+
+def is_string_list(value):
+    """
+    :param value: a value of the request body
+    :return: bool, True if it is a non-empty list of strings
+    """
+    return bool(value) and isinstance(value, list) and all(isinstance(item, str) for item in value)
+
 
 class ListFoods(APIView):
     """
     The class handles User request to send a request to 3rd libraries
     """
+    throttle_classes = (ExternalRateThrottle,)
 
     def parse_ingredients(self, ingredients):
         """
 
         :param ingredients: list, list of ingredients in string
-        :return: list of foods that was generated by OpenAI
+        :return: list of foods that was cached, found in stored recipes or generated by OpenAI
         """
         try:
-            ingredients = " ,".join(ingredients)
+            cache = get_cache("list_foods")
+            cache_key = make_key(canonical_ingredients(ingredients))
+            list_of_foods = cache.get(cache_key)
+            if list_of_foods is not None:
+                return list_of_foods
+
+            list_of_foods = self.match_stored_foods(ingredients)
+            if list_of_foods:
+                return list_of_foods
+
             openai_req = OpenAIRequest()
-            open_res = openai_req.get_list_food(ingredients).replace("\n", "")
-            filtered = ''.join(filter(lambda c: not c.isdigit(), open_res))
-            list_of_foods = filtered.split(".")
-            list_of_foods = [i for i in list_of_foods if i]
+            list_of_foods = self.parse_food_list(openai_req.get_list_food(ingredients))
+            if list_of_foods:
+                cache.set(cache_key, list_of_foods)
             return list_of_foods
         except BaseException as e:
             err = traceback.format_exc()
             logger.error(err)
 
+    @staticmethod
+    def parse_food_list(text):
+        """
+        :param text: str, numbered list of foods answered by OpenAI
+        :return: list of food names
+        """
+        filtered = ''.join(filter(lambda c: not c.isdigit(), text.replace("\n", "")))
+        return [i for i in filtered.split(".") if i]
+
+    def match_stored_foods(self, ingredients):
+        """
+        :param ingredients: list, list of ingredients in string
+        :return: list of stored foods that can be made from the ingredients,
+                 None if there are too few of them to skip OpenAI
+        """
+        config = settings.FOOD_INDEX
+        with span("index.match"):
+            matches = get_food_index().match(
+                ingredients, limit=config['MAX_RESULTS'], min_coverage=config['MIN_COVERAGE']
+            )
+        if len(matches) >= config['MIN_MATCHES']:
+            return [name for name, coverage in matches]
+
+    def degraded(self, ingredients):
+        """
+        Answer when OpenAI is unavailable: stored foods sharing the most ingredients
+
+        :param ingredients: list, list of ingredients in string
+        :return: dict, degraded response data, None if no stored food shares an ingredient
+        """
+        matches = get_food_index().match(ingredients, limit=settings.FOOD_INDEX['MAX_RESULTS'], min_coverage=0)
+        if matches:
+            return {"Ready Response": [name for name, coverage in matches], "Degraded": True}
+
     def post(self, request, *args, **kwargs):
         """
         the function takes post request and proceeds for OPENAI
@@ -47,7 +146,10 @@ class ListFoods(APIView):
                 list_of_foods = self.parse_ingredients(ingredients)
 
                 if not list_of_foods:
-                    return BadRequest("Something went wrong")
+                    degraded = self.degraded(ingredients)
+                    if degraded:
+                        return Response(degraded)
+                    return Response(UNAVAILABLE, status=503, headers=retry_after_headers())
                 return Response({
                     "Ready Response": list_of_foods
                 })
@@ -58,16 +160,20 @@ class ListFoods(APIView):
         except BaseException as e:
             err = traceback.format_exc()
             logger.error(err)
+            return Response({"message": "Something went wrong"}, status=500)
 
 
 class DetailFood(APIView):
     """
     The class handles User request to send a request to 3rd libraries
     """
+    throttle_classes = (ExternalRateThrottle,)
 
     def get_response_openai(self, food_name, ingredients):
         """
 
+        YouTube and OpenAI are asked concurrently, link is None when the video search fails or times out
+
         :param food:str, name of food
         :param ingredients:list, list of ingredients in string
         :return: response generated from OpenAI and YouTube api
@@ -77,24 +183,39 @@ class DetailFood(APIView):
 
             openai_req = OpenAIRequest()
 
-            response_youtube = VideosSearch(food_name, limit=1).result().get("result")[0].get("link")
+            started = time.monotonic()
+            youtube_future = external_executor.submit(search_video_link, food_name)
+            recipe_future = external_executor.submit(openai_req.get_recipe, food_name, ingredients)
+
+            recipe = recipe_future.result(timeout=settings.EXTERNAL_CALLS['RECIPE_TIMEOUT'])
+            try:
+                video_timeout = settings.EXTERNAL_CALLS['VIDEO_TIMEOUT'] - (time.monotonic() - started)
+                response_youtube = youtube_future.result(timeout=max(video_timeout, 0))
+            except BaseException as e:
+                # the recipe is the valuable part, answer without the video
+                logger.warning("video search failed for %s: %r", food_name, e)
+                response_youtube = None
 
-            recipe = openai_req.get_recipe(food_name, ingredients)
             ready_response.append({"Name": food_name, "link": response_youtube, "recipe": recipe})
-            t = Thread(target=self.create_food, args=[food_name, response_youtube, recipe, ingredients])
-            t.run()
+            # stored by the write queue workers after the response is sent
+            get_write_queue().submit(self.create_food, food_name, response_youtube, recipe, ingredients)
             return ready_response
         except BaseException as e:
             err = traceback.format_exc()
             logger.error(err)
 
-    def get_food(self, food_name):
+    def get_food(self, food_name, primary=False):
         """
         :param food_name: str, contains food name
-        :return: return food if exists
+        :param primary: bool, read from the primary, for the checks right before a generation
+        :return: return food if exists, otherwise a stored near-duplicate such as a misspelling of it,
+                 read from the replica by default: a food stored moments ago may be missed
         """
         try:
-            food = Food.objects.get(name__iexact=food_name)
+            with span("db.get_food"), (primary_reads() if primary else replica_reads()):
+                food = Food.objects.filter(name__iexact=food_name).first()
+                if not food:
+                    food = find_similar_food(food_name)
             if food:
                 return food
 
@@ -102,32 +223,200 @@ class DetailFood(APIView):
             err = traceback.format_exc()
             logger.error(err)
 
+    def food_response(self, food_name, food):
+        """
+        :param food_name: str, contains food name
+        :param food: Food, stored food
+        :return: dict, response item of the stored food, a near-duplicate keeps its stored name
+        """
+        return {
+            "Name": food_name if food.name.lower() == food_name.lower() else food.name,
+            "link": food.youtube_link,
+            "recipe": food.recipe
+        }
+
+    def degraded(self, food_name, ingredients):
+        """
+        Answer when OpenAI is unavailable: stored foods found by searching the requested name,
+        otherwise the stored foods sharing the most ingredients
+
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        :return: dict, degraded response data, None if no stored food is close enough
+        """
+        limit = settings.FOOD_INDEX['MAX_RESULTS']
+        ids = search_food_ids(food_name, limit=limit)
+        foods = sorted(Food.objects.filter(pk__in=ids).exclude(recipe=None), key=lambda food: ids.index(food.pk))
+        if not foods:
+            matches = get_food_index().match(ingredients, limit=limit, min_coverage=0)
+            names = [name for name, coverage in matches]
+            foods = sorted(Food.objects.filter(name__in=names), key=lambda food: names.index(food.name))
+        if foods:
+            return {"Ready Response": [self.food_response(food.name, food) for food in foods], "Degraded": True}
+
+    def count_request(self, food_name, ingredients):
+        """
+        Counts the request for the warm_popular_foods command, written by the write queue workers
+
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        """
+        get_write_queue().submit(
+            DishRequest.objects.record, normalize_food(food_name), canonical_ingredients(ingredients), food_name
+        )
+
+    def get_or_generate(self, food_name, ingredients):
+        """
+        Runs once per food name across concurrent requests,
+        the food may have been stored while the request was waiting for its turn
+
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        :return: response from database or generated from OpenAI and YouTube api
+        """
+        # the previous flight of the name may have stored it moments ago, which the replica may not show yet
+        food = self.get_food(food_name, primary=True)
+        if food:
+            return [self.food_response(food_name, food)]
+        return self.get_response_openai(food_name, ingredients)
+
     def create_food(self, food_name, link, recipe, ingredients):
         """
         :param food_name: str, contains food name
         :param link: str, YouTube link of food
         :param recipe: str, description how to coook
         :param ingredients: list, list of ingredients
-        :return: True if created
+        :return: True if created, False if the food already exists
+        :raises: the database error, so the write queue can retry
         """
         try:
+            with span("db.create_food"), transaction.atomic():
+                if Food.objects.filter(name__iexact=food_name).exists():
+                    return False
 
-            ing_ids = []
-            for i in ingredients:
-                ins = Ingredient.objects.get_or_create(name=i)
-                print(ins)
-                ing_ids.append(ins)
-            food = Food.objects.create(name=food_name, youtube_link=link, recipe=recipe)
-            food.main_ingredients.add(*ing_ids)  # adds all together
+                ingredient_objs = Ingredient.objects.bulk_get_or_create(ingredients)
+                food = Food.objects.create(name=food_name, youtube_link=link, recipe=recipe)
+                food.main_ingredients.add(*ingredient_objs)  # adds all together
             logger.info("created")
             return True
+        except IntegrityError:
+            # stored by a concurrent request since the check
+            return False
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+            raise
+
+    def stream_recipe(self, food_name, ingredients, events):
+        """
+        Generation of the leader of a streamed flight: the video search and the recipe parts are sent to the events
+        of its request as they come
+
+        :param food_name: str, name of food
+        :param ingredients: list, list of ingredients in string
+        :param events: queue.Queue receiving ("link", Future of the video search) and ("recipe", part)
+        :return: list with the response item, like get_or_generate
+        """
+        food = self.get_food(food_name, primary=True)
+        if food:
+            return [self.food_response(food_name, food)]
+
+        started = time.monotonic()
+        youtube_future = external_executor.submit(search_video_link, food_name)
+        youtube_future.add_done_callback(lambda f: events.put(("link", f)))
+        parts = []
+        for part in OpenAIRequest().stream_recipe(food_name, ingredients):
+            parts.append(part)
+            events.put(("recipe", part))
+        recipe = "".join(parts)
+        try:
+            video_timeout = settings.EXTERNAL_CALLS['VIDEO_TIMEOUT'] - (time.monotonic() - started)
+            response_youtube = youtube_future.result(timeout=max(video_timeout, 0))
+        except BaseException as e:
+            logger.warning("video search failed for %s: %r", food_name, e)
+            response_youtube = None
+        get_write_queue().submit(self.create_food, food_name, response_youtube, recipe, ingredients)
+        return [{"Name": food_name, "link": response_youtube, "recipe": recipe}]
+
+    def stream_flight(self, food_name, ingredients, events):
+        """
+        Runs on the external executor, so the food is stored even if the client goes away.
+        Joins the flight of the food like the non-stream requests: the leader streams its parts,
+        the others get the finished item.
+
+        :param food_name: str, name of food
+        :param ingredients: list, list of ingredients in string
+        :param events: queue.Queue receiving the events of stream_recipe, then ("end", item) or ("error", message)
+        """
+        try:
+            ready_response = get_single_flight().do(
+                make_key("detail", food_name.lower()),
+                lambda: self.stream_recipe(food_name, ingredients, events)
+            )
         except BaseException as e:
             err = traceback.format_exc()
             logger.error(err)
+            ready_response = None
+        if ready_response:
+            events.put(("end", ready_response[0]))
+        else:
+            events.put(("error", "Something went wrong"))
+
+    def event_stream(self, food_name, ingredients, food=None):
+        """
+        Server-sent events of a food: "link" as soon as the video is found, "recipe" for every generated part
+        and "done" with the complete response item. When the food cannot be generated "degraded" with the answer
+        of degraded(), or "error" if there is none.
+
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        :param food: Food, stored food answered at once
+        :return: generator of str
+        """
+        if food:
+            item = self.food_response(food_name, food)
+            yield sse_event("link", item["link"])
+            yield sse_event("recipe", item["recipe"])
+            yield sse_event("done", item)
+            return
+
+        events = queue.Queue()
+        external_executor.submit(self.stream_flight, food_name, ingredients, events)
+
+        link_sent, recipe_sent = False, False
+        timeout = settings.EXTERNAL_CALLS['RECIPE_TIMEOUT'] + settings.EXTERNAL_CALLS['VIDEO_TIMEOUT']
+        while True:
+            try:
+                kind, value = events.get(timeout=timeout)
+            except queue.Empty:
+                kind, value = "error", "Something went wrong"
+            if kind == "link":
+                if not link_sent and value.exception() is None:
+                    link_sent = True
+                    yield sse_event("link", value.result())
+            elif kind == "recipe":
+                recipe_sent = True
+                yield sse_event("recipe", value)
+            elif kind == "end":
+                # requests following the flight of another one get the finished item only
+                if not link_sent:
+                    yield sse_event("link", value["link"])
+                if not recipe_sent:
+                    yield sse_event("recipe", value["recipe"])
+                yield sse_event("done", value)
+                return
+            else:
+                degraded = self.degraded(food_name, ingredients)
+                if degraded:
+                    yield sse_event("degraded", degraded)
+                else:
+                    yield sse_event("error", value)
+                return
 
     def post(self, request, *args, **kwargs):
         """
-        the function takes post request and proceeds for OPENAI and YouTube API
+        the function takes post request and proceeds for OPENAI and YouTube API,
+        with ?stream=1 the answer is streamed as server-sent events, see event_stream
         :param request: request data
         :return:  Response of status
         """
@@ -139,19 +428,32 @@ class DetailFood(APIView):
                 ingredients = [i.strip() for i in ingredients]
                 food_name = food_name.strip()
 
+                self.count_request(food_name, ingredients)
                 food_exists = self.get_food(food_name)
 
+                if request.query_params.get("stream"):
+                    response = StreamingHttpResponse(
+                        self.event_stream(food_name, ingredients, food_exists), content_type="text/event-stream"
+                    )
+                    response["Cache-Control"] = "no-cache"
+                    response["X-Accel-Buffering"] = "no"  # nginx forwards the events as they come
+                    return response
+
                 ready_response = []
 
                 if food_exists:
-                    ready_response.append({
-                        "Name": food_name,
-                        "link": food_exists.youtube_link,
-                        "recipe": food_exists.recipe
-                    })
+                    ready_response.append(self.food_response(food_name, food_exists))
                 else:
-                    ready_response = self.get_response_openai(food_name, ingredients)
+                    ready_response = get_single_flight().do(
+                        make_key("detail", food_name.lower()),
+                        lambda: self.get_or_generate(food_name, ingredients)
+                    )
 
+                if not ready_response:
+                    degraded = self.degraded(food_name, ingredients)
+                    if degraded:
+                        return Response(degraded)
+                    return Response(UNAVAILABLE, status=503, headers=retry_after_headers())
                 return Response({
                     "Ready Response": ready_response
                 })
@@ -162,3 +464,170 @@ class DetailFood(APIView):
         except BaseException as e:
             err = traceback.format_exc()
             logger.error(err)
+            return Response({"message": "Something went wrong"}, status=500)
+
+
+class BatchDetailFood(DetailFood):
+    """
+    DetailFood for several foods sharing the same ingredients in one request:
+    stored foods are read with one query and the missing ones are generated concurrently
+    """
+
+    def unique_names(self, food_names):
+        """
+        :param food_names: list, food names
+        :return: dict, stripped food name -> its UPPER(name) computed by the database, without blank names and
+                 case-insensitive duplicates, compared with Upper("name") like the name__iexact lookups
+        """
+        keys = upper_names([food_name.strip() for food_name in food_names], router.db_for_read(Food))
+        unique = {}
+        for food_name, key in keys.items():
+            if food_name:
+                unique.setdefault(key, food_name)
+        return {food_name: key for key, food_name in unique.items()}
+
+    def get_foods(self, keys):
+        """
+        :param keys: dict, food name -> its UPPER(name) of unique_names
+        :return: dict, food name -> stored food
+        """
+        foods = Food.objects.annotate(name_upper=Upper("name")).filter(name_upper__in=list(keys.values()))
+        foods = {food.name_upper: food for food in foods}
+        return {food_name: foods[key] for food_name, key in keys.items() if key in foods}
+
+    def generate(self, food_name, ingredients):
+        """
+        Runs on the batch executor
+
+        :param food_name: str, contains food name
+        :param ingredients: list, list of ingredients in string
+        :return: response generated from OpenAI and YouTube api, None on failure
+        """
+        try:
+            return get_single_flight().do(
+                make_key("detail", food_name.lower()),
+                lambda: self.get_or_generate(food_name, ingredients)
+            )
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+
+    def check_generations(self, request, count):
+        """
+        Charges the generations of the batch to the external quota, the request itself paid for the first one
+
+        :param request: rest_framework Request
+        :param count: int, number of foods to generate
+        :raises: Throttled when the quota of the user has fewer requests left
+        """
+        for throttle in self.get_throttles():
+            if hasattr(throttle, "allow_requests") and not throttle.allow_requests(request, self, count - 1):
+                raise exceptions.Throttled(throttle.wait())
+
+    def resolve(self, food_names, ingredients, foods):
+        """
+        :param food_names: list, food names without case-insensitive duplicates
+        :param ingredients: list, list of ingredients in string
+        :param foods: dict, stored foods of get_foods
+        :return: generator of (food name, response item or None on failure), stored foods first,
+                 then the generated ones as they complete
+        """
+        futures = {}
+        for food_name in food_names:
+            food = foods.get(food_name)
+            if food:
+                yield food_name, self.food_response(food_name, food)
+            else:
+                futures[batch_executor.submit(self.generate, food_name, ingredients)] = food_name
+
+        for future in as_completed(futures):
+            ready_response = future.result()
+            yield futures[future], ready_response[0] if ready_response else None
+
+    def stream_lines(self, food_names, ingredients, foods):
+        """
+        :return: generator of JSON lines, one response item or {"Name": ..., "error": ...} per food
+        """
+        for food_name, item in self.resolve(food_names, ingredients, foods):
+            yield json.dumps(item or {"Name": food_name, "error": "Something went wrong"}) + "\n"
+
+    def post(self, request, *args, **kwargs):
+        """
+        the function takes post request with "names" and "ingredients" and proceeds for OPENAI and YouTube API,
+        with ?stream=1 every food is sent as a JSON line as soon as it is ready
+        :param request: request data
+        :return:  Response of status
+        """
+        try:
+            food_names = self.request.data.get("names")
+            ingredients = self.request.data.get("ingredients")
+
+            if not (is_string_list(food_names) and is_string_list(ingredients)):
+                return Response({
+                    "message": "error, send names and ingredients with same key",
+                }, status=400)
+            if len(food_names) > settings.EXTERNAL_CALLS['BATCH_MAX_FOODS']:
+                return Response({
+                    "message": "error, send at most {} names".format(settings.EXTERNAL_CALLS['BATCH_MAX_FOODS']),
+                }, status=400)
+
+            ingredients = [i.strip() for i in ingredients]
+            keys = self.unique_names(food_names)
+            food_names = list(keys)
+            foods = self.get_foods(keys)
+            self.check_generations(request, len([food_name for food_name in food_names if food_name not in foods]))
+            for food_name in food_names:
+                self.count_request(food_name, ingredients)
+
+            if request.query_params.get("stream"):
+                response = StreamingHttpResponse(
+                    self.stream_lines(food_names, ingredients, foods), content_type="application/x-ndjson"
+                )
+                response["X-Accel-Buffering"] = "no"
+                return response
+
+            items = dict(self.resolve(food_names, ingredients, foods))
+            return Response({
+                "Ready Response": [items[food_name] for food_name in food_names if items[food_name]],
+                "Failed": [food_name for food_name in food_names if not items[food_name]],
+            })
+        except exceptions.Throttled:
+            raise
+        except BaseException as e:
+            err = traceback.format_exc()
+            logger.error(err)
+            return Response({"message": "Something went wrong"}, status=500)
+
+
+def component_gauges():
+    """
+    :return: list of (name, labels, value) gauges of the caches, write queue, rate limiters and circuit breakers
+    """
+    gauges = []
+    for alias, cache in sorted(all_caches().items()):
+        for key, value in cache.stats().items():
+            gauges.append(("riga_idea_cache_{}".format(key), {"cache": alias}, value))
+    for key, value in get_write_queue().stats().items():
+        gauges.append(("riga_idea_write_queue_{}".format(key), {}, value))
+    for alias, limiter in sorted(all_rate_limiters().items()):
+        for key, value in limiter.stats().items():
+            gauges.append(("riga_idea_rate_limit_{}".format(key), {"upstream": alias}, value))
+    for alias, breaker in sorted(all_circuit_breakers().items()):
+        stats = breaker.stats()
+        state = stats.pop("state")
+        gauges.append(("riga_idea_circuit_open", {"upstream": alias}, int(state != "closed")))
+        for key, value in stats.items():
+            gauges.append(("riga_idea_circuit_{}".format(key), {"upstream": alias}, value))
+    return gauges
+
+
+def metrics(request):
+    """
+    Metrics of the worker serving the request in the Prometheus text format, labelled with its pid
+    :param request: the HTTP request, with "Authorization: Bearer <METRICS TOKEN>" unless METRICS['PUBLIC'] is set
+    :return: HttpResponse, 403 without the token
+    """
+    authorization = request.headers.get("Authorization", "")
+    if not settings.METRICS['PUBLIC'] and not is_metrics_token(authorization.removeprefix("Bearer ")):
+        return HttpResponse(status=403)
+    return HttpResponse(registry.render(component_gauges()), content_type="text/plain; version=0.0.4")
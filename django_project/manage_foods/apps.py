@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class ManageFoodsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'manage_foods'
+
+    def ready(self):
+        from . import signals  # noqa: F401
@@ -0,0 +1,303 @@
+"""
+Bulk import and export of the catalog as NDJSON or CSV.
+
+Imports read the rows lazily and write them chunk by chunk, every chunk in one transaction: the ingredient names of a
+chunk are resolved with one IngredientManager.bulk_get_or_create, foods matching a stored food by case-insensitive
+name are updated with bulk_update and the others created with bulk_create. Bulk writes send no signals, so every
+chunk refreshes the search vectors, the cached versions and the catalog version itself, see manage_foods.signals.
+Exports page through the table by id, memory stays constant for any number of rows.
+"""
+import codecs
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models.functions import Upper
+from django.utils import timezone
+
+from .models import Food, Ingredient, upper_names
+from .object_cache import forget_versions, refresh_catalog_version, refresh_versions
+from .search import update_search_vectors
+
+FORMATS = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+FOOD_FIELDS = ("name", "origin_continent", "origin_country", "recipe", "youtube_link", "image")
+INGREDIENT_FIELDS = ("name",)
+INGREDIENTS_FIELD = "main_ingredients"
+# separates the ingredient names of a food in a CSV cell
+CSV_SEPARATOR = "|"
+
+
+def decode_lines(readline):
+    """
+    :param readline: callable returning the next line of bytes, b"" at the end
+    :return: generator of str lines, a leading byte order mark is skipped
+    """
+    return codecs.iterdecode(iter(readline, b""), "utf-8-sig")
+
+
+def read_rows(lines, fmt):
+    """
+    :param lines: iterable of str lines
+    :param fmt: "ndjson" or "csv"
+    :return: generator of (line number, dict or None, error message or None), unreadable input ends it with an error
+    """
+    number = 0
+    try:
+        if fmt == "csv":
+            reader = csv.DictReader(lines)
+            for row in reader:
+                number = reader.line_num
+                yield number, row, None
+            return
+        for number, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                yield number, None, "invalid JSON: {}".format(e)
+                continue
+            yield number, row, None if isinstance(row, dict) else "a row must be an object"
+    except (UnicodeDecodeError, csv.Error) as e:
+        yield number + 1, None, "unreadable input: {}".format(e)
+
+
+def _clean_text(model, row, field, fmt):
+    value = row[field]
+    if fmt == "csv" and value == "":
+        # CSV cannot tell empty from missing, exports write None as an empty cell
+        value = None
+    if value is not None and not isinstance(value, str):
+        raise ValueError("{} must be a string".format(field))
+    max_length = model._meta.get_field(field).max_length
+    if value is not None and max_length and len(value) > max_length:
+        raise ValueError("{} is longer than {} characters".format(field, max_length))
+    return value
+
+
+def clean_food(row, fmt):
+    """
+    :param row: dict read by read_rows
+    :param fmt: "ndjson" or "csv"
+    :return: (dict of the food fields present in the row, list of ingredient names or None if not present)
+    :raises ValueError: if the row is not a valid food
+    """
+    if not isinstance(row.get("name"), str) or not row["name"].strip():
+        raise ValueError("name is required")
+    values = {field: _clean_text(Food, row, field, fmt) for field in FOOD_FIELDS if field in row}
+    values["name"] = values["name"].strip()
+    names = row.get(INGREDIENTS_FIELD)
+    if fmt == "csv" and names is not None:
+        names = names.split(CSV_SEPARATOR) if names else []
+    if names is not None:
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise ValueError("{} must be a list of names".format(INGREDIENTS_FIELD))
+        names = [name.strip() for name in names if name.strip()]
+        max_length = Ingredient._meta.get_field("name").max_length
+        for name in names:
+            if len(name) > max_length:
+                raise ValueError("ingredient {!r} is longer than {} characters".format(name, max_length))
+    return values, names
+
+
+def clean_ingredient(row, fmt):
+    """
+    :param row: dict read by read_rows
+    :param fmt: "ndjson" or "csv"
+    :return: str, name of the ingredient
+    :raises ValueError: if the row is not a valid ingredient
+    """
+    if not isinstance(row.get("name"), str) or not row["name"].strip():
+        raise ValueError("name is required")
+    return _clean_text(Ingredient, row, "name", fmt).strip()
+
+
+def _insert_links(pairs):
+    """
+    Inserts links of foods to ingredients with multi-row INSERTs, building a model instance per link for
+    bulk_create costs more than the INSERT itself
+
+    :param pairs: list of (food id, ingredient id)
+    """
+    Through = Food.main_ingredients.through
+    connection = connections[router.db_for_write(Through)]
+    qn = connection.ops.quote_name
+    sql = "INSERT INTO {} ({}, {}) VALUES ".format(
+        qn(Through._meta.db_table), qn(Through._meta.get_field("food").column),
+        qn(Through._meta.get_field("ingredient").column),
+    )
+    batch_size = settings.CATALOG_BULK["BATCH_SIZE"]
+    if connection.features.max_query_params:
+        batch_size = min(batch_size, connection.features.max_query_params // 2)
+    with connection.cursor() as cursor:
+        for i in range(0, len(pairs), batch_size):
+            batch = pairs[i:i + batch_size]
+            cursor.execute(sql + ", ".join(["(%s, %s)"] * len(batch)), [value for pair in batch for value in pair])
+
+
+def _write_foods(chunk):
+    """
+    :param chunk: list of (food fields, ingredient names or None), the last row of a name wins
+    :return: (number of created foods, number of updated foods, number of foods already equal to their row)
+    """
+    batch_size = settings.CATALOG_BULK["BATCH_SIZE"]
+    Through = Food.main_ingredients.through
+
+    with transaction.atomic():
+        # names are compared with the UPPER of the database, like the lookups of the stored foods below
+        keys = upper_names([values["name"] for values, _ in chunk], router.db_for_write(Food))
+        rows = {}
+        for values, names in chunk:
+            rows[keys[values["name"]]] = (values, names)
+        ingredients = Ingredient.objects.resolve([name for _, names in rows.values() for name in names or ()])
+        stored = Food.objects.annotate(name_upper=Upper("name")).filter(name_upper__in=list(rows))
+        stored = {food.name_upper: food for food in stored}
+        stored_links = {}
+        pairs = Through.objects.filter(food_id__in=[food.pk for food in stored.values()])
+        for food_id, ingredient_id in pairs.values_list("food_id", "ingredient_id"):
+            stored_links.setdefault(food_id, set()).add(ingredient_id)
+
+        created, updated, links, fields, unchanged, now = [], [], [], set(), 0, timezone.now()
+        for key, (values, names) in rows.items():
+            # the ingredients of a row replace the ones of the food, rows without the column keep them
+            ingredient_ids = {ingredients[name].pk for name in names} if names is not None else None
+            food = stored.get(key)
+            if food is None:
+                food = Food(**values)
+                created.append(food)
+            else:
+                changed = [field for field, value in values.items() if getattr(food, field) != value]
+                if ingredient_ids == stored_links.get(food.pk, set()):
+                    ingredient_ids = None
+                if not changed and ingredient_ids is None:
+                    # re-imports of an unchanged catalog write nothing
+                    unchanged += 1
+                    continue
+                for field in changed:
+                    setattr(food, field, values[field])
+                food.updated_at = now
+                fields.update(changed)
+                updated.append(food)
+            if ingredient_ids is not None:
+                links.append((food, ingredient_ids))
+        Food.objects.bulk_create(created, batch_size=batch_size)
+        if updated:
+            Food.objects.bulk_update(updated, list(fields) + ["updated_at"], batch_size=batch_size)
+        Through.objects.filter(food_id__in=[food.pk for food, _ in links if food.pk in stored_links]).delete()
+        _insert_links([(food.pk, pk) for food, ingredient_ids in links for pk in ingredient_ids])
+
+        created_ids, updated_ids = [food.pk for food in created], [food.pk for food in updated]
+        if created_ids or updated_ids:
+            update_search_vectors(Food.objects.filter(pk__in=created_ids + updated_ids))
+            transaction.on_commit(lambda: forget_versions(Food, created_ids))
+            transaction.on_commit(lambda: refresh_versions(Food, updated_ids))
+            transaction.on_commit(refresh_catalog_version)
+    return len(created), len(updated), unchanged
+
+
+def _write_ingredients(names):
+    """
+    :param names: list of ingredient names
+    :return: (number of created ingredients, 0, number of ingredients already stored), names are never updated
+    """
+    with transaction.atomic():
+        keys = set(upper_names(names, router.db_for_write(Ingredient)).values())
+        stored = Ingredient.objects.annotate(name_upper=Upper("name")).filter(name_upper__in=list(keys)).count()
+        Ingredient.objects.bulk_get_or_create(names)
+        if stored < len(keys):
+            transaction.on_commit(refresh_catalog_version)
+    return len(keys) - stored, 0, stored
+
+
+def import_rows(model, rows, fmt, chunk_size=None, progress=None):
+    """
+    Imports rows of foods or ingredients, invalid rows are skipped and reported
+
+    :param model: Food or Ingredient
+    :param rows: generator of read_rows
+    :param fmt: "ndjson" or "csv"
+    :param chunk_size: int, rows per transaction, CATALOG_BULK['CHUNK_SIZE'] by default
+    :param progress: callable receiving the result after every chunk, optional
+    :return: dict, numbers of rows, created, updated, unchanged (already stored as in the row) and failed rows,
+             and the first CATALOG_BULK['MAX_ERRORS'] errors as {"line", "message"}
+    """
+    chunk_size = chunk_size or settings.CATALOG_BULK["CHUNK_SIZE"]
+    clean, write = (clean_food, _write_foods) if model is Food else (clean_ingredient, _write_ingredients)
+    result = {"rows": 0, "created": 0, "updated": 0, "unchanged": 0, "failed": 0, "errors": []}
+
+    def flush(chunk):
+        for key, count in zip(("created", "updated", "unchanged"), write(chunk)):
+            result[key] += count
+        if progress is not None:
+            progress(result)
+
+    chunk = []
+    for number, row, error in rows:
+        result["rows"] += 1
+        if error is None:
+            try:
+                chunk.append(clean(row, fmt))
+            except ValueError as e:
+                error = str(e)
+        if error is not None:
+            result["failed"] += 1
+            if len(result["errors"]) < settings.CATALOG_BULK["MAX_ERRORS"]:
+                result["errors"].append({"line": number, "message": error})
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk:
+        flush(chunk)
+    return result
+
+
+def export_rows(model, chunk_size=None):
+    """
+    :param model: Food or Ingredient
+    :param chunk_size: int, rows per query, CATALOG_BULK['CHUNK_SIZE'] by default
+    :return: generator of dicts in the import format, ordered by id
+    """
+    chunk_size = chunk_size or settings.CATALOG_BULK["CHUNK_SIZE"]
+    fields = FOOD_FIELDS if model is Food else INGREDIENT_FIELDS
+    last = 0
+    while True:
+        rows = list(model.objects.filter(pk__gt=last).order_by("pk").values("pk", *fields)[:chunk_size])
+        if not rows:
+            return
+        last = rows[-1]["pk"]
+        if model is Food:
+            names = {row["pk"]: [] for row in rows}
+            links = Food.main_ingredients.through.objects.filter(food_id__in=list(names)).order_by("food_id", "id")
+            for food_id, name in links.values_list("food_id", "ingredient__name"):
+                names[food_id].append(name)
+        for row in rows:
+            pk = row.pop("pk")
+            if model is Food:
+                row[INGREDIENTS_FIELD] = names[pk]
+            yield row
+
+
+def render_rows(rows, model, fmt):
+    """
+    :param rows: generator of export_rows
+    :param model: Food or Ingredient
+    :param fmt: "ndjson" or "csv"
+    :return: generator of str, one line per row after the CSV header
+    """
+    if fmt == "ndjson":
+        for row in rows:
+            yield json.dumps(row, ensure_ascii=False) + "\n"
+        return
+    fields = FOOD_FIELDS + (INGREDIENTS_FIELD,) if model is Food else INGREDIENT_FIELDS
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields)
+    writer.writeheader()
+    for row in rows:
+        if model is Food:
+            row[INGREDIENTS_FIELD] = CSV_SEPARATOR.join(row[INGREDIENTS_FIELD])
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
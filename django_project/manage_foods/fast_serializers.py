@@ -0,0 +1,199 @@
+"""
+Read-only fast path of the large catalog responses.
+
+FoodSerializer(foods, many=True) builds a model instance and runs every DRF field of every row, which dominates the
+CPU time of listings with thousands of foods. FoodValuesSerializer reads the same columns with .values(), the
+ingredient ids with ArrayAgg on PostgreSQL (with one more query elsewhere), and converts the few column types of the
+catalog itself. FastJSONRenderer renders the resulting plain dicts with orjson. Both produce the same bytes as the
+serializers and JSONRenderer they stand in for; views opt in with FastSerializationMixin.
+"""
+from functools import lru_cache
+
+import orjson
+from django.contrib.postgres.aggregates import ArrayAgg
+from django.db import connections, models
+from django.db.models import Q
+from rest_framework import serializers
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Food, Ingredient
+from .search import is_postgres
+from .serializers import IngredientSerializer
+
+
+def _converters(model, names):
+    """
+    :param model: Food or Ingredient
+    :param names: names of the serializer fields, all of them model columns
+    :return: list of (name, callable or None), the callable turns a .values() value into the serializer value
+    """
+    datetime_field = serializers.DateTimeField()
+    converters = []
+    for name in names:
+        field = model._meta.get_field(name)
+        converter = None
+        if isinstance(field, models.DateTimeField):
+            converter = datetime_field.to_representation
+        elif isinstance(field, models.FileField):
+            # ImageField of a serializer without request: the relative url of the file
+            converter = (lambda value, storage=field.storage: storage.url(value) if value else None)
+        converters.append((name, converter))
+    return converters
+
+
+def _chunks(values, size):
+    values = list(values)
+    size = size or len(values) or 1
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _convert(row, converters):
+    return {
+        name: (converter(row[name]) if converter is not None and row[name] is not None else row[name])
+        for name, converter in converters
+    }
+
+
+class FoodValuesSerializer:
+    """
+    Renders foods like serializer_class(foods, many=True).data from .values() rows
+
+    :param serializer_class: FoodSerializer or NestedFoodSerializer, gives the fields and their order
+    """
+    ingredients_field = "main_ingredients"
+    ids_annotation = "ingredient_ids"
+
+    def __init__(self, serializer_class):
+        fields = serializer_class().fields
+        self.names = list(fields)
+        self.nested = isinstance(fields[self.ingredients_field], serializers.ListSerializer)
+        self.columns = [name for name in self.names if name != self.ingredients_field]
+        self.converters = dict(_converters(Food, self.columns))
+        self.ingredient_converters = _converters(Ingredient, list(IngredientSerializer().fields))
+
+    def values(self, queryset):
+        """
+        :param queryset: Food queryset, not sliced
+        :return: the queryset as dicts of the serialized columns, with the ingredient ids on PostgreSQL
+        """
+        if not is_postgres(queryset.db):
+            return queryset.values(*self.columns)
+        ids = ArrayAgg(
+            "main_ingredients__id", filter=Q(main_ingredients__isnull=False), ordering="main_ingredients__id"
+        )
+        return queryset.annotate(**{self.ids_annotation: ids}).values(*self.columns, self.ids_annotation)
+
+    def to_representation(self, rows, using="default"):
+        """
+        :param rows: dicts of values(), a list or a cursor page
+        :param using: database of the rows
+        :return: list of dicts equal to serializer_class(foods, many=True).data
+        """
+        rows = list(rows)
+        if rows and self.ids_annotation in rows[0]:
+            ingredient_ids = {row["id"]: row[self.ids_annotation] or [] for row in rows}
+        else:
+            ingredient_ids = self.ingredient_ids([row["id"] for row in rows], using)
+        if self.nested:
+            # every ingredient is read and converted once, however many foods share it
+            ingredients = self.ingredients({pk for ids in ingredient_ids.values() for pk in ids}, using)
+        data = []
+        for row in rows:
+            food = {}
+            for name in self.names:
+                if name == self.ingredients_field:
+                    ids = ingredient_ids[row["id"]]
+                    food[name] = [ingredients[pk] for pk in ids] if self.nested else list(ids)
+                else:
+                    value, converter = row[name], self.converters[name]
+                    food[name] = converter(value) if converter is not None and value is not None else value
+            data.append(food)
+        return data
+
+    def iterate(self, queryset, chunk_size):
+        """
+        :param queryset: Food queryset, not sliced
+        :param chunk_size: rows per query
+        :return: generator of the serialized foods, memory stays constant for any number of rows
+        """
+        chunk = []
+        for row in self.values(queryset).iterator(chunk_size=chunk_size):
+            chunk.append(row)
+            if len(chunk) == chunk_size:
+                yield from self.to_representation(chunk, queryset.db)
+                chunk = []
+        yield from self.to_representation(chunk, queryset.db)
+
+    @staticmethod
+    def ingredient_ids(food_ids, using="default"):
+        """
+        :param food_ids: list of food ids
+        :param using: database of the foods
+        :return: dict, food id -> list of its ingredient ids in ascending order
+        """
+        ingredient_ids = {pk: [] for pk in food_ids}
+        through = Food.main_ingredients.through.objects.using(using)
+        for chunk in _chunks(ingredient_ids, connections[using].features.max_query_params):
+            pairs = through.filter(food_id__in=chunk).order_by("food_id", "ingredient_id")
+            for food_id, ingredient_id in pairs.values_list("food_id", "ingredient_id"):
+                ingredient_ids[food_id].append(ingredient_id)
+        return ingredient_ids
+
+    def ingredients(self, pks, using="default"):
+        """
+        :param pks: ids of the ingredients
+        :param using: database of the ingredients
+        :return: dict, ingredient id -> ingredient serialized like IngredientSerializer
+        """
+        names = [name for name, _ in self.ingredient_converters]
+        ingredients = {}
+        for chunk in _chunks(pks, connections[using].features.max_query_params):
+            for row in Ingredient.objects.using(using).filter(pk__in=chunk).values(*names):
+                ingredients[row["id"]] = _convert(row, self.ingredient_converters)
+        return ingredients
+
+
+@lru_cache(maxsize=None)
+def values_serializer(serializer_class):
+    """
+    :param serializer_class: FoodSerializer or NestedFoodSerializer
+    :return: FoodValuesSerializer of the serializer, built once
+    """
+    return FoodValuesSerializer(serializer_class)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer rendering with orjson. The compact unicode output JSONRenderer defaults to is rendered to the same
+    bytes; indented output and data orjson cannot encode the same way fall back to JSONRenderer.
+    """
+    options = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_PASSTHROUGH_DATACLASS
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        indent = self.get_indent(accepted_media_type, renderer_context or {})
+        if indent is None and self.compact and not self.ensure_ascii and self.strict:
+            try:
+                ret = orjson.dumps(data, default=JSONEncoder().default, option=self.options)
+            except TypeError:
+                pass
+            else:
+                # same escapes as JSONRenderer, the characters end lines in JavaScript
+                return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+        return super().render(data, accepted_media_type, renderer_context)
+
+
+class FastSerializationMixin:
+    """
+    Mixin of the catalog APIViews taking the fast path: list_response reads rows with FoodValuesSerializer and
+    JSON is rendered by FastJSONRenderer
+    """
+    fast_serialization = True
+
+    def get_renderers(self):
+        return [
+            FastJSONRenderer() if type(renderer) is JSONRenderer else renderer for renderer in super().get_renderers()
+        ]
@@ -0,0 +1,62 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:12
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.functions.text
+
+
+def _duplicate_groups(model):
+    """
+    :return: list of lists of ids of rows with the same case-insensitive name, oldest first
+    """
+    upper = django.db.models.functions.text.Upper('name')
+    keys = (model.objects.annotate(name_upper=upper).values('name_upper')
+            .annotate(count=Count('id')).filter(count__gt=1).values_list('name_upper', flat=True))
+    return [
+        list(model.objects.annotate(name_upper=upper).filter(name_upper=key).order_by('id').values_list('id', flat=True))
+        for key in keys
+    ]
+
+
+def dedupe_names(apps, schema_editor):
+    """
+    Merges foods and ingredients that differ only by case into the oldest row
+    """
+    Food = apps.get_model('manage_foods', 'Food')
+    Ingredient = apps.get_model('manage_foods', 'Ingredient')
+    Through = Food.main_ingredients.through
+
+    for keep, *duplicates in _duplicate_groups(Ingredient):
+        linked = set(Through.objects.filter(ingredient_id=keep).values_list('food_id', flat=True))
+        for row in Through.objects.filter(ingredient_id__in=duplicates):
+            if row.food_id not in linked:
+                Through.objects.create(food_id=row.food_id, ingredient_id=keep)
+                linked.add(row.food_id)
+        Ingredient.objects.filter(id__in=duplicates).delete()
+
+    for keep, *duplicates in _duplicate_groups(Food):
+        linked = set(Through.objects.filter(food_id=keep).values_list('ingredient_id', flat=True))
+        for row in Through.objects.filter(food_id__in=duplicates):
+            if row.ingredient_id not in linked:
+                Through.objects.create(food_id=keep, ingredient_id=row.ingredient_id)
+                linked.add(row.ingredient_id)
+        Food.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_foods', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_names, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='food',
+            index=models.Index(django.db.models.functions.text.Upper('name'), name='food_name_upper_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Upper('name'), name='ingredient_name_upper_uniq'),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.1.6 on 2026-10-18 10:39
+
+import django.contrib.postgres.search
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.operations import TrigramExtension
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations
+from django.db.models import OuterRef, Subquery
+
+
+def create_search_indexes(apps, schema_editor):
+    """
+    GIN indexes of the search vector and of the name trigrams, then the vectors of the stored foods.
+    The other databases have neither tsvector nor pg_trgm, manage_foods.search falls back to LIKE there.
+    """
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    schema_editor.execute(
+        'CREATE INDEX food_search_vector_idx ON manage_foods_food USING gin (search_vector)'
+    )
+    schema_editor.execute(
+        'CREATE INDEX food_name_trgm_idx ON manage_foods_food USING gin (name gin_trgm_ops)'
+    )
+    # the expression of manage_foods.search.search_document as of this migration
+    Food = apps.get_model('manage_foods', 'Food')
+    config = getattr(settings, 'FOOD_SEARCH', {}).get('CONFIG', 'english')
+    ingredients = Subquery(
+        Food.main_ingredients.through.objects.filter(food_id=OuterRef('pk'))
+        .values('food_id')
+        .annotate(names=StringAgg('ingredient__name', ' '))
+        .values('names')
+    )
+    Food.objects.update(search_vector=(
+        SearchVector('name', weight='A', config=config)
+        + SearchVector(ingredients, weight='B', config=config)
+        + SearchVector('recipe', weight='C', config=config)
+    ))
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS food_search_vector_idx')
+    schema_editor.execute('DROP INDEX IF EXISTS food_name_trgm_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_foods', '0002_name_upper_indexes'),
+    ]
+
+    operations = [
+        TrigramExtension(),
+        migrations.AddField(
+            model_name='food',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
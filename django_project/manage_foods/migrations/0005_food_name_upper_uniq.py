@@ -0,0 +1,44 @@
+# Generated by Django 4.1.6 on 2026-10-18 17:05
+
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.functions.text
+
+
+def dedupe_food_names(apps, schema_editor):
+    """
+    Merges the foods stored since migration 0002 that differ only by case into the oldest row
+    """
+    Food = apps.get_model('manage_foods', 'Food')
+    Through = Food.main_ingredients.through
+    upper = django.db.models.functions.text.Upper('name')
+    keys = (Food.objects.annotate(name_upper=upper).values('name_upper')
+            .annotate(count=Count('id')).filter(count__gt=1).values_list('name_upper', flat=True))
+    for key in list(keys):
+        keep, *duplicates = (Food.objects.annotate(name_upper=upper).filter(name_upper=key)
+                             .order_by('id').values_list('id', flat=True))
+        linked = set(Through.objects.filter(food_id=keep).values_list('ingredient_id', flat=True))
+        for row in Through.objects.filter(food_id__in=duplicates):
+            if row.ingredient_id not in linked:
+                Through.objects.create(food_id=keep, ingredient_id=row.ingredient_id)
+                linked.add(row.ingredient_id)
+        Food.objects.filter(id__in=duplicates).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('manage_foods', '0004_catalogversion'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedupe_food_names, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='food',
+            name='food_name_upper_idx',
+        ),
+        migrations.AddConstraint(
+            model_name='food',
+            constraint=models.UniqueConstraint(django.db.models.functions.text.Upper('name'), name='food_name_upper_uniq'),
+        ),
+    ]
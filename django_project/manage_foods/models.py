@@ -1,4 +1,15 @@
-from django.db import models
+from django.contrib.postgres.search import SearchVectorField
+from django.db import IntegrityError, connections, models, router, transaction
+from django.db.models import F
+from django.db.models.functions import Upper
+from django.utils import timezone
+
+
+class FoodManager(models.Manager):
+
+    def get_queryset(self):
+        # the search vector is only read by the database, see manage_foods.search
+        return super().get_queryset().defer("search_vector")
 
 
 class Food(models.Model):
@@ -11,15 +22,130 @@ class Food(models.Model):
     youtube_link = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # name, ingredient names and recipe, kept up to date on PostgreSQL by manage_foods.signals
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    objects = FoodManager()
+
+    class Meta:
+        # one food per name regardless of case, its index serves name__iexact lookups, which compare UPPER(name),
+        # the GIN indexes of the search are created by migration 0003 on PostgreSQL only
+        constraints = [
+            models.UniqueConstraint(Upper("name"), name="food_name_upper_uniq"),
+        ]
 
     def __str__(self):
         return self.name
 
 
+def upper_names(names, using):
+    """
+    :param names: list of str
+    :param using: alias of the database
+    :return: dict, name -> UPPER(name) computed by the database, which unlike str.upper() only changes ASCII letters
+             on SQLite: comparing these with Upper("name") agrees with the lookups and constraints on Upper("name")
+    """
+    connection = connections[using]
+    names = list(dict.fromkeys(names))
+    # one column per name, far below the limits of the select lists of SQLite and PostgreSQL
+    size = min(500, connection.features.max_query_params or 500)
+    keys = {}
+    with connection.cursor() as cursor:
+        for i in range(0, len(names), size):
+            chunk = names[i:i + size]
+            cursor.execute("SELECT {}".format(", ".join(["UPPER(%s)"] * len(chunk))), chunk)
+            keys.update(zip(chunk, cursor.fetchone()))
+    return keys
+
+
+class IngredientManager(models.Manager):
+
+    def resolve(self, names):
+        """
+        Resolves ingredients by case-insensitive name with a constant number of queries per 500 names
+
+        :param names: list, names of ingredients
+        :return: dict, every given name -> its Ingredient, the missing ones are created
+        """
+        using = router.db_for_write(self.model)
+        keys = upper_names([n for n in names if n], using)
+        unique = {}
+        for n, key in keys.items():
+            unique.setdefault(key, n)
+        found = self._by_upper_name(unique, using)
+        missing = [n for key, n in unique.items() if key not in found]
+        if missing:
+            self.bulk_create([self.model(name=n) for n in missing], ignore_conflicts=True)
+            found.update(self._by_upper_name([keys[n] for n in missing], using))
+        return {n: found[key] for n, key in keys.items() if key in found}
+
+    def bulk_get_or_create(self, names):
+        """
+        Resolves ingredients by case-insensitive name with a constant number of queries
+
+        :param names: list, names of ingredients
+        :return: list of Ingredient in the order of the first occurrence of each name
+        """
+        resolved = self.resolve(names)
+        ingredients = {}
+        for n in names:
+            if n in resolved:
+                ingredients.setdefault(resolved[n].pk, resolved[n])
+        return list(ingredients.values())
+
+    def _by_upper_name(self, keys, using):
+        queryset = self.using(using).annotate(name_upper=Upper("name")).filter(name_upper__in=list(keys))
+        return {i.name_upper: i for i in queryset}
+
+
 class Ingredient(models.Model):
     name = models.CharField(max_length=120)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    objects = IngredientManager()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(Upper("name"), name="ingredient_name_upper_uniq"),
+        ]
+
     def __str__(self):
         return self.name
+
+
+class CatalogVersionManager(models.Manager):
+    CATALOG = "catalog"
+
+    def current(self):
+        """
+        :return: CatalogVersion of the catalog, version 0 without updated_at before the first write
+        """
+        return self.filter(name=self.CATALOG).first() or self.model(name=self.CATALOG, version=0)
+
+    def bump(self):
+        """
+        Counts a write of foods, ingredients or their links, read by the conditional GETs of manage_foods.views
+        """
+        if self.filter(name=self.CATALOG).update(version=F("version") + 1, updated_at=timezone.now()):
+            return
+        try:
+            with transaction.atomic():
+                self.create(name=self.CATALOG, version=1, updated_at=timezone.now())
+        except IntegrityError:
+            # created by a concurrent write
+            self.filter(name=self.CATALOG).update(version=F("version") + 1, updated_at=timezone.now())
+
+
+class CatalogVersion(models.Model):
+    """
+    Number of writes to the catalog and the time of the latest one
+    """
+    name = models.CharField(max_length=50, unique=True)
+    version = models.PositiveBigIntegerField(default=0)
+    updated_at = models.DateTimeField(null=True)
+
+    objects = CatalogVersionManager()
+
+    def __str__(self):
+        return "{} v{}".format(self.name, self.version)
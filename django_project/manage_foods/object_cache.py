@@ -0,0 +1,136 @@
+"""
+Read-through cache of rendered catalog responses.
+
+Every row has a version, the updated_at of its latest committed change, and the catalog as a whole has the
+CatalogVersion counter for the listings. Versions are kept in the shared 'catalog_versions' cache: writers refresh
+them from the database once their transaction is committed (manage_foods.signals), readers only add a missing one,
+so a reader that loaded a row just before a write can never hide the write. Responses are cached under the version
+they were rendered at in the 'catalog_objects' cache; they never change, so it is local to every worker and a write
+never has to find and delete them.
+
+Versions and the responses cached under them are read from the primary database, a lagging replica would cache
+the old rows under the new version for good.
+"""
+from django.core.cache import caches
+from django.http import HttpResponse
+
+from main_app.components.cache import make_key
+from main_app.components.db_router import primary_reads
+from main_app.components.metrics import registry
+
+from .models import CatalogVersion
+
+# version of a deleted row, keeps readers that loaded the row before the delete from adding its old version
+DELETED = "deleted"
+
+registry.describe("riga_idea_catalog_cache_total", "Catalog responses served from or added to the object cache")
+
+
+def _version_key(model, pk):
+    return "{}:{}".format(model._meta.label_lower, pk)
+
+
+def get_version(model, pk):
+    """
+    :param model: Food or Ingredient
+    :param pk: primary key of the row
+    :return: datetime, updated_at of the row, None if it does not exist
+    """
+    versions = caches["catalog_versions"]
+    key = _version_key(model, pk)
+    version = versions.get(key)
+    if version is None:
+        with primary_reads():
+            version = model.objects.filter(pk=pk).values_list("updated_at", flat=True).first()
+        if version is None:
+            return None
+        # a version refreshed by a writer in the meantime is newer, keep it
+        versions.add(key, version)
+    return None if version == DELETED else version
+
+
+def _read_versions(model, pks):
+    with primary_reads():
+        versions = dict(model.objects.filter(pk__in=pks).values_list("pk", "updated_at"))
+    return {pk: versions.get(pk, DELETED) for pk in pks}
+
+
+def refresh_versions(model, pks):
+    """
+    Reads the versions of the rows from the database into the cache, called once the write is committed.
+    Reading and writing are two steps, so a writer that read before a later write committed can overwrite the newer
+    version cached by the later writer. Every writer therefore reads the versions again after writing them and
+    writes the ones that changed meanwhile, until they were still current once written: the last writer to finish
+    leaves the latest versions in the cache.
+
+    :param model: Food or Ingredient
+    :param pks: iterable of primary keys of written or deleted rows
+    """
+    pks = set(pks)
+    versions = _read_versions(model, pks) if pks else {}
+    while versions:
+        caches["catalog_versions"].set_many({_version_key(model, pk): version for pk, version in versions.items()})
+        current = _read_versions(model, list(versions))
+        versions = {pk: version for pk, version in current.items() if version != versions[pk]}
+
+
+def forget_versions(model, pks):
+    """
+    Drops the cached versions of created rows, called once the write is committed. A created row has none unless
+    its id belonged to a deleted row before, readers never add the version of a missing row.
+
+    :param model: Food or Ingredient
+    :param pks: iterable of primary keys of created rows
+    """
+    caches["catalog_versions"].delete_many([_version_key(model, pk) for pk in pks])
+
+
+def get_catalog_version():
+    """
+    :return: (int, datetime or None), number of writes to the catalog and the time of the latest one
+    """
+    versions = caches["catalog_versions"]
+    version = versions.get(CatalogVersion.objects.CATALOG)
+    if version is None:
+        with primary_reads():
+            current = CatalogVersion.objects.current()
+        version = (current.version, current.updated_at)
+        versions.add(CatalogVersion.objects.CATALOG, version)
+    return version
+
+
+def refresh_catalog_version():
+    """
+    Bumps the catalog version and reads it into the cache, called once the write is committed
+    """
+    CatalogVersion.objects.bump()
+    current = CatalogVersion.objects.current()
+    caches["catalog_versions"].set(CatalogVersion.objects.CATALOG, (current.version, current.updated_at))
+
+
+def cached_body(request, parts, build):
+    """
+    Answers a GET of a catalog view with the response rendered earlier for the same version, or renders it
+
+    :param request: the DRF request, after content negotiation
+    :param parts: json serializable parts of the key, the version of every row the response shows included
+    :param build: callable returning the Response to render on a miss, it reads from the primary
+    :return: HttpResponse with the rendered JSON, or the Response of build for other renderers
+    """
+    renderer = request.accepted_renderer
+    if renderer.format != "json":
+        return build()
+    bodies = caches["catalog_objects"]
+    key = make_key(request.accepted_media_type, *parts)
+    body = bodies.get(key)
+    if body is None:
+        with primary_reads():
+            response = build()
+        if response.status_code != 200:
+            return response
+        body = renderer.render(response.data, request.accepted_media_type, {"request": request})
+        bodies.set(key, body)
+        registry.inc("riga_idea_catalog_cache_total", result="miss")
+    else:
+        registry.inc("riga_idea_catalog_cache_total", result="hit")
+    return HttpResponse(body, content_type=renderer.media_type)
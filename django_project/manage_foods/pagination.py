@@ -0,0 +1,51 @@
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from rest_framework.pagination import CursorPagination
+from rest_framework.utils.encoders import JSONEncoder
+
+
+class CatalogCursorPagination(CursorPagination):
+    """
+    Keyset pagination of catalog listings by id with opaque cursors
+    """
+    ordering = "id"
+    page_size = settings.CATALOG_PAGINATION["PAGE_SIZE"]
+    page_size_query_param = "page_size"
+    max_page_size = settings.CATALOG_PAGINATION["MAX_PAGE_SIZE"]
+
+    @classmethod
+    def is_requested(cls, request):
+        """
+        Listings stay unpaginated unless the client asks for a page
+
+        :param request: the HTTP request
+        :return: True if a cursor or a page size was sent
+        """
+        return cls.cursor_query_param in request.GET or cls.page_size_query_param in request.GET
+
+
+def stream_json_array(queryset, serializer_class, values_serializer=None):
+    """
+    Renders a queryset as a JSON array chunk by chunk, memory stays constant for any number of rows
+
+    :param queryset: rows to render
+    :param serializer_class: serializer of a single row
+    :param values_serializer: FoodValuesSerializer rendering the rows instead of serializer_class, optional
+    :return: StreamingHttpResponse with the JSON array
+    """
+    chunk_size = settings.CATALOG_PAGINATION["STREAM_CHUNK_SIZE"]
+    queryset = queryset.order_by("id")
+    if values_serializer is not None:
+        rows = values_serializer.iterate(queryset, chunk_size)
+    else:
+        rows = (serializer_class(obj).data for obj in queryset.iterator(chunk_size=chunk_size))
+
+    def render():
+        yield "["
+        for i, data in enumerate(rows):
+            yield ("," if i else "") + json.dumps(data, cls=JSONEncoder)
+        yield "]"
+
+    return StreamingHttpResponse(render(), content_type="application/json")
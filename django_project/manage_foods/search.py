@@ -0,0 +1,117 @@
+"""
+Search of stored foods by name, ingredient names and recipe.
+
+On PostgreSQL a query is matched against Food.search_vector (GIN index) and, for typos, against the trigram
+similarity of the name (pg_trgm GIN index); both indexes are combined by one bitmap scan, so only matching rows
+are ranked. Other databases get a LIKE and difflib fallback, meant for tests and development.
+"""
+import difflib
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector, TrigramSimilarity
+from django.db import connections
+from django.db.models import F, FloatField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from .models import Food
+
+
+def is_postgres(using="default"):
+    return connections[using].vendor == "postgresql"
+
+
+def search_document(model=Food):
+    """
+    :param model: Food model, the historical one in migrations
+    :return: expression of the search vector of a food: name (A), ingredient names (B) and recipe (C)
+    """
+    config = settings.FOOD_SEARCH["CONFIG"]
+    ingredients = Subquery(
+        model.main_ingredients.through.objects.filter(food_id=OuterRef("pk"))
+        .values("food_id")
+        .annotate(names=StringAgg("ingredient__name", " "))
+        .values("names")
+    )
+    return (
+        SearchVector("name", weight="A", config=config)
+        + SearchVector(ingredients, weight="B", config=config)
+        + SearchVector("recipe", weight="C", config=config)
+    )
+
+
+def update_search_vectors(queryset):
+    """
+    Recomputes the search vectors of the foods in one UPDATE, nothing to do on other databases
+
+    :param queryset: foods to update
+    :return: int, number of updated foods
+    """
+    if not is_postgres(queryset.db):
+        return 0
+    return queryset.update(search_vector=search_document(queryset.model))
+
+
+def search_food_ids(query, limit=None):
+    """
+    :param query: str, words of a name, ingredients or recipe, web search syntax ("-word", "quoted phrase", or)
+    :param limit: int, maximum number of results, FOOD_SEARCH['MAX_RESULTS'] by default
+    :return: list of ids of the matching foods, most relevant first
+    """
+    limit = limit or settings.FOOD_SEARCH["MAX_RESULTS"]
+    query = " ".join(query.split())
+    if not query:
+        return []
+
+    if is_postgres():
+        search_query = SearchQuery(query, search_type="websearch", config=settings.FOOD_SEARCH["CONFIG"])
+        # foods matched by the name trigrams only may have no vector yet
+        rank = Coalesce(SearchRank(F("search_vector"), search_query), Value(0.0), output_field=FloatField())
+        foods = (
+            Food.objects.filter(Q(search_vector=search_query) | Q(name__trigram_similar=query))
+            .annotate(score=rank + TrigramSimilarity("name", query))
+            .order_by("-score", "id")
+        )
+        return list(foods.values_list("id", flat=True)[:limit])
+
+    matches = Food.objects.all()
+    for word in query.split():
+        matches = matches.filter(
+            Q(name__icontains=word) | Q(recipe__icontains=word) | Q(main_ingredients__name__icontains=word)
+        )
+    ids = list(matches.order_by("id").values_list("id", flat=True).distinct()[:limit])
+    if ids:
+        return ids
+    names = dict(Food.objects.values_list("name", "id"))
+    close = difflib.get_close_matches(query.lower(), [name.lower() for name in names], n=limit,
+                                      cutoff=settings.FOOD_SEARCH["MIN_SIMILARITY"])
+    by_lower = {name.lower(): pk for name, pk in names.items()}
+    return [by_lower[name] for name in close]
+
+
+def find_similar_food(name, min_similarity=None):
+    """
+    :param name: str, name of a requested food
+    :param min_similarity: float between 0 and 1, FOOD_SEARCH['DUPLICATE_SIMILARITY'] by default
+    :return: the stored food with a recipe whose name is the most similar to name, None if none is similar enough
+    """
+    if min_similarity is None:
+        min_similarity = settings.FOOD_SEARCH["DUPLICATE_SIMILARITY"]
+    if min_similarity is None or not name.strip():
+        return None
+    foods = Food.objects.exclude(recipe=None)
+
+    if is_postgres():
+        return (
+            foods.filter(name__trigram_similar=name)
+            .annotate(similarity=TrigramSimilarity("name", name))
+            .filter(similarity__gte=min_similarity)
+            .order_by("-similarity", "id")
+            .first()
+        )
+
+    names = {}
+    for pk, food_name in foods.order_by("id").values_list("id", "name"):
+        names.setdefault(food_name.lower(), pk)
+    close = difflib.get_close_matches(name.lower(), list(names), n=1, cutoff=min_similarity)
+    return Food.objects.get(pk=names[close[0]]) if close else None
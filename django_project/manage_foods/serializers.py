@@ -1,3 +1,4 @@
+from django.db.models import Prefetch
 from rest_framework import serializers
 from .models import Food, Ingredient
 
@@ -5,10 +6,61 @@ from .models import Food, Ingredient
 class FoodSerializer(serializers.ModelSerializer):
     class Meta:
         model = Food
-        fields = "__all__"
+        exclude = ("search_vector",)
+
+    def validate_name(self, value):
+        """
+        Food names are unique regardless of case.
+
+        :param value: name of the food
+        :return: the name if no other food has it
+        """
+        queryset = Food.objects.filter(name__iexact=value)
+        if self.instance is not None:
+            queryset = queryset.exclude(pk=self.instance.pk)
+        if queryset.exists():
+            raise serializers.ValidationError("Food with this name already exists.")
+        return value
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        """
+        Loads the ingredient ids of all foods with one query instead of one query per food.
+
+        :param queryset: Food queryset
+        :return: the queryset with main_ingredients prefetched
+        """
+        return queryset.prefetch_related(
+            Prefetch("main_ingredients", queryset=Ingredient.objects.only("id"))
+        )
 
 
 class IngredientSerializer(serializers.ModelSerializer):
     class Meta:
         model = Ingredient
         fields = "__all__"
+
+    def validate_name(self, value):
+        """
+        Ingredient names are unique regardless of case.
+
+        :param value: name of the ingredient
+        :return: the name if no other ingredient has it
+        """
+        queryset = Ingredient.objects.filter(name__iexact=value)
+        if self.instance is not None:
+            queryset = queryset.exclude(pk=self.instance.pk)
+        if queryset.exists():
+            raise serializers.ValidationError("Ingredient with this name already exists.")
+        return value
+
+
+class NestedFoodSerializer(FoodSerializer):
+    """
+    FoodSerializer rendering main_ingredients as ingredient objects instead of ids
+    """
+    main_ingredients = IngredientSerializer(many=True, read_only=True)
+
+    @staticmethod
+    def setup_eager_loading(queryset):
+        return queryset.prefetch_related("main_ingredients")
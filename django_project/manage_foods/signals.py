@@ -0,0 +1,89 @@
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
+from django.dispatch import receiver
+from django.utils import timezone
+
+from .models import Food, Ingredient
+from .object_cache import refresh_catalog_version, refresh_versions
+from .search import is_postgres, search_document, update_search_vectors
+
+
+def _catalog_changed():
+    """
+    Bumps the catalog version once the write is committed, readers never see the new version with old rows
+    """
+    transaction.on_commit(refresh_catalog_version)
+
+
+def _rows_changed(model, pks):
+    """
+    Refreshes the cached versions of the rows once the write is committed, see manage_foods.object_cache
+    """
+    pks = list(pks)
+    transaction.on_commit(lambda: refresh_versions(model, pks))
+
+
+def _foods_changed(food_ids):
+    """
+    Foods whose ingredients changed: their updated_at, which their ETags derive from, and their search vectors
+    """
+    food_ids = list(food_ids)
+    if food_ids:
+        values = {"updated_at": timezone.now()}
+        if is_postgres():
+            values["search_vector"] = search_document()
+        Food.objects.filter(pk__in=food_ids).update(**values)
+        _rows_changed(Food, food_ids)
+
+
+def _foods_changed_on_commit(ingredient):
+    """
+    Same as _foods_changed for the foods of an ingredient being removed, they are not known anymore after it
+    """
+    food_ids = list(ingredient.food_set.values_list("id", flat=True))
+    transaction.on_commit(lambda: _foods_changed(food_ids))
+
+
+@receiver(post_save, sender=Food)
+def food_saved(sender, instance, **kwargs):
+    if is_postgres():
+        update_search_vectors(Food.objects.filter(pk=instance.pk))
+    _rows_changed(Food, [instance.pk])
+    _catalog_changed()
+
+
+@receiver(post_delete, sender=Food)
+def food_deleted(sender, instance, **kwargs):
+    _rows_changed(Food, [instance.pk])
+    _catalog_changed()
+
+
+@receiver(post_save, sender=Ingredient)
+def ingredient_saved(sender, instance, created, **kwargs):
+    if not created:
+        _foods_changed(instance.food_set.values_list("id", flat=True))
+    _rows_changed(Ingredient, [instance.pk])
+    _catalog_changed()
+
+
+@receiver(pre_delete, sender=Ingredient)
+def ingredient_deleting(sender, instance, **kwargs):
+    _foods_changed_on_commit(instance)
+
+
+@receiver(post_delete, sender=Ingredient)
+def ingredient_deleted(sender, instance, **kwargs):
+    _rows_changed(Ingredient, [instance.pk])
+    _catalog_changed()
+
+
+@receiver(m2m_changed, sender=Food.main_ingredients.through)
+def food_ingredients_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == "pre_clear" and reverse:
+        _foods_changed_on_commit(instance)
+    elif action in ("post_add", "post_remove"):
+        _foods_changed(pk_set if reverse else [instance.pk])
+    elif action == "post_clear" and not reverse:
+        _foods_changed([instance.pk])
+    if action in ("post_add", "post_remove", "post_clear"):
+        _catalog_changed()
@@ -1,9 +1,25 @@
-from django.test import Client, TestCase
+import io
+import json
+import tempfile
+from decimal import Decimal
+from importlib import import_module
+
+from django.apps import apps as django_apps
+from django.conf import settings
+from django.core.management import call_command
+from django.core.cache import caches
+from django.db import IntegrityError, connection, transaction
+from django.test import Client, TestCase, override_settings
+from django.utils import timezone
+from unittest import mock
 from auth_app.models import User
 from rest_framework import status
+from rest_framework.renderers import JSONRenderer
 from rest_framework.test import APIClient
-from .models import Food, Ingredient
-from .serializers import FoodSerializer
+from .fast_serializers import FastJSONRenderer, FoodValuesSerializer
+from .models import CatalogVersion, Food, Ingredient
+from . import object_cache
+from .serializers import FoodSerializer, NestedFoodSerializer
 from django.urls import reverse
 
 
@@ -17,6 +33,8 @@ class TestCaseFoodApi(TestCase):
         Setup function for test case
         initializing necessary pre-steps
         """
+        caches["catalog_versions"].clear()
+        caches["catalog_objects"].clear()
         self.client = Client()
         self.cred = {
             'email': "testuser@gmail.com",
@@ -89,3 +107,391 @@ class TestCaseFoodApi(TestCase):
         self.valid_payload['main_ingredients'] = [self.ingredient.id]
         response = self.client.post('/api/foods/list/', data=self.invalid_payload, content_type='application/json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_get_foods_by_cursor(self):
+        """
+        Test for walking the food list page by page with cursors
+        """
+        for i in range(4):
+            Food.objects.create(name=f'Food {i + 2}')
+        names = []
+        url = '/api/foods/list?page_size=2'
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            page = response.json()
+            self.assertLessEqual(len(page['results']), 2)
+            names += [food['name'] for food in page['results']]
+            url = page['next']
+        self.assertEqual(names, [food.name for food in Food.objects.order_by('id')])
+
+    def test_stream_foods(self):
+        """
+        Test for streaming all foods as one JSON array
+        """
+        Food.objects.create(name='Food 2')
+        response = self.client.get('/api/foods/list?stream=1')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(b''.join(response.streaming_content))
+        self.assertEqual(data, FoodSerializer(Food.objects.order_by('id'), many=True).data)
+
+    def test_food_list_query_count(self):
+        """
+        Test that listing foods costs the same number of queries for any number of foods
+        """
+        for i in range(10):
+            food = Food.objects.create(name=f'Food {i + 2}')
+            food.main_ingredients.add(self.ingredient)
+        # session, user, catalog version, foods, ingredients of all foods
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/foods/list')
+        self.assertEqual(len(response.data), 11)
+        self.assertEqual(response.data[1]['main_ingredients'], [self.ingredient.id])
+        # the catalog version is cached now, ingredients are read once however many foods share them
+        with self.assertNumQueries(5):
+            response = self.client.get('/api/foods/list?expand=ingredients')
+        self.assertEqual(response.data[1]['main_ingredients'][0]['name'], self.ingredient.name)
+
+
+class TestCaseIngredientNames(TestCase):
+    """
+    Test case for case-insensitive names of foods and ingredients
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        self.client = Client()
+        self.user = User.objects.create_superuser(email="testuser@gmail.com", password="password")
+        self.client.login(email="testuser@gmail.com", password="password")
+        self.ingredient = Ingredient.objects.create(name='Egg')
+
+    def test_create_duplicate_ingredient(self):
+        """
+        Test that an ingredient differing only by case is rejected
+        """
+        response = self.client.post('/api/foods/ingredient', data={'name': 'egg'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Ingredient.objects.create(name='EGG')
+
+    def test_create_duplicate_food(self):
+        """
+        Test that a food differing only by case is rejected
+        """
+        Food.objects.create(name='Omelette')
+        response = self.client.post('/api/foods/list', data={'name': 'OMELETTE'}, content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Food.objects.create(name='omelette')
+
+    def test_bulk_get_or_create(self):
+        """
+        Test that existing ingredients are matched regardless of case and missing ones are created once
+        """
+        ingredients = Ingredient.objects.bulk_get_or_create(['egg', 'Milk', 'milk', 'Flour'])
+        self.assertEqual([i.name for i in ingredients], ['Egg', 'Milk', 'Flour'])
+        self.assertEqual(ingredients[0], self.ingredient)
+        self.assertEqual(Ingredient.objects.count(), 3)
+
+    def test_bulk_get_or_create_accents(self):
+        """
+        Test that names with non-ASCII letters are matched the way the database compares them
+        """
+        stored = Ingredient.objects.create(name='jalapeño')
+        self.assertEqual(Ingredient.objects.bulk_get_or_create(['Jalapeño', 'Crème fraîche']),
+                         [stored, Ingredient.objects.get(name='Crème fraîche')])
+        self.assertEqual(Ingredient.objects.resolve(['JALAPEñO'])['JALAPEñO'], stored)
+
+    def test_dedupe_foods(self):
+        """
+        Test that the migrations merge foods differing only by case into the oldest one
+        """
+        # rows stored before the constraint, dropped for this test only
+        with connection.cursor() as cursor:
+            cursor.execute('DROP INDEX food_name_upper_uniq')
+        milk = Ingredient.objects.create(name='Milk')
+        first = Food.objects.create(name='Omelette')
+        first.main_ingredients.add(self.ingredient)
+        second = Food.objects.create(name='omelette')
+        second.main_ingredients.add(self.ingredient, milk)
+
+        import_module('manage_foods.migrations.0002_name_upper_indexes').dedupe_names(django_apps, None)
+        self.assertEqual(list(Food.objects.all()), [first])
+        self.assertEqual(set(first.main_ingredients.all()), {self.ingredient, milk})
+
+        third = Food.objects.create(name='OMELETTE')
+        third.main_ingredients.add(self.ingredient)
+        import_module('manage_foods.migrations.0005_food_name_upper_uniq').dedupe_food_names(django_apps, None)
+        self.assertEqual(list(Food.objects.all()), [first])
+
+
+class TestCaseFoodSearch(TestCase):
+    """
+    Test case for the food search API
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        caches["catalog_versions"].clear()
+        caches["catalog_objects"].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_user(email="testuser@gmail.com", password="password"))
+        basil = Ingredient.objects.create(name="Basil")
+        self.pesto = Food.objects.create(name="Pesto Pasta", recipe="Blend the basil with pine nuts")
+        self.pesto.main_ingredients.add(basil)
+        self.soup = Food.objects.create(name="Tomato Soup", recipe="Simmer the tomatoes")
+        self.soup.main_ingredients.add(basil)
+
+    def search(self, query, **params):
+        response = self.client.get('/api/foods/search', {"q": query, **params})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        return [food["name"] for food in response.json()]
+
+    def test_search_fields(self):
+        """
+        Test that names, ingredient names and recipes are searched
+        """
+        self.assertEqual(self.search("soup"), ["Tomato Soup"])
+        self.assertEqual(self.search("basil"), ["Pesto Pasta", "Tomato Soup"])
+        self.assertEqual(self.search("pine nuts"), ["Pesto Pasta"])
+        self.assertEqual(self.search("basil", limit=1), ["Pesto Pasta"])
+
+    def test_search_typo(self):
+        """
+        Test that a misspelled name still finds the food
+        """
+        self.assertEqual(self.search("tomatto soup"), ["Tomato Soup"])
+
+    def test_search_without_query(self):
+        """
+        Test that a query is required
+        """
+        response = self.client.get('/api/foods/search')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestCaseConditionalGet(TestCase):
+    """
+    Test case for ETags and conditional GETs of the catalog API
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        caches["catalog_versions"].clear()
+        caches["catalog_objects"].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(email="testuser@gmail.com", password="password"))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food = Food.objects.create(name="Pesto Pasta", recipe="Blend")
+            self.basil = Ingredient.objects.create(name="Basil")
+
+    @mock.patch("manage_foods.views.FoodSerializer")
+    def test_list_not_modified(self, serializer):
+        """
+        Test that a matching If-None-Match is answered with 304 without queries, until the catalog changes
+        """
+        serializer.side_effect = FoodSerializer
+        response = self.client.get('/api/foods/list')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertIn('Last-Modified', response)
+        etag = response['ETag']
+
+        serializer.reset_mock()
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/foods/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+        serializer.assert_not_called()
+        self.assertNotEqual(self.client.get('/api/foods/list?page_size=1')['ETag'], etag)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.basil.name = "Thai Basil"
+            self.basil.save()
+        response = self.client.get('/api/foods/list', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_detail_not_modified(self):
+        """
+        Test that the ETag of a food changes when its ingredients change
+        """
+        url = f'/api/foods/detail/{self.food.pk}/'
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, status.HTTP_304_NOT_MODIFIED)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.food.main_ingredients.add(self.basil)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['main_ingredients'], [self.basil.pk])
+
+    def test_stream_not_cached(self):
+        """
+        Test that streams get no ETag
+        """
+        response = self.client.get('/api/foods/list?stream=1')
+        self.assertNotIn('ETag', response)
+
+    @mock.patch("manage_foods.views.FoodSerializer")
+    def test_detail_cached(self, serializer):
+        """
+        Test that a food is rendered once per version and an update is seen as soon as it is committed
+        """
+        serializer.side_effect = FoodSerializer
+        url = f'/api/foods/detail/{self.food.pk}/'
+        self.assertEqual(self.client.get(url).json()['recipe'], "Blend")
+        serializer.reset_mock()
+        with self.assertNumQueries(0):
+            response = self.client.get(url)
+        self.assertEqual(response.json()['recipe'], "Blend")
+        serializer.assert_not_called()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(url, {"name": "Pesto Pasta", "recipe": "Blend well", "main_ingredients": [self.basil.pk]}, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(self.client.get(url).json()['recipe'], "Blend well")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(url)
+        self.assertEqual(self.client.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_refresh_versions_race(self):
+        """
+        Test that a writer which read a version before a later write committed leaves the latest version cached
+        """
+        stale = self.food.updated_at - timezone.timedelta(minutes=1)
+        current = object_cache._read_versions(Food, [self.food.pk])
+        # the first read of the writer happened before the later write, the next ones see it
+        with mock.patch.object(object_cache, "_read_versions", side_effect=[{self.food.pk: stale}, current, current]):
+            object_cache.refresh_versions(Food, [self.food.pk])
+        self.assertEqual(object_cache.get_version(Food, self.food.pk), self.food.updated_at)
+
+
+class TestCaseFastSerialization(TestCase):
+    """
+    Test case for the .values() and orjson path of the catalog listings
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        basil = Ingredient.objects.create(name="Basil")
+        garlic = Ingredient.objects.create(name="Garlic")
+        pesto = Food.objects.create(name="Pesto \u2028 Genovese \u00e9", recipe="Blend\n\"well\"",
+                                    image="food_images/pesto.jpg")
+        pesto.main_ingredients.add(basil, garlic)
+        Food.objects.create(name="Plain", origin_country="")
+
+    def test_same_bytes(self):
+        """
+        Test that both serializers are rendered to the same bytes as by the DRF serializer and JSONRenderer
+        """
+        foods = Food.objects.order_by("id")
+        for serializer_class in (FoodSerializer, NestedFoodSerializer):
+            fast = FoodValuesSerializer(serializer_class)
+            data = serializer_class(serializer_class.setup_eager_loading(foods), many=True).data
+            self.assertEqual(FastJSONRenderer().render(fast.to_representation(fast.values(foods))),
+                             JSONRenderer().render(data))
+
+    def test_renderer_fallback(self):
+        """
+        Test that data and options orjson does not handle like JSONRenderer are rendered by JSONRenderer
+        """
+        data = {"price": Decimal("1.50"), "at": timezone.now(), 1: "key"}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        data = {"name": "Basil"}
+        self.assertEqual(FastJSONRenderer().render(data, "application/json; indent=2"),
+                         JSONRenderer().render(data, "application/json; indent=2"))
+
+
+class TestCaseBulk(TestCase):
+    """
+    Test case for the bulk import and export of the catalog
+    """
+
+    def setUp(self):
+        """
+        Setup function for test case
+        initializing necessary pre-steps
+        """
+        caches["catalog_versions"].clear()
+        caches["catalog_objects"].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create_superuser(email="testuser@gmail.com", password="password"))
+        self.basil = Ingredient.objects.create(name="Basil")
+        self.pesto = Food.objects.create(name="Pesto", recipe="Blend")
+        self.pesto.main_ingredients.add(self.basil)
+
+    @override_settings(CATALOG_BULK={**settings.CATALOG_BULK, 'CHUNK_SIZE': 2})
+    def test_import_ndjson(self):
+        """
+        Test that foods are matched by name, ingredients resolved by name and invalid rows reported
+        """
+        body = "\n".join([
+            json.dumps({"name": "pesto", "recipe": "Blend well", "main_ingredients": ["basil", "Garlic"]}),
+            json.dumps({"name": "Soup", "main_ingredients": ["Garlic", "Tomato"]}),
+            "{broken",
+            json.dumps({"recipe": "no name"}),
+            json.dumps({"name": "Salad"}),
+            json.dumps({"name": "Salsa", "main_ingredients": ["Jalapeño"]}),
+            json.dumps({"name": "Stew", "main_ingredients": ["x" * 121]}),
+        ])
+        jalapeno = Ingredient.objects.create(name="jalapeño")
+        version = CatalogVersion.objects.current().version
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/foods/bulk/foods', body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual({key: response.data[key] for key in ("rows", "created", "updated", "failed")},
+                         {"rows": 7, "created": 3, "updated": 1, "failed": 3})
+        self.assertEqual([error["line"] for error in response.data["errors"]], [3, 4, 7])
+
+        self.pesto.refresh_from_db()
+        self.assertEqual(self.pesto.recipe, "Blend well")
+        self.assertEqual(sorted(i.name for i in self.pesto.main_ingredients.all()), ["Basil", "Garlic"])
+        soup = Food.objects.get(name="Soup")
+        self.assertEqual(sorted(i.name for i in soup.main_ingredients.all()), ["Garlic", "Tomato"])
+        self.assertEqual(list(Food.objects.get(name="Salsa").main_ingredients.all()), [jalapeno])
+        self.assertEqual(Ingredient.objects.count(), 4)
+        self.assertGreater(CatalogVersion.objects.current().version, version)
+
+    def test_csv_round_trip(self):
+        """
+        Test that an exported catalog imports back to the same rows
+        """
+        Food.objects.create(name="Soup, with \"quotes\"", recipe="Line 1\nLine 2", origin_country="Latvia")
+        response = self.client.get('/api/foods/bulk/foods?fmt=csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        exported = b''.join(response.streaming_content)
+
+        Food.objects.all().delete()
+        with tempfile.NamedTemporaryFile(suffix=".csv") as f:
+            f.write(exported)
+            f.flush()
+            call_command("import_catalog", f.name, stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(Food.objects.count(), 2)
+        self.assertEqual(b''.join(self.client.get('/api/foods/bulk/foods?fmt=csv').streaming_content), exported)
+        ndjson = b''.join(self.client.get('/api/foods/bulk/foods').streaming_content).decode().splitlines()
+        self.assertEqual(json.loads(ndjson[0])["main_ingredients"], ["Basil"])
+
+    def test_bulk_forbidden(self):
+        """
+        Test that only superusers import and export
+        """
+        self.client.force_authenticate(User.objects.create_user(email="user@gmail.com", password="password"))
+        self.assertEqual(self.client.get('/api/foods/bulk/ingredients').status_code, status.HTTP_403_FORBIDDEN)
+        response = self.client.post('/api/foods/bulk/ingredients', '{"name": "Salt"}',
+                                    content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(Ingredient.objects.filter(name="Salt").exists())
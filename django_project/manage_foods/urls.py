@@ -3,9 +3,13 @@ from .views import *
 
 urlpatterns = [
     re_path(r'list/?$', FoodList.as_view(), name='food_list'),
+    re_path(r'search/?$', FoodSearch.as_view(), name='food_search'),
     path('detail/<int:pk>/', FoodDetail.as_view(), name='food_detail'),
 
     re_path(r'ingredient/?$', IngredientList.as_view(), name='ingredient_list'),
     path('ingredient/<int:pk>/', IngredientDetail.as_view(), name='ingredient_detail'),
 
+    re_path(r'bulk/foods/?$', BulkFoods.as_view(), name='bulk_foods'),
+    re_path(r'bulk/ingredients/?$', BulkIngredients.as_view(), name='bulk_ingredients'),
+
 ]
\ No newline at end of file
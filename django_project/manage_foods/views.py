@@ -2,18 +2,175 @@ from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from .models import Food, Ingredient
-from .serializers import FoodSerializer, IngredientSerializer
-from django.http import Http404
+from .serializers import FoodSerializer, NestedFoodSerializer, IngredientSerializer
+from .pagination import CatalogCursorPagination, stream_json_array
+from .fast_serializers import FastSerializationMixin, values_serializer
+from .search import search_food_ids
+from .object_cache import cached_body, get_catalog_version, get_version
+from . import bulk
+from contextlib import nullcontext
+from functools import wraps
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
+from main_app.components.cache import make_key
+from main_app.components.db_router import primary_reads
+from main_app.components.metrics import span
 
 
-class FoodList(APIView):
+def food_serializer_class(request):
+    """
+    :param request: the HTTP request
+    :return: NestedFoodSerializer for expand=ingredients, FoodSerializer otherwise
+    """
+    if request.GET.get('expand') == 'ingredients':
+        return NestedFoodSerializer
+    return FoodSerializer
+
+
+def catalog_version(request):
+    """
+    :param request: the HTTP request
+    :return: (int, datetime or None), version of the catalog, read once per request
+    """
+    if not hasattr(request, '_catalog_version'):
+        request._catalog_version = get_catalog_version()
+    return request._catalog_version
+
+
+def list_etag(request, *args, **kwargs):
+    """
+    :return: ETag of a listing, it changes with every write to the catalog, None for streams
+    """
+    if request.GET.get('stream'):
+        return None
+    return make_key(request.path, catalog_version(request)[0], sorted(request.GET.lists()))
+
+
+def list_last_modified(request, *args, **kwargs):
+    """
+    :return: time of the latest write to the catalog, None for streams
+    """
+    if request.GET.get('stream'):
+        return None
+    return catalog_version(request)[1]
+
+
+def row_version(request, model, pk):
+    """
+    :param request: the HTTP request
+    :param model: Food or Ingredient
+    :param pk: primary key of the row
+    :return: datetime, version of the row read once per request, None if it does not exist
+    """
+    if not hasattr(request, '_row_version'):
+        request._row_version = get_version(model, pk)
+    return request._row_version
+
+
+def row_conditions(model):
+    """
+    :param model: Food or Ingredient
+    :return: (etag function, last modified function) of the detail view of a row, from its version alone
+    """
+    def updated_at(request, pk=None):
+        return row_version(request, model, pk) if pk is not None else None
+
+    def etag(request, pk=None):
+        modified = updated_at(request, pk)
+        if modified:
+            return make_key(request.path, modified.isoformat(), sorted(request.GET.lists()))
+
+    return etag, updated_at
+
+
+def http_cache(etag_func, last_modified_func):
+    """
+    Conditional GET of a catalog view: a request with a matching If-None-Match or If-Modified-Since is answered
+    with 304 before the view queries and serializes anything. Clients revalidate every time (Cache-Control),
+    nginx serves the response from its cache for CATALOG_HTTP_CACHE['PROXY_MAX_AGE'] seconds (X-Accel-Expires).
+    Responses with an ETag are read from the primary database, a lagging replica would tag old rows as new.
+
+    :param etag_func: callable (request, *args, **kwargs) returning the ETag, None to skip the conditions
+    :param last_modified_func: callable (request, *args, **kwargs) returning the time of the latest change
+    :return: decorator of the get method of an APIView
+    """
+    def decorator(func):
+        conditional = condition(etag_func=etag_func, last_modified_func=last_modified_func)(func)
+
+        @wraps(func)
+        def inner(request, *args, **kwargs):
+            reads = primary_reads() if etag_func(request, *args, **kwargs) is not None else nullcontext()
+            with reads:
+                response = conditional(request, *args, **kwargs)
+            if response.status_code in (200, 304) and response.has_header('ETag'):
+                response['Cache-Control'] = settings.CATALOG_HTTP_CACHE['CACHE_CONTROL']
+                response['X-Accel-Expires'] = str(settings.CATALOG_HTTP_CACHE['PROXY_MAX_AGE'])
+            return response
+
+        return inner
+
+    return method_decorator(decorator)
+
+
+def list_response(view, request, queryset, serializer_class):
+    """
+    Serializes a catalog listing as a whole, as a cursor page or as a stream.
+
+    :param view: the APIView handling the request, FastSerializationMixin views skip the serializer
+    :param request: the HTTP request
+    :param queryset: rows of the listing
+    :param serializer_class: serializer of a single row
+    :return: a Response, or a StreamingHttpResponse for stream=1
+    """
+    fast = values_serializer(serializer_class) if getattr(view, 'fast_serialization', False) else None
+    if request.GET.get('stream'):
+        if not request.user.is_superuser:
+            return Response({"message": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+        if fast is None and hasattr(serializer_class, 'setup_eager_loading'):
+            queryset = serializer_class.setup_eager_loading(queryset)
+        return stream_json_array(queryset, serializer_class, fast)
+
+    def serialize(rows):
+        with span("serialize.catalog"):
+            if fast is not None:
+                return fast.to_representation(rows, queryset.db)
+            return serializer_class(rows, many=True).data
+
+    if fast is not None:
+        rows = fast.values(queryset)
+    elif hasattr(serializer_class, 'setup_eager_loading'):
+        rows = serializer_class.setup_eager_loading(queryset)
+    else:
+        rows = queryset
+    if CatalogCursorPagination.is_requested(request):
+        def build():
+            paginator = CatalogCursorPagination()
+            page = paginator.paginate_queryset(rows, request, view=view)
+            return paginator.get_paginated_response(serialize(page))
+
+        # pages are cached, whole listings can be too large
+        return cached_body(request, (request.path, catalog_version(request)[0], sorted(request.GET.lists())), build)
+    return Response(serialize(rows))
+
+
+food_etag, food_last_modified = row_conditions(Food)
+ingredient_etag, ingredient_last_modified = row_conditions(Ingredient)
+
+
+class FoodList(FastSerializationMixin, APIView):
     """
     The `FoodList` class is an APIView that provides a list of Food objects in a RESTful API.
     """
 
+    @http_cache(list_etag, list_last_modified)
     def get(self, request):
         """
         Retrieve a list of Food objects.
+        Sending `cursor` or `page_size` returns a page, `stream=1` streams every food (superusers only),
+        `expand=ingredients` renders ingredients as objects.
 
         :param request: The request object that contains the GET parameters.
         :return: A Response object with the serialized Food objects.
@@ -23,8 +180,7 @@ class FoodList(APIView):
             foods = Food.objects.filter(name__iexact=name)
         else:
             foods = Food.objects.all()
-        serializer = FoodSerializer(foods, many=True)
-        return Response(serializer.data)
+        return list_response(self, request, foods, food_serializer_class(request))
 
     def post(self, request):
         """
@@ -43,6 +199,40 @@ class FoodList(APIView):
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+class FoodSearch(FastSerializationMixin, APIView):
+    """
+    Full-text search of foods by name, ingredients and recipe, tolerant to typos in names
+    """
+
+    @http_cache(list_etag, list_last_modified)
+    def get(self, request):
+        """
+        Retrieve the foods matching `q`, most relevant first.
+        `limit` caps the number of results, `expand=ingredients` renders ingredients as objects.
+
+        :param request: The request object that contains the GET parameters.
+        :return: A Response object with the serialized Food objects.
+        """
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return Response({"message": "Please provide a search query q."}, status=status.HTTP_400_BAD_REQUEST)
+        try:
+            limit = min(max(int(request.GET.get('limit', 0)), 0), settings.CATALOG_PAGINATION["MAX_PAGE_SIZE"])
+        except ValueError:
+            return Response({"message": "limit must be a number."}, status=status.HTTP_400_BAD_REQUEST)
+
+        def build():
+            with span("db.search"):
+                ids = search_food_ids(query, limit=limit)
+            fast = values_serializer(food_serializer_class(request))
+            foods = sorted(fast.values(Food.objects.filter(pk__in=ids)), key=lambda food: ids.index(food['id']))
+            with span("serialize.catalog"):
+                data = fast.to_representation(foods)
+            return Response(data)
+
+        return cached_body(request, (request.path, catalog_version(request)[0], sorted(request.GET.lists())), build)
+
+
 class FoodDetail(APIView):
     """
     This class provides the ability to retrieve, update, and delete food items by their name or primary key.
@@ -62,22 +252,27 @@ class FoodDetail(APIView):
         except Food.DoesNotExist:
             raise Http404
 
+    @http_cache(food_etag, food_last_modified)
     def get(self, request, pk=None):
         """
         This method retrieves a food item by its name or primary key.
         If neither a name nor a pk is provided, a 400 error is returned.
+        Sending `expand=ingredients` renders ingredients as objects.
 
         :param request: the HTTP request
         :param pk: the primary key of the food item (optional)
-        :return: a serialized representation of the food item
+        :return: a serialized representation of the food item, rendered once per version of the food
         """
-        if pk is not None:
-            food = self.get_object(pk)
-        else:
+        if pk is None:
             return Response({"message": "Please provide either a name or a pk for the food."},
                             status=status.HTTP_400_BAD_REQUEST)
-        serializer = FoodSerializer(food)
-        return Response(serializer.data)
+        version = row_version(request, Food, pk)
+        if version is None:
+            raise Http404
+        return cached_body(
+            request, ("food", pk, version.isoformat(), request.GET.get('expand')),
+            lambda: Response(food_serializer_class(request)(self.get_object(pk)).data)
+        )
 
     def put(self, request, pk):
         """
@@ -116,7 +311,7 @@ class FoodDetail(APIView):
             return Response({"message": "You do not have permission to perform this action."},
                             status=status.HTTP_401_UNAUTHORIZED)
         try:
-            item = self.get_object()
+            item = self.get_object(pk)
             item.delete()
             return Response({"message": "The item was successfully deleted."}, status=status.HTTP_204_NO_CONTENT)
         except Exception as ex:
@@ -133,11 +328,13 @@ class IngredientList(APIView):
     POST requests are only allowed for superusers, and create a new ingredient.
     """
 
+    @http_cache(list_etag, list_last_modified)
     def get(self, request):
         """
         Handle GET requests and return a list of ingredients.
 
         Filters can be applied by passing 'name' or 'pk' as query parameters.
+        Sending `cursor` or `page_size` returns a page, `stream=1` streams every ingredient (superusers only).
         :param request: the HTTP request
         :return: a message indicating
         """
@@ -147,8 +344,7 @@ class IngredientList(APIView):
             Ingredients = Ingredient.objects.filter(name__iexact=name)
         else:
             Ingredients = Ingredient.objects.all()
-        serializer = IngredientSerializer(Ingredients, many=True)
-        return Response(serializer.data)
+        return list_response(self, request, Ingredients, IngredientSerializer)
 
     def post(self, request):
         """
@@ -185,21 +381,25 @@ class IngredientDetail(APIView):
         except Ingredient.DoesNotExist:
             raise Http404
 
+    @http_cache(ingredient_etag, ingredient_last_modified)
     def get(self, request, pk=None):
         """
         Get the ingredient details based on name or pk.
         :param request: HttpRequest
         :param pk: primary key of the ingredient
-        :return: ingredient instance serialized
+        :return: ingredient instance serialized, rendered once per version of the ingredient
         :raises: Http400 if either name or pk is not provided
         """
-        if pk is not None:
-            ingredient = self.get_object(pk)
-        else:
+        if pk is None:
             return Response({"message": "Please provide either a name or a pk for the Ingredient."},
                             status=status.HTTP_400_BAD_REQUEST)
-        serializer = IngredientSerializer(ingredient)
-        return Response(serializer.data)
+        version = row_version(request, Ingredient, pk)
+        if version is None:
+            raise Http404
+        return cached_body(
+            request, ("ingredient", pk, version.isoformat()),
+            lambda: Response(IngredientSerializer(self.get_object(pk)).data)
+        )
 
     def put(self, request, pk):
         """
@@ -233,9 +433,75 @@ class IngredientDetail(APIView):
             return Response({"message": "You do not have permission to perform this action."},
                             status=status.HTTP_401_UNAUTHORIZED)
         try:
-            item = self.get_object()
+            item = self.get_object(pk)
             item.delete()
             return Response({"message": "The item was successfully deleted."}, status=status.HTTP_204_NO_CONTENT)
         except Exception as ex:
             return Response({"message": "An error occurred while deleting the item."},
                             status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class BulkCatalog(APIView):
+    """
+    Bulk import and export of the rows of `model` as NDJSON or CSV, superusers only, see manage_foods.bulk
+    """
+    model = None
+
+    def data_format(self, request):
+        """
+        :param request: the HTTP request
+        :return: str, `fmt` of the query, else csv for a text/csv body, else ndjson
+        """
+        default = "csv" if request.content_type.startswith(bulk.FORMATS["csv"]) else "ndjson"
+        return request.GET.get('fmt', default)
+
+    def get(self, request):
+        """
+        Stream every row, `fmt=csv` or `fmt=ndjson` (default).
+
+        :param request: the HTTP request
+        :return: StreamingHttpResponse with the rows in the import format
+        """
+        if not request.user.is_superuser:
+            return Response({"message": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+        fmt = self.data_format(request)
+        if fmt not in bulk.FORMATS:
+            return Response({"message": "fmt must be one of {}.".format(", ".join(bulk.FORMATS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        response = StreamingHttpResponse(bulk.render_rows(bulk.export_rows(self.model), self.model, fmt),
+                                         content_type="{}; charset=utf-8".format(bulk.FORMATS[fmt]))
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(
+            self.model._meta.verbose_name_plural, fmt
+        )
+        return response
+
+    def post(self, request):
+        """
+        Import the rows of the body, read as it arrives. Rows are written CATALOG_BULK['CHUNK_SIZE'] at a time,
+        invalid rows are skipped and reported.
+
+        :param request: the HTTP request, a body of NDJSON or CSV (Content-Type text/csv or `fmt=csv`)
+        :return: a Response with the numbers of rows, created, updated, unchanged and failed rows and
+                 the first errors
+        """
+        if not request.user.is_superuser:
+            return Response({"message": "You do not have permission to perform this action."},
+                            status=status.HTTP_403_FORBIDDEN)
+        fmt = self.data_format(request)
+        if fmt not in bulk.FORMATS:
+            return Response({"message": "fmt must be one of {}.".format(", ".join(bulk.FORMATS))},
+                            status=status.HTTP_400_BAD_REQUEST)
+        stream = request.stream
+        lines = bulk.decode_lines(stream.readline) if stream is not None else []
+        with span("db.bulk_import"):
+            result = bulk.import_rows(self.model, bulk.read_rows(lines, fmt), fmt)
+        return Response(result)
+
+
+class BulkFoods(BulkCatalog):
+    model = Food
+
+
+class BulkIngredients(BulkCatalog):
+    model = Ingredient
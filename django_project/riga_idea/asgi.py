@@ -14,3 +14,8 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'riga_idea.settings')
 
 application = get_asgi_application()
+
+from main_app.components.food_index import get_food_index  # noqa: E402
+
+# ListFoods matches stored recipes with the food index, built before the first request needs it
+get_food_index().build_in_background()
@@ -14,6 +14,7 @@ from pathlib import Path
 from datetime import timedelta
 import logging
 import os
+import tempfile
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -36,6 +37,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'rest_framework_simplejwt',
     'rest_framework',
     'auth_app',
@@ -44,6 +46,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'main_app.middleware.MetricsMiddleware',
+    'main_app.middleware.DatabaseRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -76,9 +80,25 @@ WSGI_APPLICATION = 'riga_idea.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
+# Connections are kept open for CONN_MAX_AGE seconds and checked before they are reused (CONN_HEALTH_CHECKS).
+# With DB_POOL=1 the threads of a worker share a pool of at most POOL['MAX_SIZE'] connections instead, see
+# main_app.components.postgresql_pool, connections go back to the pool after every request or executor task.
+# The database sees at most workers x MAX_SIZE connections per alias, MAX_SIZE defaults to the number of threads
+# of a worker using the ORM (see FOOD_WRITE_QUEUE)
+DB_POOL = bool(os.getenv("DB_POOL"))
+DB_CONNECTION = {
+    'ENGINE': 'main_app.components.postgresql_pool' if DB_POOL else 'django.db.backends.postgresql',
+    'CONN_MAX_AGE': 0 if DB_POOL else int(os.getenv("DB_CONN_MAX_AGE", 60)),
+    'CONN_HEALTH_CHECKS': True,
+    'POOL': {
+        'TIMEOUT': float(os.getenv("DB_POOL_TIMEOUT", 5)),
+        'MAX_LIFETIME': int(os.getenv("DB_POOL_MAX_LIFETIME", 1800)),
+    },
+}
+
 DATABASES = {
    'default': {
-       'ENGINE': 'django.db.backends.postgresql',
+       **DB_CONNECTION,
        'NAME': os.getenv("NAME"),
        'USER': os.getenv("USER"),
        'PASSWORD': os.getenv("PASSWORD"),
@@ -86,6 +106,21 @@ DATABASES = {
        'PORT': os.getenv("PORT"),
    }
 }
+if os.getenv("REPLICA_HOST"):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'HOST': os.getenv("REPLICA_HOST"),
+        'PORT': os.getenv("REPLICA_PORT", os.getenv("PORT")),
+        'TEST': {'MIRROR': 'default'},
+    }
+
+# Reads of REPLICA_APPS go to the REPLICA alias during their GET requests and the food lookups of main_app,
+# see main_app.components.db_router. Everything reads from the primary without a REPLICA_HOST
+DATABASE_ROUTERS = ['main_app.components.db_router.ReplicaRouter']
+DATABASE_ROUTING = {
+    'REPLICA': 'replica' if 'replica' in DATABASES else None,
+    'REPLICA_APPS': ['manage_foods'],
+}
 
 
 AUTH_USER_MODEL = 'auth_app.User'
@@ -144,10 +179,64 @@ REST_FRAMEWORK = {
 
         'rest_framework_simplejwt.authentication.JWTAuthentication',
         'rest_framework.authentication.SessionAuthentication',
-    )
+    ),
+
+    # per user quota of api/external/*, see main_app.throttling
+    'DEFAULT_THROTTLE_RATES': {
+        'external': os.getenv("EXTERNAL_USER_RATE", '30/min'),
+    },
 
 }
 
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # request history of the throttles, a directory shared by the workers of the host
+    'throttle': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv("THROTTLE_CACHE_LOCATION", os.path.join(tempfile.gettempdir(), "riga_idea_throttle")),
+    },
+    # versions of the cached catalog rows, see manage_foods.object_cache. Shared by the workers of the host,
+    # several hosts need a shared backend such as DatabaseCache, Redis or Memcached
+    'catalog_versions': {
+        'BACKEND': os.getenv("CATALOG_VERSIONS_CACHE_BACKEND", 'main_app.components.cache.LazyCullFileBasedCache'),
+        'LOCATION': os.getenv("CATALOG_VERSIONS_CACHE_LOCATION",
+                              os.path.join(tempfile.gettempdir(), "riga_idea_catalog_versions")),
+        'TIMEOUT': 60 * 60 * 24,
+        'OPTIONS': {'MAX_ENTRIES': 100000, 'CULL_EVERY': 1000},
+    },
+    # rendered catalog responses by version, they never change so every worker keeps its own
+    'catalog_objects': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'catalog_objects',
+        'TIMEOUT': 60 * 60,
+        'OPTIONS': {'MAX_ENTRIES': int(os.getenv("CATALOG_OBJECTS_CACHE_MAX_ENTRIES", 10000))},
+    },
+}
+
+# Cursor pagination of the manage_foods listings, used when the client sends cursor or page_size
+CATALOG_PAGINATION = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 500,
+    'STREAM_CHUNK_SIZE': 1000,
+}
+
+# Bulk NDJSON/CSV import and export of the catalog, see manage_foods.bulk: rows per transaction,
+# rows per INSERT or UPDATE and number of errors reported by an import
+CATALOG_BULK = {
+    'CHUNK_SIZE': int(os.getenv("CATALOG_BULK_CHUNK_SIZE", 1000)),
+    'BATCH_SIZE': 1000,
+    'MAX_ERRORS': 100,
+}
+
+# Conditional GETs of the manage_foods catalog, clients always revalidate (Cache-Control),
+# nginx serves a response from its cache for PROXY_MAX_AGE seconds before revalidating it, see nginx/default.conf
+CATALOG_HTTP_CACHE = {
+    'CACHE_CONTROL': 'private, no-cache',
+    'PROXY_MAX_AGE': int(os.getenv("CATALOG_PROXY_MAX_AGE", 5)),
+}
+
 # settings.py
 
 
@@ -184,6 +273,150 @@ SIMPLE_JWT = {
 }
 
 
+# Process-wide OpenAI client of main_app.components.open_ai, timeouts in seconds
+OPENAI = {
+    'API_KEY': os.getenv("OPENAI_API_KEY"),
+    'API_BASE': os.getenv("OPENAI_API_BASE", "https://api.openai.com/v1"),
+    'MODEL': "text-davinci-003",
+    'CONNECT_TIMEOUT': 3.05,
+    'READ_TIMEOUT': 30,
+    'POOL_SIZE': 20,
+    'MAX_CONCURRENCY': int(os.getenv("OPENAI_MAX_CONCURRENCY", 20)),
+    'MAX_RETRIES': 3,
+    'BACKOFF_BASE': 0.5,
+    'BACKOFF_MAX': 8,
+}
+
+# Caches of main_app.components.cache, BACKEND is one of MemoryBackend (per process),
+# DatabaseBackend (main_app_cacheentry table) or FileBackend (OPTIONS: location). The shared Database and File
+# backends evict every OPTIONS evict_every writes (100) and record accesses every touch_interval seconds (60)
+RESULT_CACHES = {
+    'list_foods': {
+        'BACKEND': os.getenv("LIST_FOODS_CACHE_BACKEND", 'main_app.components.cache.MemoryBackend'),
+        'TIMEOUT': int(os.getenv("LIST_FOODS_CACHE_TIMEOUT", 60 * 60 * 24)),
+        'MAX_ENTRIES': int(os.getenv("LIST_FOODS_CACHE_MAX_ENTRIES", 10000)),
+        'OPTIONS': {},
+    },
+    # OpenAI completions by normalized prompt, shared by the workers and kept across restarts
+    'completions': {
+        'BACKEND': os.getenv("COMPLETIONS_CACHE_BACKEND", 'main_app.components.cache.DatabaseBackend'),
+        'TIMEOUT': int(os.getenv("COMPLETIONS_CACHE_TIMEOUT", 60 * 60 * 24 * 30)),
+        'MAX_ENTRIES': int(os.getenv("COMPLETIONS_CACHE_MAX_ENTRIES", 100000)),
+        'OPTIONS': {},
+    },
+}
+
+# ListFoods answers from stored recipes when at least MIN_MATCHES foods have MIN_COVERAGE
+# of their ingredients among the requested ones, the index is rebuilt every REFRESH_INTERVAL seconds
+FOOD_INDEX = {
+    'MIN_MATCHES': int(os.getenv("FOOD_INDEX_MIN_MATCHES", 3)),
+    'MIN_COVERAGE': 1.0,
+    'MAX_RESULTS': 5,
+    'REFRESH_INTERVAL': 300,
+}
+
+# Search of stored foods, see manage_foods.search. CONFIG is the PostgreSQL text search configuration,
+# MIN_SIMILARITY the name similarity of typo matches without PostgreSQL. DetailFood answers with a stored food
+# whose name is at least DUPLICATE_SIMILARITY similar to the requested one instead of asking OpenAI, None disables it
+FOOD_SEARCH = {
+    'CONFIG': 'english',
+    'MAX_RESULTS': 20,
+    'MIN_SIMILARITY': 0.6,
+    'DUPLICATE_SIMILARITY': float(os.getenv("FOOD_DUPLICATE_SIMILARITY", 0.7)),
+}
+
+# Thread pool and timeouts (seconds) of the OpenAI and YouTube lookups of DetailFood
+EXTERNAL_CALLS = {
+    'MAX_WORKERS': int(os.getenv("EXTERNAL_CALLS_MAX_WORKERS", 16)),
+    'RECIPE_TIMEOUT': 30,
+    'VIDEO_TIMEOUT': 5,
+    # foods of one DetailFood batch request and how many of them are generated at the same time
+    'BATCH_MAX_FOODS': 10,
+    'BATCH_WORKERS': int(os.getenv("EXTERNAL_CALLS_BATCH_WORKERS", 6)),
+}
+
+# Serve api/external/* with the async views of main_app.async_views,
+# only worth it under an ASGI server (see docker-compose.yml)
+ASYNC_EXTERNAL_VIEWS = bool(os.getenv("ASYNC_EXTERNAL_VIEWS"))
+
+# Deduplication of concurrent DetailFood generations of the same food,
+# BACKEND "database" also deduplicates across workers, "local" only inside a worker
+SINGLE_FLIGHT = {
+    'BACKEND': os.getenv("SINGLE_FLIGHT_BACKEND", 'database'),
+    'WAIT_TIMEOUT': 30,
+    'LEASE_TIMEOUT': 60,
+    'RESULT_TTL': 30,
+    'POLL_INTERVAL': 0.1,
+}
+
+# Background persistence of generated foods, WORKERS 0 writes on the request thread
+FOOD_WRITE_QUEUE = {
+    'WORKERS': int(os.getenv("FOOD_WRITE_QUEUE_WORKERS", 2)),
+    'MAX_SIZE': 1000,
+    'PUT_TIMEOUT': 0.1,
+    'MAX_RETRIES': 3,
+    'RETRY_DELAY': 0.5,
+}
+
+# threads of a worker which may hold a database connection at once: request threads (gunicorn --threads),
+# the executors of main_app.views and the write queue workers
+DB_CONNECTION['POOL']['MAX_SIZE'] = int(os.getenv("DB_POOL_MAX_SIZE", 0)) or (
+    int(os.getenv("GUNICORN_THREADS", 1)) + EXTERNAL_CALLS['MAX_WORKERS'] + EXTERNAL_CALLS['BATCH_WORKERS']
+    + FOOD_WRITE_QUEUE['WORKERS']
+)
+
+# Circuit breakers of the upstream APIs: the circuit opens for OPEN_TIMEOUT seconds when FAILURE_RATE of
+# at least MIN_CALLS calls of the last WINDOW seconds failed or took longer than SLOW_CALL_DURATION seconds
+CIRCUIT_BREAKERS = {
+    'openai': {
+        'FAILURE_RATE': 0.5,
+        'MIN_CALLS': 5,
+        'WINDOW': 60,
+        'SLOW_CALL_DURATION': 25,
+        'OPEN_TIMEOUT': 30,
+    },
+    'youtube': {
+        'FAILURE_RATE': 0.5,
+        'MIN_CALLS': 5,
+        'WINDOW': 60,
+        'SLOW_CALL_DURATION': 4,
+        'OPEN_TIMEOUT': 30,
+    },
+}
+
+# Token buckets of the upstream APIs (RATE calls per second, BURST calls at once). Callers wait up to MAX_WAIT
+# seconds for a token, at most MAX_QUEUE of them per worker, then fail fast. BACKEND is one of LocalBucket
+# (per process), FileBucket (workers of one host) or DatabaseBucket (main_app_ratebucket table)
+RATE_LIMITS = {
+    'openai': {
+        'BACKEND': os.getenv("RATE_LIMIT_BACKEND", 'main_app.components.rate_limit.FileBucket'),
+        'RATE': float(os.getenv("OPENAI_RATE_LIMIT", 3)),
+        'BURST': 10,
+        'MAX_WAIT': 10,
+        'MAX_QUEUE': 100,
+    },
+    'youtube': {
+        'BACKEND': os.getenv("RATE_LIMIT_BACKEND", 'main_app.components.rate_limit.FileBucket'),
+        'RATE': float(os.getenv("YOUTUBE_RATE_LIMIT", 5)),
+        'BURST': 10,
+        'MAX_WAIT': 2,
+        'MAX_QUEUE': 50,
+    },
+}
+
+# In-process metrics served in the Prometheus text format at /metrics, which requires
+# "Authorization: Bearer <TOKEN>" and is refused without a TOKEN unless PUBLIC is set (nginx never serves it).
+# Responses carry the time per span and the database queries in a Server-Timing header with SERVER_TIMING,
+# otherwise only for requests with "X-Metrics-Token: <TOKEN>". Quantiles are computed over the last MAX_SAMPLES
+# observations. The metrics are kept per gunicorn worker, the workers share the port so a scrape reaches one of them
+# at random: every series has the pid of its worker in a "worker" label and is a sample of that worker only
+METRICS = {
+    'TOKEN': os.getenv("METRICS_TOKEN"),
+    'PUBLIC': bool(os.getenv("METRICS_PUBLIC")),
+    'SERVER_TIMING': bool(os.getenv("METRICS_SERVER_TIMING")),
+    'MAX_SAMPLES': 1024,
+}
+
 
 LOGGING = {
     'version': 1,